@@ -0,0 +1,177 @@
+# encoding: utf-8
+"""
+Access log for the HFTP server.
+
+Records are produced from inside the event loop, so AccessLog.record()
+never touches the output stream: it only appends the record to a bounded
+in-memory ring buffer. A background thread drains the buffer in batches
+and writes them out. If the writer can't keep up (e.g. stdout is a slow
+pipe) the buffer fills up and new records are dropped and counted instead
+of stalling the server.
+"""
+
+import collections
+import json
+import sys
+import threading
+import time
+from typing import Deque, Dict, IO, List, Union
+
+FORMATS = ('text', 'json')
+
+DEFAULT_CAPACITY = 8192
+DEFAULT_BATCH_SIZE = 512
+DEFAULT_FLUSH_INTERVAL = 0.2  # seconds
+
+# Long arguments (e.g. a 5MB bogus filename) are cut down to this length
+MAX_FIELD_LENGTH = 128
+
+Record = Dict[str, Union[str, int, float, None]]
+
+
+class AccessLog(object):
+    """
+    Log estructurado con un registro por comando atendido, escrito en
+    segundo plano.
+    """
+
+    stream: IO[str]
+    fmt: str
+    capacity: int
+    batch_size: int
+    flush_interval: float
+
+    # records waiting for the writer thread
+    buffer: Deque[Record]
+
+    # records discarded because the buffer was full
+    dropped: int
+    # value of dropped already reported in the log itself
+    reported_dropped: int
+
+    def __init__(self, stream: IO[str] = None, fmt: str = 'text',
+                 capacity: int = DEFAULT_CAPACITY,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown access log format '{fmt}'")
+
+        self.stream = stream if stream is not None else sys.stdout
+        self.fmt = fmt
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.buffer = collections.deque()
+        self.dropped = 0
+        self.reported_dropped = 0
+
+        self.closed = threading.Event()
+        self.writer = threading.Thread(target=self.writer_loop,
+                                       name='access-log', daemon=True)
+        self.writer.start()
+
+    def record(self, peer: str, event: str, command: str = None,
+               args: str = None, status: int = None, nbytes: int = None,
+               duration: float = None, listener: str = None):
+        """
+        Queues a record without blocking. Safe to call from the event loop.
+        Durations are in seconds.
+        """
+        # deque.append and len are atomic, so the hot path takes no locks
+        if len(self.buffer) >= self.capacity:
+            self.dropped += 1
+            return
+
+        self.buffer.append({
+            'time': time.time(),
+            'peer': peer,
+            'event': event,
+            'command': command,
+            'args': args,
+            'status': status,
+            'bytes': nbytes,
+            'duration': duration,
+            'listener': listener,
+        })
+
+    def close(self):
+        """Stops the writer after flushing every queued record."""
+        self.closed.set()
+        self.writer.join()
+
+    # Writer thread
+
+    def writer_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        while True:
+            batch = self.take_batch()
+            if not batch:
+                break
+            try:
+                self.stream.write(''.join(batch))
+                self.stream.flush()
+            except (OSError, ValueError):
+                # Nowhere left to log to; keep draining so memory is freed
+                pass
+
+    def take_batch(self) -> List[str]:
+        batch = []
+
+        dropped = self.dropped
+        if dropped != self.reported_dropped:
+            batch.append(self.format({
+                'time': time.time(),
+                'event': 'dropped',
+                'count': dropped - self.reported_dropped,
+            }))
+            self.reported_dropped = dropped
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.format(self.buffer.popleft()))
+            except IndexError:
+                break
+
+        return batch
+
+    def format(self, record: Record) -> str:
+        if self.fmt == 'json':
+            return json.dumps(record, separators=(',', ':')) + '\n'
+        return format_text(record)
+
+
+def format_text(record: Record) -> str:
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S',
+                              time.localtime(record['time']))
+    millis = int(record['time'] * 1000) % 1000
+    fields = [f"{timestamp}.{millis:03d}"]
+
+    if record['event'] == 'dropped':
+        fields.append(f"dropped {record['count']} records")
+        return ' '.join(fields) + '\n'
+
+    fields.append(record['peer'])
+    if record['listener']:
+        fields.append(f"via {record['listener']}")
+    if record['event'] != 'command':
+        fields.append(record['event'])
+        return ' '.join(fields) + '\n'
+
+    fields.append(record['command'])
+    if record['args']:
+        fields.append(record['args'])
+    fields.append(str(record['status']))
+    fields.append(f"{record['bytes']}B")
+    fields.append(f"{record['duration'] * 1000:.3f}ms")
+    return ' '.join(fields) + '\n'
+
+
+def shorten(s: str) -> str:
+    if len(s) <= MAX_FIELD_LENGTH:
+        return s
+    return s[:MAX_FIELD_LENGTH] + f"...({len(s)} chars)"
@@ -0,0 +1,90 @@
+# encoding: utf-8
+"""
+Backpressure on the output of the connections.
+
+A client that pipelines requests without reading the responses would make
+the server buffer them all. Instead, every connection stops reading and
+serving requests once its unsent output reaches the high water mark, and
+resumes when it drains below the low water mark. The server drops POLLIN
+for it meanwhile, so the requests pile up in the kernel and TCP flow
+control pushes back on the client.
+
+On top of that, the output of all the connections shares a memory budget.
+While it is exhausted, connections with unsent output don't serve new
+requests either, until the total falls back to BUDGET_LOW_RATIO of the
+budget. Connections that keep up with their responses are still served,
+so well behaved clients aren't starved by the ones that don't read.
+
+Responses are never split, so the output can go over the marks by one
+response per connection, and the real bound is the budget plus that much
+per connection. Each response is bounded on its own: get_slices and
+get_file refuse to send more than MAX_BATCH_BYTES, and get_slice bodies
+larger than STREAM_CHUNK are read from the file as they are sent, a chunk
+at a time. Only listings grow with the size of the directory.
+"""
+
+from ratelimit import parse_rate
+
+DEFAULT_HIGH_WATER = 4 * 2**20
+DEFAULT_LOW_WATER = 2**20
+DEFAULT_MEMORY_BUDGET = 256 * 2**20
+# Fraction of the budget the output has to fall to once exhausted
+BUDGET_LOW_RATIO = 0.75
+
+
+def parse_size(s: str) -> int:
+    """Parses a size in bytes, e.g. "512K" or "64M"."""
+    return parse_rate(s)
+
+
+class OutputBudget(object):
+    """
+    Salida pendiente de todas las conexiones, y los límites que la acotan.
+    """
+
+    high_water: int
+    low_water: int
+    limit: int
+
+    # bytes queued and not sent yet, among all the connections
+    used: int
+    exhausted: bool
+    # set when the budget stops being exhausted, cleared by the server
+    # once it resumed the connections it had paused
+    resumed: bool
+    # times the budget got exhausted
+    exhaustions: int
+
+    def __init__(self, high_water: int = DEFAULT_HIGH_WATER,
+                 low_water: int = DEFAULT_LOW_WATER,
+                 limit: int = DEFAULT_MEMORY_BUDGET):
+        if not 0 <= low_water <= high_water:
+            raise ValueError("Expected 0 <= low water mark <= high water "
+                             f"mark, got {low_water} and {high_water}")
+        self.high_water = high_water
+        self.low_water = low_water
+        self.limit = limit
+        self.used = 0
+        self.exhausted = False
+        self.resumed = False
+        self.exhaustions = 0
+
+    def add(self, n: int):
+        self.used += n
+        if not self.exhausted and self.used >= self.limit:
+            self.exhausted = True
+            self.exhaustions += 1
+
+    def release(self, n: int):
+        self.used -= n
+        if self.exhausted and self.used <= self.limit * BUDGET_LOW_RATIO:
+            self.exhausted = False
+            self.resumed = True
+
+    def stats(self) -> dict:
+        return {
+            'used': self.used,
+            'limit': self.limit,
+            'exhausted': self.exhausted,
+            'exhaustions': self.exhaustions,
+        }
@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+In-process micro-benchmarks for the HFTP server hot path.
+
+Every benchmark drives a Connection directly, either over a fake socket
+or over socket.socketpair(), so that parsing, framing, line accumulation
+and base64 encoding can be measured without kernel networking noise.
+
+Results are normalized by a fixed pure-Python calibration workload, timed
+right before every round of every benchmark, and compared against the
+baselines stored in BASELINE_FILE, so the same baseline can be used on
+machines of different speed. The median of the rounds is compared, not
+the best one. Any benchmark that gets slower than its baseline by more
+than the tolerance is measured again CONFIRM_RUNS times, and makes the
+script exit with a non-zero status only if it regressed every time.
+
+The network scenarios (--storm, --latency, --reload) run a real server in
+a subprocess. They are reported but not compared against baselines, since
+they depend on kernel settings far more than on our code.
+"""
+
+import json
+import logging
+import optparse
+import os
+import selectors
+import shutil
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import client
+from connection import Connection
+from constants import CODE_OK, bEOL
+from serverproc import spawn_server
+from stats import percentile
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_baseline.json')
+DEFAULT_TOLERANCE = 0.5
+DEFAULT_REPEAT = 7
+# Times a regression is measured again before reporting it
+CONFIRM_RUNS = 2
+# Minimum duration of a round, in seconds
+ROUND_TIME = 0.02
+
+LINE_SIZES = [16, 256, 4096, 65536]
+PIPELINE_DEPTHS = [1, 16, 128]
+SLICE_SIZES = [1024, 65536, 1048576]
+
+
+class FakeSocket(object):
+    """
+    Minimal stand-in for a non-blocking socket. recv() hands out the
+    preloaded input in BUFFER_SIZE chunks and send() swallows everything.
+    """
+
+    def __init__(self, data: bytes = b''):
+        self.data = data
+        self.pos = 0
+
+    def feed(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def recv(self, size: int) -> bytes:
+        if self.pos >= len(self.data):
+            raise BlockingIOError
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+    def send(self, data) -> int:
+        return len(data)
+
+    def getpeername(self):
+        return ('127.0.0.1', 0)
+
+    def fileno(self) -> int:
+        return -1
+
+    def close(self):
+        pass
+
+
+def round_loops(fn: Callable[[], None]) -> int:
+    """Calls of fn it takes for a round to last at least ROUND_TIME."""
+    loops = 1
+    while time_round(fn, loops) * loops < ROUND_TIME * 1e9:
+        loops *= 2
+    return loops
+
+
+def time_round(fn: Callable[[], None], loops: int) -> float:
+    """Wall time per call of fn over `loops' calls, in nanoseconds."""
+    start = time.perf_counter()
+    for _ in range(loops):
+        fn()
+    return (time.perf_counter() - start) / loops * 1e9
+
+
+def calibration():
+    # Fixed interpreter-bound workload used to normalize results
+    acc = 0
+    for i in range(10000):
+        acc += i * i % 7
+    return acc
+
+
+def measure(fn: Callable[[], None], repeat: int) -> Tuple[float, float]:
+    """
+    Times fn in `repeat' rounds, each right after a round of the
+    calibration workload so that frequency scaling and other processes
+    slow both alike. Returns the median time per call in nanoseconds and
+    the median ratio to the calibration.
+    """
+    loops = round_loops(fn)
+    calibration_loops = round_loops(calibration)
+    times = []
+    ratios = []
+    for _ in range(repeat):
+        calibration_ns = time_round(calibration, calibration_loops)
+        ns = time_round(fn, loops)
+        times.append(ns)
+        ratios.append(ns / calibration_ns)
+    return statistics.median(times), statistics.median(ratios)
+
+
+# Benchmarks. Each factory receives a scratch directory and returns the
+# function to time.
+
+def bench_process_line(size: int):
+    def factory(directory: str) -> Callable[[], None]:
+        # Replace the handler so only parsing and dispatch get measured
+        patterns, repeated, _ = Connection.commands["get_metadata"]
+
+        class ParseOnly(Connection):
+            __slots__ = ()
+            commands = dict(Connection.commands, get_metadata=(
+                patterns, repeated, lambda self, args: (CODE_OK, "OK")))
+
+        conn = ParseOnly(FakeSocket(), directory)
+        line = "get_metadata " + "x" * size + "\r\n"
+        return lambda: conn.process_line(line)
+    return factory
+
+
+def bench_send_message(size: int):
+    def factory(directory: str) -> Callable[[], None]:
+        conn = Connection(FakeSocket(), directory)
+        body = b"x" * size
+        return lambda: conn.send_message(CODE_OK, "OK", body)
+    return factory
+
+
+def bench_send_listing(count: int):
+    def factory(directory: str) -> Callable[[], None]:
+        conn = Connection(FakeSocket(), directory)
+        body = [b"file%06d" % i for i in range(count)]
+        return lambda: conn.send_message(CODE_OK, "OK", body)
+    return factory
+
+
+def bench_recv_line(size: int):
+    def factory(directory: str) -> Callable[[], None]:
+        sock = FakeSocket()
+        conn = Connection(sock, directory)
+        data = b"x" * (size - 2) + bEOL
+
+        def run():
+            sock.feed(data)
+            line = conn.recv_line()
+            assert line is not None and len(line) == size
+        return run
+    return factory
+
+
+def bench_get_slice(size: int):
+    def factory(directory: str) -> Callable[[], None]:
+        with open(os.path.join(directory, 'slice'), 'wb') as f:
+            f.write(os.urandom(size))
+        conn = Connection(FakeSocket(), directory)
+        args = ['slice', '0', str(size)]
+        # Framed and sent too: large slices are read while they are sent
+        return lambda: conn.send_message(*conn.get_slice_handler(args))
+    return factory
+
+
+def bench_pipeline(depth: int):
+    def factory(directory: str) -> Callable[[], None]:
+        open(os.path.join(directory, 'meta'), 'wb').close()
+        server_end, client_end = socket.socketpair()
+        server_end.setblocking(False)
+        conn = Connection(server_end, directory)
+        request = b"get_metadata meta\r\n" * depth
+        # "0 OK\r\n0\r\n" per request
+        expected = len(b"0 OK\r\n0\r\n") * depth
+
+        def run():
+            client_end.sendall(request)
+            received = 0
+            while received < expected:
+                conn.on_read_available()
+                received += len(client_end.recv(65536))
+        return run
+    return factory
+
+
+BENCHMARKS: List[Tuple[str, Callable[[str], Callable[[], None]]]] = (
+    [(f"process_line/{n}", bench_process_line(n)) for n in LINE_SIZES] +
+    [(f"send_message/{n}", bench_send_message(n)) for n in SLICE_SIZES] +
+    [(f"send_listing/{n}", bench_send_listing(n)) for n in (10, 1000)] +
+    [(f"recv_line/{n}", bench_recv_line(n)) for n in LINE_SIZES] +
+    [(f"get_slice/{n}", bench_get_slice(n)) for n in SLICE_SIZES] +
+    [(f"pipeline/{n}", bench_pipeline(n)) for n in PIPELINE_DEPTHS]
+)
+
+
+def run_benchmarks(names: List[str], repeat: int,
+                   exact: bool = False) -> Dict[str, Tuple[float, float]]:
+    """
+    Runs the benchmarks whose names contain any of `names' (all if empty),
+    or with exact, only those named exactly so. See measure().
+    """
+    results = {}
+    directory = tempfile.mkdtemp(prefix='hftp-bench-')
+    try:
+        for name, factory in BENCHMARKS:
+            if exact and name not in names:
+                continue
+            if names and not any(n in name for n in names):
+                continue
+            results[name] = measure(factory(directory), repeat)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+# Network scenarios
+
+STORM_CLIENTS = 2000
+LATENCY_REQUESTS = 5000
+LATENCY_SLICE = 256 * 1024
+RELOAD_DURATION = 6  # seconds
+RELOAD_CLIENTS = 32
+# Each load test client reconnects after this many requests
+REQUESTS_PER_CONNECTION = 50
+STORM_TIMEOUT = 60  # seconds
+
+
+def raise_fd_limit(wanted: int):
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def storm(port: int, clients: int) -> Tuple[float, int]:
+    """
+    Opens `clients' connections at once, each sending a single quit, and
+    returns the time until every one got its answer and the number of
+    connections that failed.
+    """
+    sel = selectors.DefaultSelector()
+    pending = {}
+    failed = 0
+    start = time.perf_counter()
+
+    for _ in range(clients):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(('127.0.0.1', port))
+        sel.register(sock, selectors.EVENT_WRITE)
+        pending[sock] = b''
+
+    deadline = time.monotonic() + STORM_TIMEOUT
+    while pending and time.monotonic() < deadline:
+        for key, mask in sel.select(1):
+            sock = key.fileobj
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    sock.send(b'quit\r\n')
+                    sel.modify(sock, selectors.EVENT_READ)
+                    continue
+                data = sock.recv(64)
+            except OSError:
+                data = b''
+                failed += 1
+            pending[sock] += data
+            if not data or bEOL in pending[sock]:
+                sel.unregister(sock)
+                sock.close()
+                del pending[sock]
+
+    failed += len(pending)
+    for sock in pending:
+        sock.close()
+    return time.perf_counter() - start, failed
+
+
+def run_storms(clients: int):
+    raise_fd_limit(clients + 256)
+    directory = tempfile.mkdtemp(prefix='hftp-bench-')
+    try:
+        for batch in (1, 64):
+            proc, port = spawn_server(directory,
+                                      ['--accept-batch', str(batch)])
+            try:
+                elapsed, failed = storm(port, clients)
+            finally:
+                proc.kill()
+                proc.wait()
+            print(f"storm/{clients} accept_batch={batch:<4}"
+                  f"{elapsed * 1000:10.1f} ms   {failed} failed")
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_latency(requests: int):
+    """
+    Compares request latency and slice throughput over loopback TCP and
+    over a Unix domain socket served by the same server.
+    """
+    directory = tempfile.mkdtemp(prefix='hftp-bench-')
+    unix_path = os.path.join(directory, 'hftp.sock')
+    with open(os.path.join(directory, 'data'), 'wb') as f:
+        f.write(os.urandom(LATENCY_SLICE))
+    proc, port = spawn_server(directory, ['-L', 'unix:' + unix_path])
+    try:
+        for name, address in (('tcp', '127.0.0.1'),
+                              ('unix', 'unix:' + unix_path)):
+            c = client.Client(address, port)
+            samples = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                c.get_metadata('data')
+                samples.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            c.send('get_slice data 0 %d' % LATENCY_SLICE)
+            c.read_response_line()
+            c.read_fragment(LATENCY_SLICE)
+            elapsed = time.perf_counter() - start
+            c.close()
+
+            print(f"latency/{name:5} p50 {percentile(samples, .5) * 1e6:8.1f}"
+                  f" us   p99 {percentile(samples, .99) * 1e6:8.1f} us   "
+                  f"slice {LATENCY_SLICE / elapsed / 2**20:8.1f} MB/s")
+    finally:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(directory)
+
+
+def run_reload(clients: int):
+    """
+    Load test across a graceful reload: `clients' threads issue
+    get_metadata requests for RELOAD_DURATION seconds and the server gets
+    a SIGHUP halfway through. Reports failed requests and the latency
+    around the reload compared to the rest of the run.
+
+    Like any keep-alive client, a request that fails on a reused connection
+    (which the old server may have closed while idle) is retried once on a
+    new one; those are reported as reconnects, not errors.
+    """
+    # Closed connections make Client warn about every empty response
+    logging.getLogger().setLevel(logging.ERROR)
+
+    directory = tempfile.mkdtemp(prefix='hftp-bench-')
+    open(os.path.join(directory, 'meta'), 'wb').close()
+    proc, port = spawn_server(directory, ['--drain-timeout', '5'],
+                              start_new_session=True)
+
+    samples = []  # (time since start, latency)
+    errors = []
+    reconnects = []
+    lock = threading.Lock()
+    start = time.monotonic()
+    stop = start + RELOAD_DURATION
+
+    def worker():
+        c = None
+        done = 0
+        while time.monotonic() < stop:
+            t0 = time.monotonic()
+            reused = c is not None
+            try:
+                if c is None:
+                    c = client.Client('127.0.0.1', port)
+                if c.get_metadata('meta') != 0:
+                    raise RuntimeError(f"status {c.status}")
+                done += 1
+                if done % REQUESTS_PER_CONNECTION == 0:
+                    c.close()
+                    c = None
+            except (OSError, RuntimeError) as e:
+                c = None
+                with lock:
+                    if reused:
+                        reconnects.append(t0 - start)
+                    else:
+                        errors.append((t0 - start, repr(e)))
+                if not reused:
+                    continue
+                try:
+                    c = client.Client('127.0.0.1', port)
+                    if c.get_metadata('meta') != 0:
+                        raise RuntimeError(f"status {c.status}")
+                except (OSError, RuntimeError) as e:
+                    c = None
+                    with lock:
+                        errors.append((t0 - start, repr(e)))
+                    continue
+            with lock:
+                samples.append((t0 - start, time.monotonic() - t0))
+        if c is not None:
+            c.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    try:
+        for t in threads:
+            t.start()
+        time.sleep(RELOAD_DURATION / 2)
+        reload_at = time.monotonic() - start
+        proc.send_signal(signal.SIGHUP)
+        for t in threads:
+            t.join()
+    finally:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        shutil.rmtree(directory)
+
+    around = [lat for t, lat in samples if abs(t - reload_at) < 1]
+    steady = [lat for t, lat in samples if abs(t - reload_at) >= 1]
+    print(f"reload/{clients} {len(samples)} requests, {len(errors)} errors, "
+          f"{len(reconnects)} reconnects")
+    for name, lats in (('steady', steady), ('reload', around)):
+        if lats:
+            print(f"  {name:7} p50 {percentile(lats, .5) * 1000:7.2f} ms   "
+                  f"p99 {percentile(lats, .99) * 1000:7.2f} ms   "
+                  f"max {max(lats) * 1000:7.2f} ms")
+    for t, error in errors[:10]:
+        print(f"  error at {t:.2f}s: {error}")
+
+
+def compare(results: Dict[str, Tuple[float, float]], baseline: Dict,
+            tolerance: float, label: str = 'REGRESSION') -> List[str]:
+    """
+    Prints every result next to its baseline and returns the names of the
+    benchmarks that regressed beyond the tolerance.
+    """
+    regressions = []
+    base_results = baseline.get('results', {})
+    for name, (ns, ratio) in results.items():
+        base = base_results.get(name)
+        if base is None:
+            print(f"{name:24} {ns:14.0f} ns   (no baseline)")
+            continue
+        change = ratio / base - 1
+        flag = ''
+        if change > tolerance:
+            flag = '  ' + label
+            regressions.append(name)
+        print(f"{name:24} {ns:14.0f} ns   {change:+7.1%}{flag}")
+    return regressions
+
+
+def confirm(regressions: List[str], repeat: int, baseline: Dict,
+            tolerance: float) -> List[str]:
+    """
+    Measures the regressed benchmarks again, CONFIRM_RUNS times, and
+    returns the ones that regressed every time.
+    """
+    for run in range(CONFIRM_RUNS):
+        if not regressions:
+            break
+        print(f"Confirming {len(regressions)} regressions "
+              f"({run + 1}/{CONFIRM_RUNS})")
+        results = {}
+        for name in regressions:
+            results.update(run_benchmarks([name], repeat, exact=True))
+        regressions = compare(results, baseline, tolerance, 'CONFIRMED')
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option(
+        "-r", "--repeat", type="int", default=DEFAULT_REPEAT,
+        help="Rondas por benchmark (se toma la mediana)")
+    parser.add_option(
+        "-t", "--tolerance", type="float", default=DEFAULT_TOLERANCE,
+        help="Empeoramiento relativo tolerado respecto del baseline")
+    parser.add_option(
+        "-b", "--baseline", default=BASELINE_FILE,
+        help="Archivo con los baselines")
+    parser.add_option(
+        "-s", "--save", action="store_true", default=False,
+        help="Guardar los resultados como nuevo baseline")
+    parser.add_option(
+        "--storm", type="int", default=None, metavar="CLIENTS",
+        help="Medir cuánto tarda el servidor en atender una avalancha de "
+             "CLIENTS conexiones simultáneas (ej. %d)" % STORM_CLIENTS)
+    parser.add_option(
+        "--latency", type="int", default=None, metavar="REQUESTS",
+        help="Comparar la latencia de REQUESTS pedidos por TCP loopback y "
+             "por socket Unix (ej. %d)" % LATENCY_REQUESTS)
+    parser.add_option(
+        "--reload", type="int", default=None, metavar="CLIENTS",
+        help="Medir errores y latencia de CLIENTS clientes mientras el "
+             "servidor se reinicia con kill -HUP (ej. %d)" % RELOAD_CLIENTS)
+    options, args = parser.parse_args()
+
+    if options.reload is not None:
+        run_reload(options.reload)
+        return
+    if options.storm is not None:
+        run_storms(options.storm)
+        return
+    if options.latency is not None:
+        run_latency(options.latency)
+        return
+
+    results = run_benchmarks(args, options.repeat)
+
+    if options.save:
+        baseline = {'results': {}}
+        if os.path.exists(options.baseline):
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+        for name, (ns, ratio) in results.items():
+            baseline['results'][name] = ratio
+        with open(options.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Saved {len(results)} baselines to {options.baseline}")
+        return
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = compare(results, baseline, options.tolerance)
+    regressions = confirm(regressions, options.repeat, baseline,
+                          options.tolerance)
+    if regressions:
+        sys.stderr.write("Hot path regressions: %s\n" % ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
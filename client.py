@@ -6,29 +6,80 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: client.py 387 2011-03-22 13:48:44Z nicolasw $
 
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
+import json
+import os
+import select
 import socket
 import logging
 import optparse
 import sys
+import threading
 import time
 from base64 import b64decode
 from constants import *
 
+# Conexiones por servidor que mantiene como máximo un ConnectionPool
+DEFAULT_POOL_SIZE = 8
+# Segundos que una conexión puede quedar ociosa en el pool
+DEFAULT_POOL_IDLE = 60
+# Bytes a pedir en cada recv()
+RECV_SIZE = 65536
+# Transferencias simultáneas del modo espejo
+DEFAULT_JOBS = 4
+# Tamaño de los pedazos en que el modo espejo baja cada archivo
+MIRROR_CHUNK = 2 ** 20
+# Nombres por pedido de get_metadata_batch
+METADATA_BATCH = 256
+# Segundos entre actualizaciones del progreso
+PROGRESS_INTERVAL = 0.5
+# Índice de la caché de descargas, dentro del directorio de la caché
+CACHE_INDEX = '.hftp-cache.json'
+# Veces que se reintenta una descarga si el archivo cambia a mitad de camino
+VERSION_RETRIES = 3
+# Peso de cada medición nueva en el RTT suavizado (como en TCP) y en el
+# throughput suavizado de cada mirror
+SRTT_ALPHA = 0.125
+THROUGHPUT_ALPHA = 0.25
+# Sólo las respuestas de al menos este tamaño cuentan para el throughput
+THROUGHPUT_MIN_BYTES = 64 * 1024
+# Latencias recientes de cada mirror que se usan para estimar su p95
+LATENCY_SAMPLES = 64
+# Pedidos medidos en un mirror antes de empezar a duplicar los lentos
+HEDGE_MIN_SAMPLES = 8
+# Segundos que se evita un mirror después de que falla
+MIRROR_BACKOFF = 5
+# Mientras no se puede estimar cuándo duplicar un pedido, cada cuántos
+# segundos volver a intentarlo
+HEDGE_CHECK_INTERVAL = 0.05
+
 
 class Client(object):
 
-    def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+    def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT, cache=None):
         """
         Nuevo cliente, conectado al `server' solicitado en el `port' TCP
-        indicado.
+        indicado. Si `server' es de la forma unix:/ruta, se conecta en
+        cambio al socket Unix en esa ruta y se ignora `port'.
+
+        Si se da una DownloadCache, retrieve guarda los archivos en ella y
+        no vuelve a bajar los que ya tiene en la misma versión.
 
         Si falla la conexión, genera una excepción de socket.
         """
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if server.startswith(UNIX_PREFIX):
+            self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.s.connect(server[len(UNIX_PREFIX):])
+        else:
+            # Resuelve tanto IPv4 como IPv6
+            self.s = socket.create_connection((server, port))
         self.status = None
-        self.s.connect((server, port))
         self.buffer = ''
         self.connected = True
+        self.cache = cache
 
     def close(self):
         """
@@ -43,6 +94,28 @@ class Client(object):
         self.connected = False
         self.s.close()
 
+    def abort(self):
+        """
+        Cierra la conexión sin avisarle al server, p.ej. si quedó en un
+        estado desconocido a mitad de una respuesta.
+        """
+        self.connected = False
+        self.s.close()
+
+    def is_alive(self):
+        """
+        Chequeo barato, sin ida y vuelta al server, de que una conexión
+        ociosa sigue sirviendo: no debe haber nada para leer. Si lo hay, es
+        el fin de la conexión (el server la cerró) o datos que nadie pidió.
+        """
+        if not self.connected or self.buffer:
+            return False
+        try:
+            readable, _, _ = select.select([self.s], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
     def send(self, message, timeout=None):
         """
         Envía el mensaje 'message' al server, seguido por el terminador de
@@ -63,17 +136,18 @@ class Client(object):
 
     def _recv(self, timeout=None):
         """
-        Recibe datos y acumula en el buffer interno.
+        Recibe datos y los devuelve; read_line se encarga de acumularlos en
+        el buffer interno.
 
         Para uso privado del cliente.
         """
         self.s.settimeout(timeout)
-        data = self.s.recv(4096).decode("ascii")
-        self.buffer += data
+        data = self.s.recv(RECV_SIZE).decode("ascii")
 
         if len(data) == 0:
             logging.info("El server interrumpió la conexión.")
             self.connected = False
+        return data
 
     def read_line(self, timeout=None):
         """
@@ -83,15 +157,28 @@ class Client(object):
         Devuelve la línea, eliminando el terminaodr y los espacios en blanco
         al principio y al final.
         """
-        while not EOL in self.buffer and self.connected:
-            if timeout is not None:
-                t1 = time.process_time()
-            self._recv(timeout)
-            if timeout is not None:
-                t2 = time.process_time()
-                timeout -= t2 - t1
-                t1 = t2
-        if EOL in self.buffer:
+        # Las líneas de datos pueden medir megabytes: se juntan los pedazos
+        # recibidos una sola vez al final, y se busca el terminador sólo en
+        # lo nuevo (más el último carácter, por si quedó partido)
+        chunks = [self.buffer]
+        found = EOL in self.buffer
+        # El timeout es de reloj de pared: cuenta el tiempo esperando al
+        # server, que es justamente el que no consume CPU
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not found and self.connected:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout("timed out")
+                data = self._recv(remaining)
+                found = EOL in chunks[-1][-1:] + data
+                chunks.append(data)
+        finally:
+            # Aun si hubo timeout, no perder lo recibido
+            self.buffer = ''.join(chunks)
+        if found:
             response, self.buffer = self.buffer.split(EOL, 1)
             return response.strip()
         else:
@@ -127,6 +214,9 @@ class Client(object):
         data = self.read_line()
         fragment = b64decode(data)
         while len(fragment) < length:
+            if not self.connected:
+                raise ConnectionError("Se cortó la conexión a mitad de la "
+                                      "respuesta")
             data = self.read_line()
             fragment += b64decode(data)
 
@@ -163,6 +253,31 @@ class Client(object):
             size = int(self.read_line())
             return size
 
+    def get_metadata_ext(self, filename):
+        """
+        Obtiene en el server el tamaño, la fecha de modificación (en
+        segundos desde la época) y el token de versión del archivo.
+        Devuelve la tupla (tamaño, mtime, versión), o None en caso de error.
+        """
+        self.send('get_metadata_ext %s' % filename)
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            size, mtime, version = self.read_line().split()
+            return int(size), int(mtime), version
+
+    def get_slice_if(self, filename, version, start, length):
+        """
+        Obtiene un trozo de un archivo sólo si sigue en la versión dada.
+        Devuelve el trozo, o None en caso de error; si el archivo cambió,
+        el status queda en VERSION_CHANGED.
+        """
+        self.send('get_slice_if %s %s %d %d' % (filename, version, start,
+                                                length))
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            return None
+        return self.read_fragment(length)
+
     def get_slice(self, filename, start, length):
         """
         Obtiene un trozo de un archivo en el server.
@@ -181,25 +296,939 @@ class Client(object):
             logging.warning("El servidor indico un error al leer de %s."
                             % filename)
 
+    def get_metadata_batch(self, filenames):
+        """
+        Obtiene en un solo pedido el tamaño de varios archivos.
+        Devuelve una lista con el tamaño de cada archivo, en el mismo orden,
+        con None para los que no se pudieron consultar; o None si falló el
+        pedido entero.
+        """
+        self.send('get_metadata_batch %s' % ' '.join(filenames))
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("Falló la consulta de metadata en lote "
+                            "(code=%s %s)." % (self.status, message))
+            return None
+
+        sizes = []
+        for _ in filenames:
+            fields = self.read_line().split()
+            if fields and int(fields[0]) == CODE_OK:
+                sizes.append(int(fields[1]))
+            else:
+                sizes.append(None)
+        self.read_line()  # Línea vacía que termina la lista
+        return sizes
+
+    def get_slices(self, filename, ranges):
+        """
+        Obtiene en un solo pedido varios trozos de un archivo, dados como
+        una lista de pares (comienzo, longitud).
+
+        Devuelve la lista de trozos, o None si el servidor indicó un error.
+        Si la respuesta llega incompleta (p.ej. se cortó la conexión) genera
+        ConnectionError, para que se pueda reintentar.
+        """
+        self.send('get_slices %s %s' % (filename, ' '.join(
+            '%d %d' % (start, length) for start, length in ranges)))
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("El servidor indico un error al leer de %s."
+                            % filename)
+            return None
+
+        fragments = []
+        for _, length in ranges:
+            fragment = b64decode(self.read_line())
+            if not self.connected or len(fragment) != length:
+                raise ConnectionError("Trozo incompleto de %s" % filename)
+            fragments.append(fragment)
+        self.read_line()  # Línea vacía que termina la lista
+        if not self.connected:
+            raise ConnectionError("Respuesta incompleta para %s" % filename)
+        return fragments
+
+    def subscribe(self):
+        """
+        Se suscribe a los cambios de los archivos del server, que se leen
+        con events(). Mientras dure la suscripción, la conexión no atiende
+        otros pedidos. Devuelve False si falló.
+        """
+        self.send('subscribe')
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("Falló la suscripción (code=%s %s)."
+                            % (self.status, message))
+        return self.status == CODE_OK
+
+    def events(self, timeout=None):
+        """
+        Genera un par (evento, archivo) por cada cambio, con evento 'add',
+        'remove' o 'modify'; o ('overflow', None) si se perdieron eventos y
+        conviene volver a pedir el listado. Si se da un timeout, genera None
+        cada vez que pasa ese tiempo sin cambios. Termina si se cierra la
+        conexión. Las respuestas de error que lleguen en el medio (p.ej. a
+        un pedido que no se puede hacer suscripto) no son eventos: dejan su
+        código en status, y si el error es fatal terminan los eventos.
+
+        Al cerrar el generador (p.ej. con un break) se desuscribe.
+        """
+        try:
+            while True:
+                try:
+                    line = self.read_line(timeout)
+                except socket.timeout:
+                    yield None
+                    continue
+                if not line:
+                    return
+                event, _, filename = line.partition(' ')
+                if event.isdigit():
+                    self.status = int(event)
+                    logging.warning("Error durante la suscripción (code=%s "
+                                    "%s)." % (event, filename))
+                    if fatal_status(self.status):
+                        return
+                    continue
+                yield event, filename or None
+        finally:
+            if self.connected:
+                self.unsubscribe()
+
+    def unsubscribe(self):
+        """
+        Termina la suscripción, descartando los eventos que falten leer.
+        """
+        self.send('unsubscribe')
+        while self.read_line():
+            pass
+        self.status, message = self.read_response_line()
+
+    def fetch(self, filename):
+        """
+        Obtiene el contenido completo de un archivo en un solo pedido.
+        Devuelve None si el servidor indicó un error, y genera
+        ConnectionError si la respuesta llega incompleta.
+        """
+        self.send('get_file %s' % filename)
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            return None
+
+        line = self.read_line()
+        data = b64decode(self.read_line())
+        if not self.connected or not line.isdigit() or \
+                len(data) != int(line):
+            raise ConnectionError("Respuesta incompleta para %s" % filename)
+        return data
+
     def retrieve(self, filename):
         """
         Obtiene un archivo completo desde el servidor.
+
+        Con caché, lo guarda en su directorio y devuelve False sin
+        transferir nada si ya tiene esa versión del archivo; si no, True.
         """
-        size = self.get_metadata(filename)
-        if self.status == CODE_OK:
-            assert size >= 0
-            self.get_slice(filename, 0, size)
-        elif self.status == FILE_NOT_FOUND:
+        if self.cache is not None:
+            return self.retrieve_cached(filename)
+
+        data = self.fetch(filename)
+        if self.status in (RESPONSE_TOO_LARGE, INVALID_COMMAND):
+            # Demasiado grande para get_file, o un servidor sin get_file:
+            # se baja de a pedazos
+            self.retrieve_in_slices(filename)
+        elif self.status == CODE_OK:
+            with open(filename, 'wb') as output:
+                output.write(data)
+        if self.status == FILE_NOT_FOUND:
             logging.info("El archivo solicitado no existe.")
-        else:
+        elif self.status != CODE_OK:
             logging.warning("No se pudo obtener el archivo %s (code=%s)."
                             % (filename, self.status))
+        return self.status == CODE_OK
+
+    def retrieve_in_slices(self, filename):
+        """
+        Baja un archivo de a MIRROR_CHUNK bytes y lo guarda en el directorio
+        actual. Sólo usa get_metadata y get_slice, que entiende cualquier
+        servidor HFTP. Si falla, el status queda con el error.
+        """
+        size = self.get_metadata(filename)
+        if size is None:
+            return
+        with open(filename, 'wb') as output:
+            for start in range(0, size, MIRROR_CHUNK):
+                length = min(MIRROR_CHUNK, size - start)
+                self.send('get_slice %s %d %d' % (filename, start, length))
+                self.status, message = self.read_response_line()
+                if self.status != CODE_OK:
+                    return
+                output.write(self.read_fragment(length))
+
+    def retrieve_cached(self, filename):
+        for _ in range(VERSION_RETRIES):
+            metadata = self.get_metadata_ext(filename)
+            if metadata is None:
+                logging.warning("No se pudo obtener el archivo %s (code=%s)."
+                                % (filename, self.status))
+                return False
+            size, _, version = metadata
+            if self.cache.has(filename, version, size):
+                logging.info("%s ya está en la caché." % filename)
+                return False
+
+            path = self.cache.path(filename)
+            with open(path + '.part', 'wb') as output:
+                for start in range(0, size, MIRROR_CHUNK):
+                    fragment = self.get_slice_if(
+                        filename, version, start,
+                        min(MIRROR_CHUNK, size - start))
+                    if fragment is None:
+                        break
+                    output.write(fragment)
+            if self.status == CODE_OK:
+                os.replace(path + '.part', path)
+                self.cache.store(filename, version)
+                return True
+            os.remove(path + '.part')
+            if self.status != VERSION_CHANGED:
+                logging.warning("No se pudo obtener el archivo %s (code=%s)."
+                                % (filename, self.status))
+                return False
+            logging.info("%s cambió durante la descarga, reintentando."
+                         % filename)
+        return False
+
+
+class DownloadCache(object):
+    """
+    Directorio de archivos bajados, con un índice en disco de la versión
+    de cada uno para no volver a bajarlos si no cambiaron en el server.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        try:
+            with open(os.path.join(directory, CACHE_INDEX)) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def has(self, filename, version, size):
+        """
+        Si está la versión dada del archivo. Se verifica también el tamaño
+        de la copia local, por si alguien la borró o la tocó.
+        """
+        with self.lock:
+            if self.index.get(filename) != version:
+                return False
+        try:
+            return os.stat(self.path(filename)).st_size == size
+        except OSError:
+            return False
+
+    def store(self, filename, version):
+        """Registra que se bajó esa versión del archivo."""
+        with self.lock:
+            self.index[filename] = version
+            # Escribir aparte y reemplazar, para que un corte no deje el
+            # índice a medias
+            index = os.path.join(self.directory, CACHE_INDEX)
+            with open(index + '.tmp', 'w') as f:
+                json.dump(self.index, f)
+            os.replace(index + '.tmp', index)
+
+
+class ConnectionPool(object):
+    """
+    Pool de conexiones a uno o más servidores HFTP, para reutilizar
+    conexiones ya establecidas en lugar de abrir una por pedido. Se puede
+    usar desde varios hilos a la vez.
+
+    Mantiene hasta `max_size' conexiones por (server, port), contando las
+    prestadas y las ociosas; al llegar al límite, acquire() espera a que se
+    devuelva alguna.
+    """
+
+    def __init__(self, max_size=DEFAULT_POOL_SIZE,
+                 max_idle=DEFAULT_POOL_IDLE, connect=Client):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.connect = connect
+        self.lock = threading.Condition()
+        # (server, port) -> deque de (cliente, momento en que se devolvió)
+        self.idle = collections.defaultdict(collections.deque)
+        # (server, port) -> conexiones abiertas, prestadas u ociosas
+        self.open = collections.defaultdict(int)
+        # cliente prestado -> (server, port)
+        self.lent = {}
+        self.closed = False
+
+    def acquire(self, server=DEFAULT_ADDR, port=DEFAULT_PORT, timeout=None):
+        """
+        Presta una conexión al servidor, reutilizando una ociosa si hay
+        alguna sana o abriendo una nueva. Debe devolverse con release().
+
+        Si se da un timeout y no hay conexiones disponibles en ese tiempo,
+        genera una excepción socket.timeout.
+        """
+        key = (server, port)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise RuntimeError("El pool está cerrado")
+
+                idle = self.idle[key]
+                while idle:
+                    # La usada más recientemente es la que más
+                    # probablemente siga viva
+                    client, since = idle.pop()
+                    if time.monotonic() - since <= self.max_idle and \
+                            client.is_alive():
+                        self.lent[client] = key
+                        return client
+                    self.discard(key, client)
+
+                if self.open[key] < self.max_size:
+                    self.open[key] += 1
+                    break
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout("No hay conexiones libres")
+                self.lock.wait(remaining)
+
+        # Conectar sin tener tomado el lock
+        try:
+            client = self.connect(server, port)
+        except BaseException:
+            with self.lock:
+                self.open[key] -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.lent[client] = key
+        return client
+
+    def release(self, client, broken=False):
+        """
+        Devuelve una conexión prestada. Si está rota (o se indica `broken',
+        p.ej. porque falló a mitad de una respuesta) se cierra en lugar de
+        guardarse.
+        """
+        with self.lock:
+            key = self.lent.pop(client)
+            if broken or self.closed or not client.connected or \
+                    client.buffer:
+                self.discard(key, client)
+            else:
+                self.idle[key].append((client, time.monotonic()))
+            self.lock.notify()
+
+    def discard(self, key, client):
+        """Cierra una conexión y la descuenta. Requiere tener el lock."""
+        self.open[key] -= 1
+        client.abort()
+
+    @contextlib.contextmanager
+    def connection(self, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+        """
+        Presta una conexión durante un bloque with. Si el bloque termina con
+        una excepción, la conexión se descarta.
+        """
+        client = self.acquire(server, port)
+        try:
+            yield client
+        except BaseException:
+            self.release(client, broken=True)
+            raise
+        self.release(client)
+
+    def request(self, server, port, fn):
+        """
+        Ejecuta fn(cliente) con una conexión del pool y devuelve su
+        resultado. Si una conexión reutilizada resulta estar cerrada (p.ej.
+        el server la cerró por ociosa justo antes del pedido), reintenta una
+        vez con una conexión nueva; los pedidos HFTP se pueden repetir.
+        """
+        client = self.acquire(server, port)
+        # Un cliente nuevo no tiene status hasta recibir su primera respuesta
+        reused = client.status is not None
+        try:
+            result = fn(client)
+        except (socket.error, ValueError):
+            self.release(client, broken=True)
+            if not reused:
+                raise
+            return self.retry(server, port, fn)
+        if reused and not client.connected and client.status is None:
+            self.release(client, broken=True)
+            return self.retry(server, port, fn)
+        self.release(client)
+        return result
+
+    def retry(self, server, port, fn):
+        # Si el server cerró una conexión ociosa probablemente cerró todas
+        # (p.ej. al reiniciarse), así que se descartan las demás también
+        key = (server, port)
+        with self.lock:
+            idle = self.idle[key]
+            while idle:
+                client, _ = idle.pop()
+                self.discard(key, client)
+        with self.connection(server, port) as client:
+            return fn(client)
+
+    def close(self):
+        """Cierra todas las conexiones ociosas; las prestadas, al volver."""
+        with self.lock:
+            self.closed = True
+            for key, idle in self.idle.items():
+                while idle:
+                    client, _ = idle.pop()
+                    self.open[key] -= 1
+                    try:
+                        client.close()
+                    except socket.error:
+                        client.abort()
+            self.lock.notify_all()
+
+
+class MirrorStats(object):
+    """
+    Mediciones de uno de los servidores de un MirrorGroup.
+    """
+
+    def __init__(self, server, port):
+        self.server = server
+        self.port = port
+        self.srtt = None  # segundos
+        self.throughput = None  # bytes/s
+        # Los pedidos chicos y las transferencias por separado: un trozo de
+        # 1MB tarda mucho más que un get_metadata. Las transferencias se
+        # guardan por byte, porque no todas son del mismo tamaño
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.transfer_times = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        # Pedidos duplicados en otro mirror porque este tardaba, y cuántas
+        # veces ganó una copia duplicada en este
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.down_until = 0
+
+    def record(self, elapsed, nbytes):
+        self.requests += 1
+        if nbytes >= THROUGHPUT_MIN_BYTES:
+            self.transfer_times.append(elapsed / nbytes)
+        else:
+            self.latencies.append(elapsed)
+        if self.srtt is None:
+            self.srtt = elapsed
+        else:
+            self.srtt += SRTT_ALPHA * (elapsed - self.srtt)
+        if nbytes >= THROUGHPUT_MIN_BYTES:
+            sample = nbytes / max(elapsed, 1e-6)
+            if self.throughput is None:
+                self.throughput = sample
+            else:
+                self.throughput += THROUGHPUT_ALPHA * (sample -
+                                                       self.throughput)
+
+    def expected_time(self, nbytes):
+        """
+        Cuánto se espera que tarde un pedido de nbytes de respuesta, o None
+        si todavía no hay mediciones para estimarlo.
+        """
+        if self.srtt is None:
+            return None
+        expected = self.srtt
+        if nbytes >= THROUGHPUT_MIN_BYTES:
+            if self.throughput is None:
+                return None
+            expected += nbytes / self.throughput
+        # Los pedidos en curso compiten por el mismo enlace
+        return expected * (1 + self.in_flight)
+
+    def hedge_delay(self, nbytes):
+        """
+        p95 de lo que tardaron los pedidos recientes como uno de nbytes de
+        respuesta: si tarda más que eso, se duplica en otro mirror. None si
+        todavía no hay suficientes datos.
+        """
+        if nbytes >= THROUGHPUT_MIN_BYTES:
+            samples, scale = self.transfer_times, nbytes
+        else:
+            samples, scale = self.latencies, 1
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(samples)
+        return samples[int(len(samples) * 0.95)] * scale
+
+    def stats(self):
+        return {
+            'server': self.server,
+            'port': self.port,
+            'srtt_ms': None if self.srtt is None else
+            round(self.srtt * 1000, 3),
+            'mb_per_s': None if self.throughput is None else
+            round(self.throughput / 2**20, 3),
+            'requests': self.requests,
+            'failures': self.failures,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+        }
+
+
+class MirrorGroup(object):
+    """
+    Cliente para varios servidores HFTP que sirven los mismos archivos.
+
+    Cada pedido va al mirror que se espera que conteste antes, según su RTT
+    y throughput suavizados y los pedidos que ya tiene en curso. Si un
+    pedido tarda más que el p95 de su mirror, se manda un duplicado a otro
+    y se usa la primera respuesta que llegue. Si un mirror falla, el
+    pedido se reintenta en otro y el que falló se evita por un rato.
+    """
+
+    def __init__(self, mirrors, pool_size=DEFAULT_POOL_SIZE, hedge=True):
+        """
+        `mirrors' es una lista de pares (server, port).
+        """
+        self.mirrors = [MirrorStats(server, port) for server, port in mirrors]
+        self.hedge = hedge
+        self.pool = ConnectionPool(max_size=pool_size)
+        self.lock = threading.Lock()
+        # Corre los pedidos, para poder esperarlos con un plazo
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            pool_size * len(self.mirrors))
+
+    def choose(self, nbytes=0, exclude=()):
+        """
+        El mirror al que conviene mandar el próximo pedido, o None si no
+        queda ninguno fuera de `exclude'.
+        """
+        with self.lock:
+            now = time.monotonic()
+            candidates = [m for m in self.mirrors if m not in exclude]
+            up = [m for m in candidates if m.down_until <= now]
+            candidates = up or candidates
+            if not candidates:
+                return None
+            known = [m for m in candidates
+                     if m.expected_time(nbytes) is not None]
+            # Los que todavía no se midieron se prueban con un pedido a la
+            # vez, así uno lento no se lleva muchos antes de conocerlo
+            unknown = [m for m in candidates
+                       if m not in known and m.in_flight == 0]
+            if unknown:
+                return unknown[0]
+            if known:
+                return min(known, key=lambda m: m.expected_time(nbytes))
+            return min(candidates, key=lambda m: m.in_flight)
+
+    def hedge_delay(self, mirror, nbytes):
+        """
+        Cuánto esperar la respuesta de `mirror' antes de duplicar el pedido
+        en otro: el p95 de sus latencias, o si todavía no se lo conoce, el
+        doble de lo que tardaría el mejor de los otros.
+        """
+        delay = mirror.hedge_delay(nbytes)
+        if delay is not None:
+            return delay
+        with self.lock:
+            others = [m.expected_time(nbytes) for m in self.mirrors
+                      if m is not mirror]
+        others = [t for t in others if t is not None]
+        return 2 * min(others) if others else None
+
+    def run_on(self, mirror, fn, nbytes):
+        with self.lock:
+            mirror.in_flight += 1
+        start = time.monotonic()
+        try:
+            result = self.pool.request(mirror.server, mirror.port, fn)
+        except BaseException:
+            with self.lock:
+                mirror.in_flight -= 1
+                mirror.failures += 1
+                mirror.down_until = time.monotonic() + MIRROR_BACKOFF
+            raise
+        with self.lock:
+            mirror.in_flight -= 1
+            mirror.record(time.monotonic() - start, nbytes)
+        return result
+
+    def request(self, fn, nbytes=0):
+        """
+        Ejecuta fn(cliente) en el mirror más conveniente y devuelve su
+        resultado. `nbytes' es el tamaño esperado de la respuesta, para
+        elegir mirror según su throughput.
+        """
+        tried = []
+        error = None
+        while True:
+            primary = self.choose(nbytes, tried)
+            if primary is None:
+                raise error
+            tried.append(primary)
+            start = time.monotonic()
+            futures = {self.executor.submit(self.run_on, primary, fn,
+                                            nbytes): primary}
+            pending = set(futures)
+            hedged = not self.hedge
+            while pending:
+                timeout = None
+                if not hedged:
+                    # Se recalcula en cada vuelta: otro pedido puede haber
+                    # medido los mirrors mientras tanto
+                    delay = self.hedge_delay(primary, nbytes)
+                    timeout = HEDGE_CHECK_INTERVAL if delay is None else \
+                        max(0, start + delay - time.monotonic())
+                done, pending = concurrent.futures.wait(
+                    pending, timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except (socket.error, ValueError) as e:
+                        error = e
+                        continue
+                    if futures[future] is not primary:
+                        with self.lock:
+                            futures[future].hedge_wins += 1
+                    # El perdedor termina solo y devuelve su conexión
+                    return result
+
+                if not done and not hedged and delay is not None:
+                    hedged = True
+                    backup = self.choose(nbytes, tried)
+                    if backup is not None:
+                        tried.append(backup)
+                        with self.lock:
+                            primary.hedged += 1
+                        future = self.executor.submit(self.run_on, backup,
+                                                      fn, nbytes)
+                        futures[future] = backup
+                        pending.add(future)
+
+    def file_lookup(self):
+        return self.request(lambda c: c.file_lookup())
+
+    def get_metadata(self, filename):
+        return self.request(lambda c: c.get_metadata(filename))
+
+    def get_metadata_batch(self, filenames):
+        return self.request(lambda c: c.get_metadata_batch(filenames))
+
+    def get_slice(self, filename, start, length):
+        """
+        Devuelve el trozo pedido de un archivo, o None en caso de error.
+        """
+        if length == 0:
+            # get_slices no acepta rangos vacíos
+            return b''
+
+        def fetch(c):
+            fragments = c.get_slices(filename, [(start, length)])
+            if fragments is None:
+                return None
+            # Un mirror que se cae a mitad del trozo es una falla: se pasa
+            # a otro
+            if len(fragments[0]) != length:
+                raise ConnectionError("Trozo incompleto de %s" % filename)
+            return fragments[0]
+        return self.request(fetch, length)
+
+    def retrieve(self, filename, path=None, jobs=DEFAULT_JOBS):
+        """
+        Obtiene un archivo completo, pidiendo sus pedazos en paralelo a los
+        distintos mirrors. Lo guarda en `path', o en el directorio actual
+        con el mismo nombre. Devuelve False si no se pudo obtener, y genera
+        socket.error si fallaron todos los mirrors; en ambos casos no deja
+        el archivo a medias.
+        """
+        size = self.get_metadata(filename)
+        if size is None:
+            logging.warning("No se pudo obtener el archivo %s." % filename)
+            return False
+
+        path = filename if path is None else path
+        offsets = range(0, size, MIRROR_CHUNK)
+        complete = False
+        try:
+            with open(path, 'wb') as output, \
+                    concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                output.truncate(size)
+                chunks = executor.map(
+                    lambda start: (start, self.get_slice(
+                        filename, start, min(MIRROR_CHUNK, size - start))),
+                    offsets)
+                for start, fragment in chunks:
+                    if fragment is None:
+                        return False
+                    output.seek(start)
+                    output.write(fragment)
+            complete = True
+        finally:
+            if not complete:
+                # Lo que faltó quedaría en ceros
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return True
+
+    def stats(self):
+        with self.lock:
+            return [m.stats() for m in self.mirrors]
+
+    def close(self):
+        # Cortar los pedidos duplicados que perdieron y siguen en curso,
+        # para no esperar a que terminen
+        with self.pool.lock:
+            for c in self.pool.lent:
+                try:
+                    c.s.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        self.executor.shutdown(wait=False)
+        self.pool.close()
+
+
+class MirrorClient(MirrorGroup):
+    """
+    MirrorGroup con la interfaz de Client que usa la interfaz interactiva.
+    """
+
+    def __init__(self, mirrors):
+        MirrorGroup.__init__(self, mirrors)
+        self.status = None
+
+    def file_lookup(self):
+        try:
+            files = MirrorGroup.file_lookup(self)
+        except (socket.error, ValueError):
+            files = None
+        self.status = CODE_OK if files is not None else INTERNAL_ERROR
+        return files or []
+
+    def retrieve(self, filename):
+        try:
+            MirrorGroup.retrieve(self, filename)
+        except (socket.error, ValueError) as e:
+            logging.warning("Error obteniendo %s: %s" % (filename, e))
+
+
+class Mirror(object):
+    """
+    Copia a un directorio local todos los archivos de un servidor, o los
+    que coinciden con un patrón glob, con varias transferencias a la vez.
+    Saltea los archivos cuya copia local ya tiene el tamaño del remoto.
+    Si se dan varios mirrors del mismo contenido, reparte los pedidos
+    entre ellos con un MirrorGroup.
+    """
+
+    def __init__(self, mirrors, dest, pattern='*', jobs=DEFAULT_JOBS,
+                 progress=None):
+        """
+        `mirrors' es una lista de pares (server, port). Si se da un
+        `progress' (p.ej. sys.stderr), se muestra ahí el avance de la copia
+        mientras se hace.
+        """
+        self.dest = dest
+        self.pattern = pattern
+        self.jobs = jobs
+        self.progress = progress
+        self.group = MirrorGroup(mirrors, pool_size=jobs)
+
+        self.lock = threading.Lock()
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.skipped = 0
+        self.failed = []
+        self.start = None
+
+    def run(self):
+        """
+        Hace la copia y devuelve un resumen en un dict, listo para
+        serializar en JSON.
+        """
+        self.start = time.monotonic()
+        os.makedirs(self.dest, exist_ok=True)
+        try:
+            pending = self.plan()
+            with self.lock:
+                self.files_total = len(pending)
+                self.bytes_total = sum(size for _, size in pending)
+
+            stop = threading.Event()
+            reporter = None
+            if self.progress is not None:
+                reporter = threading.Thread(target=self.report_progress,
+                                            args=(stop,), daemon=True)
+                reporter.start()
+            try:
+                with concurrent.futures.ThreadPoolExecutor(
+                        self.jobs) as executor:
+                    for name, size in pending:
+                        executor.submit(self.download, name, size)
+            finally:
+                stop.set()
+                if reporter is not None:
+                    reporter.join()
+        finally:
+            self.group.close()
+
+        return self.summary()
+
+    def plan(self):
+        """Lista de (nombre, tamaño) de los archivos a bajar."""
+        names = self.group.file_lookup()
+        names = [n for n in names if fnmatch.fnmatchcase(n, self.pattern)]
+
+        # Nombres que el protocolo no permite pedir
+        invalid = [n for n in names if not set(n) <= VALID_CHARS]
+        self.failed.extend(invalid)
+        names = [n for n in names if set(n) <= VALID_CHARS]
+
+        pending = []
+        for i in range(0, len(names), METADATA_BATCH):
+            batch = names[i:i + METADATA_BATCH]
+            sizes = self.group.get_metadata_batch(batch)
+            if sizes is None:
+                self.failed.extend(batch)
+                continue
+            for name, size in zip(batch, sizes):
+                if size is None:
+                    # Se borró entre el listado y la consulta
+                    self.failed.append(name)
+                elif self.local_size(name) == size:
+                    self.skipped += 1
+                else:
+                    pending.append((name, size))
+        return pending
+
+    def local_size(self, name):
+        try:
+            return os.stat(os.path.join(self.dest, name)).st_size
+        except OSError:
+            return None
+
+    def download(self, name, size):
+        path = os.path.join(self.dest, name)
+        partial = path + '.part'
+        done = 0
+        try:
+            with open(partial, 'wb') as output:
+                while done < size or size == 0:
+                    length = min(MIRROR_CHUNK, size - done)
+                    fragment = self.group.get_slice(name, done, length)
+                    if fragment is None:
+                        raise IOError("El servidor indicó un error")
+                    if len(fragment) != length:
+                        raise IOError("Trozo incompleto: %d bytes de %d"
+                                      % (len(fragment), length))
+                    output.write(fragment)
+                    done += len(fragment)
+                    with self.lock:
+                        self.bytes_done += len(fragment)
+                    if size == 0:
+                        break
+            os.replace(partial, path)
+        except Exception as e:
+            logging.warning("No se pudo bajar %s: %s" % (name, e))
+            with self.lock:
+                self.failed.append(name)
+                self.bytes_done -= done
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            self.files_done += 1
+
+    def report_progress(self, stop):
+        while not stop.wait(PROGRESS_INTERVAL):
+            self.print_progress()
+        self.print_progress()
+        self.progress.write('\n')
+        self.progress.flush()
+
+    def print_progress(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start, 1e-9)
+            rate = self.bytes_done / elapsed
+            remaining = self.bytes_total - self.bytes_done
+            eta = '--:--'
+            if rate > 0:
+                eta = '%02d:%02d' % divmod(int(remaining / rate), 60)
+            line = ("%d/%d archivos  %.1f/%.1f MB  %.2f MB/s  %.1f "
+                    "archivos/s  ETA %s" % (
+                        self.files_done, self.files_total,
+                        self.bytes_done / 2**20, self.bytes_total / 2**20,
+                        rate / 2**20, self.files_done / elapsed, eta))
+        self.progress.write('\r' + line.ljust(79))
+        self.progress.flush()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        return {
+            'mirrors': self.group.stats(),
+            'dest': self.dest,
+            'pattern': self.pattern,
+            'files_transferred': self.files_done,
+            'files_skipped': self.skipped,
+            'files_failed': len(self.failed),
+            'failed': sorted(self.failed),
+            'bytes': self.bytes_done,
+            'seconds': round(elapsed, 3),
+            'mb_per_s': round(self.bytes_done / 2**20 / elapsed, 3),
+            'files_per_s': round(self.files_done / elapsed, 3),
+        }
+
+
+def parse_server(arg, port):
+    """
+    Devuelve el par (server, port) de un argumento de la línea de comandos:
+    host, host:puerto, [ipv6]:puerto o unix:/ruta. Si no dice puerto se
+    usa `port'.
+    """
+    if arg.startswith(UNIX_PREFIX):
+        return arg, port
+    if arg.startswith('['):
+        host, sep, rest = arg[1:].partition(']')
+        if not sep or (rest and not rest.startswith(':')):
+            raise ValueError("Server invalido: %s" % arg)
+        return host, int(rest[1:]) if rest else port
+    host, sep, rest = arg.partition(':')
+    if not sep:
+        return arg, port
+    if ':' in rest:
+        # IPv6 sin corchetes, no tiene puerto
+        return arg, port
+    if not rest.isdigit():
+        raise ValueError("Puerto invalido: %s" % arg)
+    return host, int(rest)
 
 
 def main():
     """
     Interfaz interactiva simple para el cliente: permite elegir un archivo
-    y bajarlo.
+    y bajarlo. Con --mirror, en cambio, copia sin preguntar todos los
+    archivos a un directorio y termina imprimiendo un resumen en JSON.
     """
     DEBUG_LEVELS = {'DEBUG': logging.DEBUG,
                     'INFO': logging.INFO,
@@ -208,13 +1237,33 @@ def main():
                     }
 
     # Parsear argumentos
-    parser = optparse.OptionParser(usage="%prog [options] server")
+    parser = optparse.OptionParser(
+        usage="%prog [options] server [server ...]\n\n"
+        "server puede ser un host, host:puerto, [ipv6]:puerto o unix:/ruta.\n"
+        "Con varios servers (mirrors del mismo contenido) se reparten los\n"
+        "pedidos entre ellos.")
     parser.add_option("-p", "--port",
                       help="Numero de puerto TCP donde escuchar", default=DEFAULT_PORT)
     parser.add_option("-v", "--verbose", dest="level", action="store",
                       help="Determina cuanta informacion de depuracion a mostrar"
                       "(valores posibles son: ERROR, WARN, INFO, DEBUG)",
                       default="ERROR")
+    parser.add_option("-m", "--mirror", metavar="DIR",
+                      help="Copiar todos los archivos del server a DIR, sin "
+                      "preguntar", default=None)
+    parser.add_option("-g", "--glob", metavar="PATRON",
+                      help="Con --mirror, copiar sólo los archivos cuyo "
+                      "nombre coincide con PATRON (ej. '*.txt')", default='*')
+    parser.add_option("-j", "--jobs", type="int",
+                      help="Con --mirror, cantidad de transferencias "
+                      "simultáneas", default=DEFAULT_JOBS)
+    parser.add_option("-c", "--cache", metavar="DIR",
+                      help="Guardar los archivos en DIR y no volver a bajar "
+                      "los que no cambiaron (sólo con un server)",
+                      default=None)
+    parser.add_option("-q", "--quiet", action="store_true",
+                      help="Con --mirror, no mostrar el progreso",
+                      default=False)
     options, args = parser.parse_args()
     try:
         port = int(options.port)
@@ -224,16 +1273,39 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    if len(args) != 1 or options.level not in list(DEBUG_LEVELS.keys()):
+    if not args or options.level not in list(DEBUG_LEVELS.keys()):
         parser.print_help()
         sys.exit(1)
+    try:
+        mirrors = [parse_server(arg, port) for arg in args]
+    except ValueError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
 
     # Setar verbosidad
     code_level = DEBUG_LEVELS.get(options.level)  # convertir el str en codigo
     logging.getLogger().setLevel(code_level)
 
+    if options.mirror is not None:
+        mirror = Mirror(mirrors, options.mirror, options.glob,
+                        options.jobs, None if options.quiet else sys.stderr)
+        try:
+            summary = mirror.run()
+        except(socket.error, socket.gaierror):
+            sys.stderr.write("Error al conectarse\n")
+            sys.exit(1)
+        print(json.dumps(summary, indent=2))
+        sys.exit(1 if summary['files_failed'] else 0)
+
     try:
-        client = Client(args[0], port)
+        if len(mirrors) == 1:
+            cache = None
+            if options.cache is not None:
+                os.makedirs(options.cache, exist_ok=True)
+                cache = DownloadCache(options.cache)
+            client = Client(*mirrors[0], cache=cache)
+        else:
+            client = MirrorClient(mirrors)
     except(socket.error, socket.gaierror):
         sys.stderr.write("Error al conectarse\n")
         sys.exit(1)
@@ -3,26 +3,94 @@
 # Copyright 2014 Carlos Bederián
 # $Id: connection.py 455 2011-05-01 00:32:09Z carlos $
 
+from accesslog import AccessLog, shorten
+from backpressure import OutputBudget
 from base64 import b64encode
 from constants import (EOL, bEOL, fatal_status, BAD_REQUEST, CODE_OK,
                        FILE_NOT_FOUND, INTERNAL_ERROR, BAD_OFFSET,
-                       BAD_EOL, INVALID_COMMAND, INVALID_ARGUMENTS)
+                       BAD_EOL, INVALID_COMMAND, INVALID_ARGUMENTS,
+                       VERSION_CHANGED, RESPONSE_TOO_LARGE)
 import re
 import socket as s
 import os
 import logging
-from typing import Callable, Dict, List, Tuple, Union
-
-BUFFER_SIZE = 1024
+import time
+from ratelimit import TokenBucket
+from readahead import AccessTracker
+from recorder import Recorder
+from typing import (Callable, ClassVar, Dict, List, Pattern, Sequence,
+                    Tuple, Union)
+from watcher import EVENT_BUFFER_LIMIT, OVERFLOW, Subscriptions
+
+BUFFER_SIZE = 65536
 FILENAME_CHARSET = r"a-zA-Z0-9-_."
+VERSION_CHARSET = r"0-9a-f-"
+# Max number of filenames or ranges in a single batch command
+MAX_BATCH = 1024
+# Max bytes of file data in a get_slices or get_file response: a handler
+# builds its whole response in memory, before any backpressure applies
+MAX_BATCH_BYTES = 16 * 2 ** 20
+# A rate limited connection waits until it can send at least this much
+THROTTLE_CHUNK = 16384
+# get_slice bodies larger than this are read from the file as they are
+# sent, this much at a time; a multiple of 3 so the base64 pieces join up
+STREAM_CHUNK = 3 * 2 ** 18
+# The only commands accepted while subscribed to changes
+SUBSCRIBED_COMMANDS = ("unsubscribe", "quit")
+# Pipelined requests served per read event, so one client can't hog the
+# loop; the server comes back for the rest in its next iteration
+PIPELINE_BATCH = 64
+
+COMMAND_PATTERN = re.compile(r"([a-z_]+)( |\r\n)")
 
 HandlerResult = Union[
     Tuple[int, str],
     Tuple[int, str, bytes],
     Tuple[int, str, List[bytes]],
+    Tuple[int, str, 'SliceStream'],
 ]
 
 
+def arg_patterns(charsets: List[str]) -> List[Pattern]:
+    """Patterns matching one argument each, with its leading space."""
+    return [re.compile(f" ([{charset}]+)") for charset in charsets]
+
+
+class SliceStream(object):
+    """
+    Cuerpo de una respuesta que se lee del archivo a medida que se envía,
+    de a STREAM_CHUNK bytes, en vez de armarse entero en memoria.
+    """
+
+    __slots__ = ('file', 'remaining', 'encoded_size')
+
+    def __init__(self, file, offset: int, size: int):
+        file.seek(offset)
+        self.file = file
+        self.remaining = size
+        # base64 of the data, and the EOL ending it
+        self.encoded_size = (size + 2) // 3 * 4 + len(bEOL)
+
+    def read(self) -> bytes:
+        """
+        Next piece of the encoded body, the last one with its EOL. Raises
+        EOFError if the file got shorter.
+        """
+        data = self.file.read(min(self.remaining, STREAM_CHUNK))
+        if not data:
+            raise EOFError(f"{self.file.name} got shorter while sent")
+        self.remaining -= len(data)
+        if self.remaining == 0:
+            return b64encode(data) + bEOL
+        if len(data) % 3:
+            # Short read: the next piece would be encoded out of step
+            raise EOFError(f"{self.file.name} got shorter while sent")
+        return b64encode(data)
+
+    def close(self):
+        self.file.close()
+
+
 class Connection(object):
     """
     Conexión punto a punto entre el servidor y un cliente.
@@ -30,70 +98,258 @@ class Connection(object):
     que termina la conexión.
     """
 
+    # A server may hold 100k+ mostly idle connections: no instance dict,
+    # and the buffers only exist while they have data
+    __slots__ = ('socket', 'dir', 'access_log', 'listener', 'subscriptions',
+                 'recv_buffer', 'lines_ready', 'send_buffer', 'send_offset',
+                 'quit', 'peer', 'access', 'buckets', 'throttled_until',
+                 'subscribed', 'events_lost', 'budget', 'output_paused',
+                 'recorder', 'stream')
+
     socket: s.socket
     dir: str
-    commands: Dict[str, Tuple[List[str], Callable[[List[str]], HandlerResult]]]
-
-    # accumulator of recv()'ed data
-    data_acc: str
-
+    # command name -> (patterns of the fixed arguments,
+    #                  patterns of a group that may repeat 1 or more times,
+    #                  handler), shared by all the connections
+    commands: ClassVar[Dict[str, Tuple[
+        List[Pattern], Union[List[Pattern], None],
+        Callable[['Connection', List[str]], HandlerResult]]]]
+
+    # recv()'ed data not processed yet, None when there is none
+    recv_buffer: Union[bytearray, None]
+    # recv_buffer may hold a complete line: look there before recv()'ing
+    lines_ready: bool
+
+    # output not sent yet is send_buffer[send_offset:]; b'' when there is
+    # none, which is a shared object
     send_buffer: bytes
+    send_offset: int
+    # rest of a large get_slice body, read into send_buffer as it empties
+    stream: Union[SliceStream, None]
 
     quit: bool
 
-    def __init__(self, socket: s.socket, directory: str):
+    # "ip:port" of the client, kept since getpeername() fails once closed
+    peer: str
+    # name of the listener the connection was accepted on
+    listener: str
+    access_log: Union[AccessLog, None]
+
+    # sequential access detection for get_slice, once a file is read
+    access: Union[AccessTracker, None]
+
+    # rate limits that apply to this connection, see ratelimit.py
+    buckets: Sequence[TokenBucket]
+    # when throttled, time.monotonic() at which sending can resume
+    throttled_until: Union[float, None]
+
+    # change notifications, see watcher.py
+    subscriptions: Union[Subscriptions, None]
+    subscribed: bool
+    # events were dropped because the client wasn't reading them
+    events_lost: bool
+
+    # backpressure, see backpressure.py: accounts the output of all the
+    # connections, and bounds it with the water marks it holds
+    budget: Union[OutputBudget, None]
+    # the output went over the high water mark and hasn't drained below
+    # the low one yet
+    output_paused: bool
+
+    # traffic recording for replay.py, see recorder.py
+    recorder: Union[Recorder, None]
+
+    def __init__(self, socket: s.socket, directory: str,
+                 access_log: AccessLog = None, listener: str = '',
+                 subscriptions: Subscriptions = None,
+                 budget: OutputBudget = None, recorder: Recorder = None):
         self.socket = socket
         self.dir = directory
-        self.commands = {
-            "get_file_listing": ([], self.get_file_listing_handler),
-            "get_metadata": ([FILENAME_CHARSET], self.get_metadata_handler),
-            "get_slice": ([FILENAME_CHARSET, r"\d", r"\d"],
-                          self.get_slice_handler),
-            "quit": ([], self.quit_handler),
-        }
-        self.data_acc = ''
+        self.access_log = access_log
+        self.listener = listener
+        self.subscriptions = subscriptions
+        self.recv_buffer = None
+        self.lines_ready = False
         self.quit = False
+        self.access = None
+        self.buckets = ()
+        self.throttled_until = None
+        self.subscribed = False
+        self.events_lost = False
+        self.budget = budget
+        self.output_paused = False
+        self.recorder = recorder
 
         self.send_buffer = b''
+        self.send_offset = 0
+        self.stream = None
 
-        peername = format_ip(self.socket.getpeername())
-        print(f"Established connection with {peername}")
+        self.peer = format_ip(self.socket.getpeername())
+        if self.access_log is not None:
+            self.access_log.record(self.peer, 'connect',
+                                   listener=self.listener)
+        if self.recorder is not None:
+            self.recorder.connect(self)
 
     def close(self):
-        peername = format_ip(self.socket.getpeername())
+        if self.subscribed:
+            self.subscriptions.unsubscribe(self)
+            self.subscribed = False
+        if self.budget is not None:
+            self.budget.release(self.pending_output())
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
         self.socket.close()
-        print(f"Closed connection with {peername}")
+        if self.access_log is not None:
+            self.access_log.record(self.peer, 'close',
+                                   listener=self.listener)
+        if self.recorder is not None:
+            self.recorder.close_connection(self)
 
     def send(self, msg: bytes = None):
         if msg is not None:
-            self.send_buffer += msg
+            self.queue(msg)
+
+        if self.buckets:
+            self.send_limited()
+            return
 
         while self.send_buffer:
             try:
-                bytes_sent = self.socket.send(self.send_buffer)
-                self.send_buffer = self.send_buffer[bytes_sent:]
+                if self.send_offset:
+                    bytes_sent = self.socket.send(
+                        memoryview(self.send_buffer)[self.send_offset:])
+                else:
+                    bytes_sent = self.socket.send(self.send_buffer)
+            except BlockingIOError:
+                break
+            self.sent(bytes_sent)
+
+    def queue(self, msg: bytes):
+        if self.budget is not None:
+            self.budget.add(len(msg))
+        if not self.send_buffer:
+            # The usual case: a whole response, queued without copying
+            self.send_buffer = msg
+        else:
+            self.send_buffer = self.send_buffer[self.send_offset:] + msg
+            self.send_offset = 0
+
+    def sent(self, n: int):
+        """Drops n bytes already sent from the front of the output."""
+        if self.budget is not None:
+            self.budget.release(n)
+        self.send_offset += n
+        if self.send_offset == len(self.send_buffer):
+            self.send_buffer = b''
+            self.send_offset = 0
+            if self.stream is not None:
+                self.refill()
+
+    def refill(self):
+        """Queues the next piece of the body being streamed."""
+        try:
+            piece = self.stream.read()
+        except (OSError, EOFError) as e:
+            # The client sees the response cut short
+            logging.warning(f"Aborting response to {self.peer}: {e}")
+            piece = b''
+            self.quit = True
+        if not piece or self.stream.remaining == 0:
+            self.stream.close()
+            self.stream = None
+        if piece:
+            self.queue(piece)
+
+    def pending_output(self) -> int:
+        return len(self.send_buffer) - self.send_offset
+
+    def reading_paused(self) -> bool:
+        """
+        Whether to stop reading and serving requests until the client
+        reads more of its responses, see backpressure.py.
+        """
+        if self.stream is not None:
+            # The next response goes after the whole body
+            return True
+        budget = self.budget
+        if budget is None:
+            return False
+        pending = self.pending_output()
+        if self.output_paused:
+            if pending <= budget.low_water:
+                self.output_paused = False
+        elif pending >= budget.high_water:
+            self.output_paused = True
+        return self.output_paused or (budget.exhausted and pending > 0)
+
+    def send_limited(self):
+        """
+        Like send(), but never writes more than the rate limits allow. If
+        they run out, sets throttled_until and stops.
+        """
+        if self.throttled_until is not None:
+            return
+
+        while self.send_offset < len(self.send_buffer):
+            now = time.monotonic()
+            allowed = min(b.available(now) for b in self.buckets)
+            # Don't trickle out tiny writes as the buckets refill
+            if allowed < min(self.pending_output(), THROTTLE_CHUNK):
+                self.throttle(now)
+                break
+
+            try:
+                bytes_sent = self.socket.send(memoryview(self.send_buffer)[
+                    self.send_offset:self.send_offset + allowed])
             except BlockingIOError:
                 break
+            for bucket in self.buckets:
+                bucket.consume(bytes_sent, now)
+            self.sent(bytes_sent)
+
+    def throttle(self, now: float):
+        wanted = min(self.pending_output(), THROTTLE_CHUNK)
+        wait = 0.0
+        for bucket in self.buckets:
+            bucket_wait = bucket.time_until(wanted, now)
+            if bucket_wait > 0:
+                bucket.throttles += 1
+                wait = max(wait, bucket_wait)
+        self.throttled_until = now + wait
 
     def send_message(
             self,
             code: int,
             desc: str,
-            body: Union[None, bytes, List[bytes]] = None
-    ):
+            body: Union[None, bytes, List[bytes], SliceStream] = None
+    ) -> int:
+        """
+        Frames and queues a response. Returns its length in bytes.
+        """
         msg = f'{code} {desc}'.encode('ascii')
         msg += bEOL
+        length = 0
 
         if type(body) is bytes:
             msg += body
             msg += bEOL
         elif type(body) is list:
-            msg += bEOL.join(body)
-            msg += bEOL
+            if body:
+                msg += bEOL.join(body)
+                msg += bEOL
+            # Empty line ending the list
             msg += bEOL
+        elif body is not None:
+            # Queued piece by piece once the rest is sent, see refill()
+            self.stream = body
+            length = body.encoded_size
 
         self.send(msg)
 
+        return len(msg) + length
+
     def recv_line(self) -> Union[str, None]:
         """
         Tries to read a line from the socket.
@@ -103,15 +359,17 @@ class Connection(object):
         and the connection should be closed.
         """
 
+        # A previous recv() may have left whole pipelined lines behind
+        if self.lines_ready:
+            line = self.pop_line()
+            if line is not None:
+                return line
+
         while True:
             try:
-                data = self.socket.recv(BUFFER_SIZE).decode('ascii')
+                data = self.socket.recv(BUFFER_SIZE)
             except BlockingIOError:
                 return ''
-            except UnicodeDecodeError:
-                self.send_message(
-                    BAD_REQUEST, "Message contains non-ascii characters")
-                return None
             except ConnectionResetError:
                 return None
 
@@ -119,28 +377,99 @@ class Connection(object):
             if len(data) == 0:
                 return None
 
-            # accumulate data
-            self.data_acc += data
-
-            # check if EOL in data
-            eol_index = self.data_acc.find(EOL)
-            if eol_index == -1:
-                # No EOL found, keep receiving
-                continue
-
-            next_line_index = eol_index + len(EOL)
-
-            line = self.data_acc[0:next_line_index]
-            # Strip line from accumulator
-            self.data_acc = self.data_acc[next_line_index:]
+            if not data.isascii():
+                self.send_message(
+                    BAD_REQUEST, "Message contains non-ascii characters")
+                return None
 
-            return line
+            buffer = self.recv_buffer
+            if buffer is None:
+                start = 0
+                buffer = self.recv_buffer = bytearray(data)
+            else:
+                # Only the new data needs to be searched, plus the last
+                # byte before it in case the EOL was split. Long lines
+                # arrive in many pieces, searching it all is quadratic
+                start = len(buffer) - 1
+                buffer += data
+            eol_index = buffer.find(bEOL, start)
+            if eol_index != -1:
+                return self.take_line(eol_index)
+
+    def pop_line(self) -> Union[str, None]:
+        """
+        Removes and returns the first complete line in the buffer,
+        or None if there isn't one yet.
+        """
+        eol_index = -1
+        if self.recv_buffer is not None:
+            eol_index = self.recv_buffer.find(bEOL)
+        if eol_index == -1:
+            self.lines_ready = False
+            return None
+        return self.take_line(eol_index)
+
+    def take_line(self, eol_index: int) -> str:
+        next_line_index = eol_index + len(bEOL)
+        buffer = self.recv_buffer
+        line = buffer[:next_line_index].decode('ascii')
+        if next_line_index == len(buffer):
+            self.recv_buffer = None
+            self.lines_ready = False
+        else:
+            # Cheap: bytearray drops a prefix by moving its start
+            del buffer[:next_line_index]
+            self.lines_ready = True
+        return line
 
     def quit_handler(self, _) -> HandlerResult:
-        print("Client requested to quit.")
+        if self.subscribed:
+            self.end_subscription()
         self.quit = True
         return CODE_OK, "OK"
 
+    def subscribe_handler(self, _) -> HandlerResult:
+        """
+        Answers OK and then pushes a line "EVENT FILENAME" for every file
+        added, removed or modified, with EVENT one of add, remove, modify;
+        or just "overflow" when events were lost and the client should list
+        the files again. unsubscribe or quit end the list of events with an
+        empty line, like any other list, before their own response.
+        """
+        if self.subscriptions is None:
+            return INVALID_COMMAND, "Subscriptions are not available"
+        try:
+            self.subscriptions.subscribe(self)
+        except OSError:
+            return INTERNAL_ERROR, "Can't watch the directory"
+        self.subscribed = True
+        self.events_lost = False
+        return CODE_OK, "OK"
+
+    def unsubscribe_handler(self, _) -> HandlerResult:
+        if not self.subscribed:
+            return INVALID_COMMAND, "Not subscribed"
+        self.end_subscription()
+        return CODE_OK, "OK"
+
+    def end_subscription(self):
+        self.subscriptions.unsubscribe(self)
+        self.subscribed = False
+        self.send(bEOL)
+
+    def push_events(self, lines: bytes):
+        """
+        Queues event lines for a subscribed client; the server sends them.
+        A client that doesn't keep up loses events and gets an overflow.
+        """
+        if self.pending_output() >= EVENT_BUFFER_LIMIT:
+            self.events_lost = True
+            return
+        if self.events_lost:
+            self.events_lost = False
+            lines = OVERFLOW.encode('ascii') + bEOL
+        self.queue(lines)
+
     def get_file_listing_handler(self, _) -> HandlerResult:
         # List filenames. Exceptions should be handled by top level handler
         filenames = os.listdir(self.dir)
@@ -155,9 +484,109 @@ class Connection(object):
     def get_metadata_handler(self, args) -> HandlerResult:
         filename = args[0]
 
+        result = self.stat_file(filename)
+        if result[0] != CODE_OK:
+            return result
+
+        return CODE_OK, "OK", str(result[2].st_size).encode('ascii')
+
+    def get_metadata_ext_handler(self, args) -> HandlerResult:
+        """
+        Answers "SIZE MTIME VERSION": the size, the modification time in
+        seconds since the epoch and the version token to pass to
+        get_slice_if.
+        """
+        filename = args[0]
+
+        result = self.stat_file(filename)
+        if result[0] != CODE_OK:
+            return result
+
+        stat = result[2]
+        return CODE_OK, "OK", (f"{stat.st_size} {int(stat.st_mtime)} "
+                               f"{version_token(stat)}").encode('ascii')
+
+    def get_metadata_batch_handler(self, filenames) -> HandlerResult:
+        """
+        Answers one line per filename, in order: "0 SIZE" if it exists or
+        just the error code otherwise.
+        """
+        lines = []
+        for filename in filenames:
+            result = self.stat_file(filename)
+            if result[0] == CODE_OK:
+                lines.append(f"{CODE_OK} {result[2].st_size}"
+                             .encode('ascii'))
+            else:
+                lines.append(str(result[0]).encode('ascii'))
+
+        return CODE_OK, "OK", lines
+
+    def get_slice_handler(self, args) -> HandlerResult:
+        filename = args[0]
+        offset = int(args[1])
+        size = int(args[2])
+
+        result = self.read_ranges(filename, [(offset, size)], stream=True)
+        if result[0] != CODE_OK:
+            return result
+
+        return CODE_OK, "OK", result[2][0]
+
+    def get_slice_if_handler(self, args) -> HandlerResult:
+        """
+        get_slice that fails with VERSION_CHANGED, without reading, if the
+        version token of the file is not the given one anymore.
+        """
+        filename, version = args[0], args[1]
+        offset = int(args[2])
+        size = int(args[3])
+
+        result = self.read_ranges(filename, [(offset, size)], version,
+                                  stream=True)
+        if result[0] != CODE_OK:
+            return result
+
+        return CODE_OK, "OK", result[2][0]
+
+    def get_slices_handler(self, args) -> HandlerResult:
+        """
+        Multi-range get_slice: FILENAME followed by OFFSET SIZE pairs.
+        Answers one base64 line per range, in order. Empty ranges are
+        rejected: their empty line would end the list.
+        """
+        filename = args[0]
+        ranges = [(int(args[i]), int(args[i + 1]))
+                  for i in range(1, len(args), 2)]
+        if any(size == 0 for _, size in ranges):
+            return INVALID_ARGUMENTS, "Empty range"
+
+        return self.read_ranges(filename, ranges, limit=MAX_BATCH_BYTES)[:3]
+
+    def get_file_handler(self, args) -> HandlerResult:
+        """
+        Whole small file in one round trip: its size in a line, followed by
+        its base64 encoded contents in another. Files over MAX_BATCH_BYTES
+        have to be fetched in slices.
+        """
+        filename = args[0]
+
+        result = self.read_ranges(filename, [(0, None)],
+                                  limit=MAX_BATCH_BYTES)
+        if result[0] != CODE_OK:
+            return result
+
+        data, size = result[2][0], result[3]
+        return CODE_OK, "OK", str(size).encode('ascii') + bEOL + data
+
+    def stat_file(self, filename) -> HandlerResult:
+        """
+        Returns (CODE_OK, "OK", os.stat_result) or the error for the given
+        filename.
+        """
         filepath = self.get_filepath(filename)
         try:
-            size = os.stat(filepath).st_size
+            stat = os.stat(filepath)
         except FileNotFoundError:
             return FILE_NOT_FOUND, "File not found"
         except OSError as e:
@@ -170,13 +599,18 @@ class Connection(object):
                 return FILE_NOT_FOUND, "Filename too long"
             raise e
 
-        return CODE_OK, "OK", str(size).encode('ascii')
-
-    def get_slice_handler(self, args) -> HandlerResult:
-        filename = args[0]
-        offset = int(args[1])
-        size = int(args[2])
+        return CODE_OK, "OK", stat
 
+    def read_ranges(self, filename, ranges, version=None, limit=None,
+                    stream=False) -> Tuple:
+        """
+        Reads the (offset, size) ranges of the file and returns
+        (CODE_OK, "OK", base64 encoded ranges, file size), or the error.
+        A size of None means up to the end of the file. If a version token
+        is given and the file doesn't match it, nothing is read; nor if the
+        ranges add up to more than `limit' bytes. With `stream', a single
+        range over STREAM_CHUNK is returned as a SliceStream instead.
+        """
         filepath = self.get_filepath(filename)
 
         try:
@@ -192,25 +626,81 @@ class Connection(object):
         try:
             stat = os.stat(file.fileno())
 
-            # return error if user asked for a slice that is outside the file
-            if size + offset > stat.st_size:
-                return BAD_OFFSET, "Invalid file slice"
-
-            file.seek(offset)
+            # Checked on the descriptor being read: if the file is replaced
+            # after the check we still read the version that was checked
+            if version is not None and version != version_token(stat):
+                return VERSION_CHANGED, "File version changed"
 
-            data = file.read(size)
-            # encode file to base64 before sending
-            data = b64encode(data)
-
-            return CODE_OK, "OK", data
+            # return error if user asked for a slice that is outside the file
+            for offset, size in ranges:
+                if size is not None and size + offset > stat.st_size:
+                    return BAD_OFFSET, "Invalid file slice"
+
+            if limit is not None and sum(
+                    stat.st_size - offset if size is None else size
+                    for offset, size in ranges) > limit:
+                return RESPONSE_TOO_LARGE, "Response too large, ask for " \
+                    "less data"
+
+            if self.access is None:
+                self.access = AccessTracker()
+            if stream and len(ranges) == 1 and ranges[0][1] is not None \
+                    and ranges[0][1] > STREAM_CHUNK:
+                offset, size = ranges[0]
+                self.access.on_read(filename, file.fileno(), offset, size,
+                                    stat.st_size)
+                body = SliceStream(file, offset, size)
+                # Closed by the stream once sent
+                file = None
+                return CODE_OK, "OK", [body], stat.st_size
+
+            encoded = []
+            for offset, size in ranges:
+                if size is None:
+                    size = stat.st_size - offset
+                self.access.on_read(filename, file.fileno(), offset, size,
+                                    stat.st_size)
+                file.seek(offset)
+                data = file.read(size)
+                # encode file to base64 before sending
+                encoded.append(b64encode(data))
+
+            return CODE_OK, "OK", encoded, stat.st_size
         finally:
-            file.close()
+            if file is not None:
+                file.close()
+
+    commands = {
+        "get_file_listing": ([], None, get_file_listing_handler),
+        "get_metadata": (arg_patterns([FILENAME_CHARSET]), None,
+                         get_metadata_handler),
+        "get_slice": (arg_patterns([FILENAME_CHARSET, r"\d", r"\d"]), None,
+                      get_slice_handler),
+        "quit": ([], None, quit_handler),
+        # Batch commands, to save round trips
+        "get_metadata_batch": ([], arg_patterns([FILENAME_CHARSET]),
+                               get_metadata_batch_handler),
+        "get_slices": (arg_patterns([FILENAME_CHARSET]),
+                       arg_patterns([r"\d", r"\d"]), get_slices_handler),
+        "get_file": (arg_patterns([FILENAME_CHARSET]), None,
+                     get_file_handler),
+        # Conditional fetch: slices only if the file is still the same
+        "get_metadata_ext": (arg_patterns([FILENAME_CHARSET]), None,
+                             get_metadata_ext_handler),
+        "get_slice_if": (arg_patterns([FILENAME_CHARSET, VERSION_CHARSET,
+                                       r"\d", r"\d"]), None,
+                         get_slice_if_handler),
+        # Change notifications
+        "subscribe": ([], None, subscribe_handler),
+        "unsubscribe": ([], None, unsubscribe_handler),
+    }
 
     def process_line(self, line: str) -> HandlerResult:
-        if '\n' in line[:-len(EOL)] is not None:
+        end = len(line) - len(EOL)
+        if line.find('\n', 0, end) != -1:
             return BAD_EOL, "Found \\n outside EOL"
 
-        cmd_name_match = re.match(r"([a-z_]+)( |\r\n)", line)
+        cmd_name_match = COMMAND_PATTERN.match(line)
         if cmd_name_match is None:
             return BAD_REQUEST, "Couldn't parse command name"
 
@@ -221,22 +711,41 @@ class Connection(object):
             return (INVALID_COMMAND,
                     f"Command '{cmd_name}' is not a valid command")
 
-        (args_charsets, handler) = cmd
+        if self.subscribed and cmd_name not in SUBSCRIBED_COMMANDS:
+            return (INVALID_COMMAND,
+                    "Only unsubscribe or quit while subscribed")
+
+        (patterns, repeated_patterns, handler) = cmd
 
+        # Arguments are matched in place: slicing off each one copies the
+        # rest of the line, and lines can be megabytes long
         args = []
-        line = line[len(cmd_name):]
-        for arg_charset in args_charsets:
-            arg_match = re.match(f"^ ([{arg_charset}]+)", line)
+        pos = len(cmd_name)
+        for pattern in patterns:
+            arg_match = pattern.match(line, pos)
             if arg_match is None:
                 return INVALID_ARGUMENTS, "Invalid or missing argument"
-            arg = arg_match.group(1)
-            args.append(arg)
-            line = line[1 + len(arg):]
-
-        if line != EOL:
+            args.append(arg_match.group(1))
+            pos = arg_match.end()
+
+        if repeated_patterns is not None:
+            groups = 0
+            while groups == 0 or pos != end:
+                if groups == MAX_BATCH:
+                    return INVALID_ARGUMENTS, "Too many arguments"
+                for pattern in repeated_patterns:
+                    arg_match = pattern.match(line, pos)
+                    if arg_match is None:
+                        return (INVALID_ARGUMENTS,
+                                "Invalid or missing argument")
+                    args.append(arg_match.group(1))
+                    pos = arg_match.end()
+                groups += 1
+
+        if pos != end:
             return INVALID_ARGUMENTS, "EOL not found after last argument"
 
-        return handler(args)
+        return handler(self, args)
 
     def on_read_available(self) -> bool:
         """
@@ -258,30 +767,73 @@ class Connection(object):
         Retorna True si la conexión debe cerrarse.
         """
         line = self.recv_line()
-        if line == '':
-            return False
-        if line is None:
-            return True
-
-        result = self.process_line(line)
-
-        code = result[0]
-        desc = result[1]
-        body = result[2] if len(result) == 3 else None
-
-        if fatal_status(code):
-            self.quit = True
-
-        self.send_message(code, desc, body)
-
-        return self.quit
+        served = 0
+        while True:
+            if line == '':
+                return False
+            if line is None:
+                return True
+
+            start = time.perf_counter()
+            result = self.process_line(line)
+
+            code = result[0]
+            desc = result[1]
+            body = result[2] if len(result) == 3 else None
+
+            if fatal_status(code):
+                self.quit = True
+
+            nbytes = self.send_message(code, desc, body)
+
+            if self.access_log is not None or self.recorder is not None:
+                duration = time.perf_counter() - start
+                if self.access_log is not None:
+                    self.log_command(line, code, nbytes, duration)
+                if self.recorder is not None:
+                    self.recorder.command(self, line, code, nbytes, start,
+                                          duration)
+
+            if self.quit:
+                return True
+
+            # poll() is level triggered: whatever is still in the kernel
+            # gets its own event, only the lines already read are pending
+            served += 1
+            if served == PIPELINE_BATCH or not self.lines_ready:
+                return False
+            # The rest stays buffered until the client catches up
+            if self.reading_paused():
+                return False
+            line = self.pop_line()
+            if line is None:
+                return False
+
+    def log_command(self, line: str, code: int, nbytes: int,
+                    duration: float):
+        command, _, args = line[:-len(EOL)].partition(' ')
+        self.access_log.record(self.peer, 'command', shorten(command),
+                               shorten(args), code, nbytes, duration,
+                               self.listener)
 
     # Helper functions
     def get_filepath(self, filename):
         return self.dir + "/" + filename
 
     def shoud_pollout(self) -> bool:
-        return len(self.send_buffer) > 0
+        return self.send_offset < len(self.send_buffer)
+
+    def is_idle(self) -> bool:
+        """No response pending and no request, or part of one, received."""
+        if self.send_buffer or self.recv_buffer is not None:
+            return False
+        try:
+            # Requests may be waiting in the kernel, not read yet
+            return not self.socket.recv(1, s.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return True
 
 
 def try_encode(s: str, encoding: str) -> Union[bytes, None]:
@@ -291,5 +843,19 @@ def try_encode(s: str, encoding: str) -> Union[bytes, None]:
         return None
 
 
-def format_ip(ip_port: Tuple[str, int]) -> str:
+def version_token(stat: os.stat_result) -> str:
+    """
+    Identifies a version of a file: replacing it (new inode) or writing to
+    it (new mtime or size) gives a different token.
+    """
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def format_ip(ip_port: Union[Tuple[str, int], str]) -> str:
+    # AF_UNIX peers are identified by a (usually empty) path instead
+    if not isinstance(ip_port, tuple):
+        return f"unix:{ip_port}" if ip_port else "unix"
+    if len(ip_port) == 4:
+        # AF_INET6 (host, port, flowinfo, scope_id)
+        return f"[{ip_port[0]}]:{ip_port[1]}"
     return f"{ip_port[0]}:{ip_port[1]}"
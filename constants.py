@@ -8,6 +8,8 @@
 DEFAULT_DIR = 'testdata'
 DEFAULT_ADDR = '0.0.0.0'  # 0.0.0.0 representa todas las IPv4 del server
 DEFAULT_PORT = 19500
+DEFAULT_BACKLOG = 1024  # El kernel lo recorta a net.core.somaxconn
+UNIX_PREFIX = 'unix:'  # Direcciones de sockets Unix: unix:/ruta/al/socket
 
 
 EOL = '\r\n'
@@ -22,6 +24,8 @@ INVALID_COMMAND = 200
 INVALID_ARGUMENTS = 201
 FILE_NOT_FOUND = 202
 BAD_OFFSET = 203
+VERSION_CHANGED = 204
+RESPONSE_TOO_LARGE = 205
 
 
 error_messages = {
@@ -35,6 +39,8 @@ error_messages = {
     INVALID_ARGUMENTS: "INVALID ARGUMENTS FOR COMMAND",
     FILE_NOT_FOUND: "FILE NOT FOUND",
     BAD_OFFSET: "OFFSET EXCEEDS FILE SIZE",
+    VERSION_CHANGED: "FILE VERSION CHANGED",
+    RESPONSE_TOO_LARGE: "RESPONSE TOO LARGE",
 }
 
 
@@ -0,0 +1,69 @@
+# encoding: utf-8
+"""
+Listening socket handoff for zero-downtime restarts.
+
+On reload the running server starts a new copy of itself and passes it
+its listening sockets, so connections keep queueing on the same kernel
+sockets during the whole restart. The new process reports through a
+pipe once it is polling them; only then the old one stops accepting and
+starts draining its connections.
+"""
+
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# listener name -> fd of its socket, as a JSON object
+LISTEN_FDS_ENV = 'HFTP_LISTEN_FDS'
+# write end of the pipe used to report readiness to the previous process
+READY_FD_ENV = 'HFTP_READY_FD'
+
+
+def inherited_listeners() -> Dict[str, int]:
+    """
+    Listening sockets passed by the previous server process, if any.
+    Removes them from the environment so they aren't passed on again.
+    """
+    value = os.environ.pop(LISTEN_FDS_ENV, None)
+    if value is None:
+        return {}
+    return json.loads(value)
+
+
+def notify_ready():
+    """Tells the previous server process that this one took over."""
+    value = os.environ.pop(READY_FD_ENV, None)
+    if value is None:
+        return
+    fd = int(value)
+    try:
+        os.write(fd, b'1')
+    finally:
+        os.close(fd)
+
+
+def spawn_successor(listeners: List) -> Tuple[subprocess.Popen, int]:
+    """
+    Starts a new server process with the same command line, handing it
+    the given listeners. Returns the process and the read end of its
+    readiness pipe: it becomes readable with one byte when the successor
+    is serving, or with EOF if it died before that.
+    """
+    fds = {lst.name: lst.socket.fileno() for lst in listeners}
+    ready_r, ready_w = os.pipe()
+
+    env = dict(os.environ)
+    env[LISTEN_FDS_ENV] = json.dumps(fds)
+    env[READY_FD_ENV] = str(ready_w)
+    try:
+        proc = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                                pass_fds=list(fds.values()) + [ready_w])
+    except OSError:
+        os.close(ready_r)
+        raise
+    finally:
+        os.close(ready_w)
+
+    return proc, ready_r
@@ -0,0 +1,124 @@
+# encoding: utf-8
+"""
+Listening sockets of the server.
+
+A listener is described by a string:
+
+    unix:/path/to/socket    AF_UNIX stream socket
+    [::]:19500              IPv6, dual-stack (also accepts IPv4 clients)
+    [::1]:19500             IPv6 loopback
+    0.0.0.0:19500           IPv4
+"""
+
+import os
+import socket
+import stat
+from constants import UNIX_PREFIX
+from typing import Tuple, Union
+
+
+def parse_listen_spec(spec: str) -> Tuple[int, Union[str, Tuple]]:
+    """
+    Returns the (family, address) pair for socket.bind().
+    Raises ValueError if the spec is malformed.
+    """
+    if spec.startswith(UNIX_PREFIX):
+        path = spec[len(UNIX_PREFIX):]
+        if not path:
+            raise ValueError(f"Missing path in '{spec}'")
+        return socket.AF_UNIX, path
+
+    host, sep, port = spec.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(f"Expected HOST:PORT or unix:PATH, got '{spec}'")
+
+    if host.startswith('[') and host.endswith(']'):
+        return socket.AF_INET6, (host[1:-1], int(port))
+    return socket.AF_INET, (host, int(port))
+
+
+class Listener(object):
+    """
+    Socket de escucha del servidor. Lleva la cuenta de las conexiones que
+    entraron por él, para las métricas.
+    """
+
+    name: str
+    family: int
+    address: Union[str, Tuple]
+    socket: Union[socket.socket, None]
+
+    # Connections accepted so far and currently open
+    accepted: int
+    active: int
+
+    def __init__(self, spec: str):
+        self.name = spec
+        self.family, self.address = parse_listen_spec(spec)
+        self.socket = None
+        self.accepted = 0
+        self.active = 0
+
+    def open(self, backlog: int) -> socket.socket:
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            if self.family == socket.AF_UNIX:
+                remove_stale_socket(self.address)
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.family == socket.AF_INET6:
+                # "::" should take IPv4 clients too, whatever the sysctl says
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+
+            sock.bind(self.address)
+            sock.listen(backlog)
+        except OSError:
+            sock.close()
+            raise
+
+        return self.adopt(sock)
+
+    def adopt(self, sock: socket.socket) -> socket.socket:
+        """
+        Uses an already listening socket, e.g. one inherited from the
+        previous server process on a reload.
+        """
+        # accept() must fail with EAGAIN instead of blocking the loop
+        sock.setblocking(False)
+        if self.family != socket.AF_UNIX:
+            # Resolve port 0 to the port actually assigned
+            self.address = (self.address[0], sock.getsockname()[1])
+        self.socket = sock
+        return sock
+
+    def close(self):
+        if self.socket is None:
+            return
+        self.detach()
+        if self.family == socket.AF_UNIX:
+            remove_stale_socket(self.address)
+
+    def detach(self):
+        """
+        Closes our descriptor without removing the Unix socket file, for
+        when another process keeps serving the same socket.
+        """
+        if self.socket is None:
+            return
+        self.socket.close()
+        self.socket = None
+
+    @property
+    def port(self) -> Union[int, None]:
+        if self.family == socket.AF_UNIX:
+            return None
+        return self.address[1]
+
+
+def remove_stale_socket(path: str):
+    # Only ever remove sockets, never a regular file given by mistake
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
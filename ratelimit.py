@@ -0,0 +1,155 @@
+# encoding: utf-8
+"""
+Bandwidth shaping with token buckets.
+
+Every connection is subject to the bucket of the first rule whose subnet
+contains its peer address (shared by all the peers in that subnet) and to
+the global bucket. Connection.send() never writes more than the tokens
+available in all of them; when they run out the server stops polling the
+connection for POLLOUT and wakes it up through the poll timeout once the
+buckets have refilled. Reads are never paused.
+"""
+
+import ipaddress
+import math
+import time
+from typing import List, Union
+
+# Burst allowed by default: this many seconds worth of the rate
+DEFAULT_BURST_SECONDS = 0.05
+# Smallest burst, so a slow bucket still allows reasonably sized send()s
+MIN_BURST = 16384
+# Time constant of the moving average reported as the current rate
+RATE_WINDOW = 1.0  # seconds
+
+UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+
+def parse_rate(s: str) -> int:
+    """Parses a rate in bytes per second, e.g. "512K" or "10M"."""
+    s = s.strip().upper()
+    unit = s[-1:] if s[-1:] in UNITS else ''
+    number = s[:len(s) - len(unit)]
+    rate = int(float(number) * UNITS[unit])
+    if rate <= 0:
+        raise ValueError(f"Rate must be positive, got '{s}'")
+    return rate
+
+
+class TokenBucket(object):
+    """
+    Balde de tokens: se llena a `rate' bytes por segundo hasta un máximo
+    de `burst' bytes.
+    """
+
+    name: str
+    rate: int
+    burst: int
+    tokens: float
+    last: float
+
+    # bytes taken from the bucket so far and times it ran out
+    sent: int
+    throttles: int
+    # exponentially weighted moving average of the rate, in bytes/s
+    current_rate: float
+    rate_updated: float
+
+    def __init__(self, name: str, rate: int, burst: int = None):
+        if burst is None:
+            burst = max(MIN_BURST, int(rate * DEFAULT_BURST_SECONDS))
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.sent = 0
+        self.throttles = 0
+        self.current_rate = 0.0
+        self.rate_updated = self.last
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self, now: float) -> int:
+        self.refill(now)
+        return int(self.tokens)
+
+    def consume(self, n: int, now: float):
+        self.tokens -= n
+        self.sent += n
+        decay = math.exp(-(now - self.rate_updated) / RATE_WINDOW)
+        self.current_rate = self.current_rate * decay + n / RATE_WINDOW
+        self.rate_updated = now
+
+    def time_until(self, n: int, now: float) -> float:
+        """Seconds until n tokens (capped to the burst) are available."""
+        self.refill(now)
+        missing = min(n, self.burst) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def stats(self, now: float) -> dict:
+        decay = math.exp(-(now - self.rate_updated) / RATE_WINDOW)
+        return {
+            'rate': self.rate,
+            'current_rate': round(self.current_rate * decay),
+            'sent': self.sent,
+            'throttles': self.throttles,
+        }
+
+
+class RateLimiter(object):
+    """
+    Límites de ancho de banda del servidor: uno por subred (compartido por
+    todos los clientes de la subred) y uno global.
+    """
+
+    rules: List[tuple]
+    global_bucket: Union[TokenBucket, None]
+
+    def __init__(self, rules: List[str] = (), global_rate: int = None):
+        """
+        rules are strings like "10.0.0.0/8=1M" or "192.168.1.7=512K".
+        Raises ValueError if one is malformed.
+        """
+        self.rules = []
+        for rule in rules:
+            subnet, sep, rate = rule.partition('=')
+            if not sep:
+                raise ValueError(f"Expected SUBNET=RATE, got '{rule}'")
+            network = ipaddress.ip_network(subnet.strip(), strict=False)
+            self.rules.append(
+                (network, TokenBucket(str(network), parse_rate(rate))))
+
+        self.global_bucket = None
+        if global_rate is not None:
+            self.global_bucket = TokenBucket('global', global_rate)
+
+    def buckets_for(self, host: str) -> List[TokenBucket]:
+        """Buckets that apply to a peer, given its address."""
+        buckets = []
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            # AF_UNIX peers only fall under the global limit
+            address = None
+        if address is not None:
+            if getattr(address, 'ipv4_mapped', None) is not None:
+                address = address.ipv4_mapped
+            for network, bucket in self.rules:
+                if address.version == network.version and \
+                        address in network:
+                    buckets.append(bucket)
+                    break
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+        return buckets
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        stats = {bucket.name: bucket.stats(now) for _, bucket in self.rules}
+        if self.global_bucket is not None:
+            stats['global'] = self.global_bucket.stats(now)
+        return stats
@@ -0,0 +1,118 @@
+# encoding: utf-8
+"""
+Access pattern tracking for get_slice.
+
+Clients usually walk a file with consecutive get_slice calls. The server
+opens the file again for every slice, so the kernel readahead never gets
+to see the pattern. AccessTracker remembers, per connection and per file,
+where the last slice ended; once a few slices in a row are consecutive it
+tells the kernel with posix_fadvise():
+
+- SEQUENTIAL on the descriptor being read, to widen the readahead window.
+- WILLNEED for the range the next slice is expected to ask for, so the
+  disk read overlaps with encoding and sending the current one.
+- DONTNEED for the ranges already served, so a long scan doesn't push
+  everything else out of the page cache.
+
+On platforms without posix_fadvise this is a no-op.
+"""
+
+import collections
+import os
+from typing import Callable, Dict, Union
+
+# Consecutive slices needed before a stream is considered sequential
+SEQUENTIAL_THRESHOLD = 2
+# How many slices (of the current size) to prefetch ahead
+READAHEAD_SLICES = 4
+# Files tracked per connection, least recently used ones are forgotten
+MAX_TRACKED_FILES = 16
+
+Advise = Callable[[int, int, int, int], None]
+
+if hasattr(os, 'posix_fadvise'):
+    default_advise: Union[Advise, None] = os.posix_fadvise
+else:
+    default_advise = None
+
+
+class FileStream(object):
+    """Estado del recorrido de un archivo por parte de un cliente."""
+
+    # end of the last slice served
+    next_offset: int
+    # number of consecutive slices so far
+    run: int
+    # everything before this offset was already advised with WILLNEED
+    prefetched_until: int
+    # everything before this offset was already dropped with DONTNEED
+    dropped_until: int
+
+    def __init__(self):
+        self.next_offset = -1
+        self.run = 0
+        self.prefetched_until = 0
+        self.dropped_until = 0
+
+
+class AccessTracker(object):
+    """
+    Detecta recorridos secuenciales de los archivos pedidos por una
+    conexión y le da las pistas correspondientes al kernel.
+    """
+
+    files: Dict[str, FileStream]
+    advise: Union[Advise, None]
+    drop_behind: bool
+
+    def __init__(self, advise: Advise = default_advise,
+                 drop_behind: bool = True):
+        self.files = collections.OrderedDict()
+        self.advise = advise
+        self.drop_behind = drop_behind
+
+    def on_read(self, filename: str, fd: int, offset: int, size: int,
+                file_size: int):
+        """
+        Must be called right before reading [offset, offset + size) from fd.
+        """
+        if self.advise is None or size == 0:
+            return
+
+        stream = self.files.pop(filename, None)
+        if stream is None:
+            stream = FileStream()
+            if len(self.files) >= MAX_TRACKED_FILES:
+                self.files.popitem(last=False)
+        # (re)insert as most recently used
+        self.files[filename] = stream
+
+        if offset == stream.next_offset:
+            stream.run += 1
+        else:
+            stream.run = 0
+            stream.prefetched_until = 0
+            stream.dropped_until = offset
+        stream.next_offset = offset + size
+
+        if stream.run < SEQUENTIAL_THRESHOLD:
+            return
+
+        try:
+            self.advise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            end = stream.next_offset
+            ahead = min(end + size * READAHEAD_SLICES, file_size)
+            start = max(end, stream.prefetched_until)
+            if ahead > start:
+                self.advise(fd, start, ahead - start, os.POSIX_FADV_WILLNEED)
+                stream.prefetched_until = ahead
+
+            if self.drop_behind and offset > stream.dropped_until:
+                self.advise(fd, stream.dropped_until,
+                            offset - stream.dropped_until,
+                            os.POSIX_FADV_DONTNEED)
+                stream.dropped_until = offset
+        except OSError:
+            # Hints only; e.g. pipes or filesystems that don't support them
+            pass
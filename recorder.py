@@ -0,0 +1,191 @@
+# encoding: utf-8
+"""
+Traffic recording, to replay production shaped load with replay.py.
+
+With --record FILE the server writes every connection and every request
+it serves to FILE: when it arrived, the request line, and the status,
+size and duration of the response. Response bodies are never recorded.
+
+The file is a sequence of chunks, each written with a single append: on
+a reload (kill -HUP) the old process keeps recording while it drains and
+the new one appends its own chunks to the same file. A chunk is a header
+naming its process followed by records, all little endian:
+
+    header   magic (8 bytes), wall clock start of the process (double,
+             seconds), pid (uint32)
+    record   kind (uint8), connection (uint32), time since the start of
+             the process (uint64, microseconds)
+    COMMAND  records follow with duration (uint32, microseconds), status
+             (uint16), response bytes (uint64), and the request line
+             without its EOL: its length (uint16) and its bytes
+
+Request lines longer than MAX_LINE are cut, and recorded as TRUNCATED so
+they aren't replayed. Records are buffered in memory and appended in
+chunks of WRITE_BUFFER bytes, so they don't stall the event loop; a
+command costs ~40 bytes plus its line.
+"""
+
+import os
+import struct
+import time
+from typing import Iterator, List, NamedTuple, Union
+
+MAGIC = b'HFTPREC\x01'
+HEADER = struct.Struct('<8sdI')
+RECORD = struct.Struct('<BIQ')
+COMMAND_FIELDS = struct.Struct('<IHQH')
+
+CONNECT = 1
+COMMAND = 2
+CLOSE = 3
+TRUNCATED = 4
+
+MAX_LINE = 4096
+WRITE_BUFFER = 2 ** 20
+
+
+class Event(NamedTuple):
+    kind: int
+    # (process start, pid, connection number within the process)
+    connection: tuple
+    # seconds since the start of the first process recorded
+    time: float
+    # the rest only for COMMAND and TRUNCATED
+    line: Union[str, None] = None
+    status: Union[int, None] = None
+    nbytes: Union[int, None] = None
+    duration: Union[float, None] = None
+
+
+class Recorder(object):
+    """
+    Graba las conexiones y los pedidos que atiende el servidor, sin el
+    contenido de las respuestas.
+    """
+
+    fd: int
+    # header of every chunk this process writes
+    header: bytes
+    start: float
+    # records not written yet
+    chunk: List[bytes]
+    chunk_size: int
+    # connection -> its number in the recording
+    ids: dict
+    next_id: int
+
+    def __init__(self, path: str):
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o644)
+        self.header = HEADER.pack(MAGIC, time.time(), os.getpid())
+        self.start = time.perf_counter()
+        self.chunk = []
+        self.chunk_size = 0
+        self.ids = {}
+        self.next_id = 0
+
+    def write(self, record: bytes):
+        self.chunk.append(record)
+        self.chunk_size += len(record)
+        if self.chunk_size >= WRITE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if not self.chunk:
+            return
+        data = self.header + b''.join(self.chunk)
+        self.chunk = []
+        self.chunk_size = 0
+        # Appends to regular files aren't split, so chunks of two
+        # processes never interleave
+        os.write(self.fd, data)
+
+    def micros(self, seconds: float) -> int:
+        return max(0, int(seconds * 1e6))
+
+    def connect(self, connection):
+        self.ids[connection] = conn_id = self.next_id
+        self.next_id += 1
+        self.write(RECORD.pack(
+            CONNECT, conn_id, self.micros(time.perf_counter() - self.start)))
+
+    def command(self, connection, line: str, status: int, nbytes: int,
+                start: float, duration: float):
+        """
+        `line' is the request line with its EOL; `start' is the
+        time.perf_counter() at which it began to be served.
+        """
+        conn_id = self.ids.get(connection)
+        if conn_id is None:
+            return
+        data = line.encode('ascii')[:-2]
+        kind = COMMAND
+        if len(data) > MAX_LINE:
+            data = data[:MAX_LINE]
+            kind = TRUNCATED
+        self.write(
+            RECORD.pack(kind, conn_id, self.micros(start - self.start)) +
+            COMMAND_FIELDS.pack(min(self.micros(duration), 2 ** 32 - 1),
+                                status, nbytes, len(data)) +
+            data)
+
+    def close_connection(self, connection):
+        conn_id = self.ids.pop(connection, None)
+        if conn_id is None:
+            return
+        self.write(RECORD.pack(
+            CLOSE, conn_id, self.micros(time.perf_counter() - self.start)))
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+def read_recording(path: str) -> Iterator[Event]:
+    """
+    Yields the events of a recording in order. Raises ValueError if the
+    file isn't one; a record cut short at the end (e.g. the server was
+    killed) is ignored.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    offset = 0
+    process = None
+    origin = base = None
+    while offset < len(data):
+        # Record kinds are small numbers, they can't be taken for MAGIC
+        if data.startswith(MAGIC, offset):
+            if offset + HEADER.size > len(data):
+                return
+            _, wall, pid = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            process = (wall, pid)
+            if origin is None:
+                origin = wall
+            base = wall - origin
+            continue
+        if process is None:
+            raise ValueError(f"{path} is not a recording")
+
+        if offset + RECORD.size > len(data):
+            return
+        kind, conn_id, micros = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        when = base + micros / 1e6
+        if kind in (CONNECT, CLOSE):
+            yield Event(kind, process + (conn_id,), when)
+        elif kind in (COMMAND, TRUNCATED):
+            if offset + COMMAND_FIELDS.size > len(data):
+                return
+            duration, status, nbytes, length = COMMAND_FIELDS.unpack_from(
+                data, offset)
+            offset += COMMAND_FIELDS.size
+            if offset + length > len(data):
+                return
+            line = data[offset:offset + length].decode('ascii')
+            offset += length
+            yield Event(kind, process + (conn_id,), when, line, status,
+                        nbytes, duration / 1e6)
+        else:
+            raise ValueError(f"Corrupt recording at byte {offset}")
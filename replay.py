@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Replays traffic recorded with server.py --record (see recorder.py)
+against any HFTP server, to test server changes with production shaped
+load instead of synthetic benchmarks.
+
+Every recorded connection is replayed on a connection of its own,
+opened, used and closed at its recorded times, scaled by --speed. The
+requests of a connection are sent one at a time: a pipelined burst is
+replayed as consecutive requests. Subscriptions are not replayed, nor are
+request lines that were too long to record whole.
+
+Prints a JSON report with the requests whose status differs from the
+recorded one, and the latency (as seen by the client) and throughput of
+the replay. Exits with status 1 if any status diverged.
+"""
+
+import collections
+import json
+import logging
+import optparse
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+
+import client
+from constants import CODE_OK, DEFAULT_ADDR, DEFAULT_PORT, fatal_status
+from recorder import CLOSE, COMMAND, CONNECT, TRUNCATED, read_recording
+from stats import percentile
+
+DEFAULT_JOBS = 256
+# Seconds to wait for a response before counting it as an error
+RESPONSE_TIMEOUT = 30
+
+# Responses with CODE_OK carry this many body lines...
+BODY_LINES = {
+    'get_metadata': 1,
+    'get_metadata_ext': 1,
+    'get_slice': 1,
+    'get_slice_if': 1,
+    'get_file': 2,
+}
+# ...or a line per argument (per range for get_slices) and an empty line;
+# fragments can't be told from the end of the list by their content
+LIST_LINES = {
+    'get_metadata_batch': lambda args: len(args),
+    'get_slices': lambda args: (len(args) - 1) // 2,
+}
+# ...or a list of unknown length ending with an empty line
+LISTING_COMMANDS = ('get_file_listing',)
+# Their output depends on the files changing while subscribed
+NOT_REPLAYED = ('subscribe', 'unsubscribe')
+
+
+class Session(object):
+    """Una conexión grabada: cuándo se abrió, sus pedidos, cuándo se cerró."""
+
+    opened: float
+    closed: Union[float, None]
+    # (time, request line, recorded status, recorded duration)
+    requests: List[Tuple[float, str, int, float]]
+    # requests that can't be replayed
+    skipped: int
+
+    def __init__(self, opened: float):
+        self.opened = opened
+        self.closed = None
+        self.requests = []
+        self.skipped = 0
+
+
+def load_sessions(path: str) -> List[Session]:
+    """Sessions of a recording, in the order they were opened."""
+    sessions = {}
+    for event in read_recording(path):
+        session = sessions.get(event.connection)
+        if session is None:
+            session = sessions[event.connection] = Session(event.time)
+        if event.kind == CLOSE:
+            session.closed = event.time
+        elif event.kind == TRUNCATED or (
+                event.kind == COMMAND and
+                event.line.partition(' ')[0] in NOT_REPLAYED):
+            session.skipped += 1
+        elif event.kind == COMMAND:
+            session.requests.append((event.time, event.line, event.status,
+                                     event.duration))
+        elif event.kind != CONNECT:
+            raise ValueError(f"Unknown event {event.kind}")
+    return sorted(sessions.values(), key=lambda s: s.opened)
+
+
+def read_response(c: client.Client, request: str) -> Tuple[int, int]:
+    """
+    Reads the whole response to a request line. Returns its status and
+    size in bytes, or raises socket.error / socket.timeout.
+    """
+    command, *args = request.split()
+    status, message = c.read_response_line(RESPONSE_TIMEOUT)
+    if status is None:
+        raise ConnectionError("Invalid or missing response")
+    nbytes = len(str(status)) + len(message) + 3
+    if status != CODE_OK:
+        return status, nbytes
+
+    if command in LISTING_COMMANDS:
+        line = None
+        while line != '':
+            line = c.read_line(RESPONSE_TIMEOUT)
+            if not c.connected:
+                raise ConnectionError("Connection closed mid-response")
+            nbytes += len(line) + 2
+    elif command in LIST_LINES:
+        for _ in range(LIST_LINES[command](args)):
+            nbytes += len(c.read_line(RESPONSE_TIMEOUT)) + 2
+        if c.read_line(RESPONSE_TIMEOUT) != '' and c.connected:
+            raise ConnectionError("Unexpected response length")
+        nbytes += 2
+    else:
+        for _ in range(BODY_LINES.get(command, 0)):
+            nbytes += len(c.read_line(RESPONSE_TIMEOUT)) + 2
+    if not c.connected:
+        raise ConnectionError("Connection closed mid-response")
+    return status, nbytes
+
+
+class Replay(object):
+    """
+    Reproduce las sesiones grabadas contra un servidor y junta las
+    estadísticas.
+    """
+
+    def __init__(self, sessions: List[Session], server: str, port: int,
+                 speed: float = 1.0, jobs: int = DEFAULT_JOBS):
+        self.sessions = sessions
+        self.server = server
+        self.port = port
+        # 0 replays as fast as possible
+        self.speed = speed
+        self.jobs = jobs
+        self.origin = sessions[0].opened if sessions else 0.0
+        # time.monotonic() at which the replay began
+        self.start = 0.0
+
+        self.lock = threading.Lock()
+        # command -> replayed latencies, recorded durations
+        self.latencies = collections.defaultdict(list)
+        self.recorded = collections.defaultdict(list)
+        # "command recorded->replayed" -> count
+        self.divergences = collections.Counter()
+        self.requests = 0
+        self.skipped = sum(s.skipped for s in sessions)
+        self.errors = 0
+        self.bytes = 0
+        # how late the replay started a session, at worst
+        self.max_lag = 0.0
+
+    def wait_until(self, recorded_time: float) -> float:
+        """
+        Sleeps until the replay time matching a recorded time. Returns how
+        late it already was, in seconds.
+        """
+        if self.speed <= 0:
+            return 0.0
+        target = self.start + (recorded_time - self.origin) / self.speed
+        delay = target - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return -delay
+
+    def run(self) -> dict:
+        # Closed connections make Client warn about every empty response
+        logging.getLogger().setLevel(logging.ERROR)
+        self.start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            # Sessions are queued in order, so with more of them open at a
+            # time than threads the later ones start late (see max_lag)
+            for _ in executor.map(self.replay_session, self.sessions):
+                pass
+        return self.report(time.monotonic() - self.start)
+
+    def replay_session(self, session: Session):
+        lag = self.wait_until(session.opened)
+        with self.lock:
+            self.max_lag = max(self.max_lag, lag)
+
+        try:
+            c = client.Client(self.server, self.port)
+        except socket.error:
+            with self.lock:
+                self.errors += len(session.requests)
+            return
+
+        try:
+            for i, (when, line, expected, duration) in enumerate(
+                    session.requests):
+                self.wait_until(when)
+                command = line.partition(' ')[0]
+                start = time.perf_counter()
+                try:
+                    c.send(line, RESPONSE_TIMEOUT)
+                    status, nbytes = read_response(c, line)
+                except (socket.error, ConnectionError):
+                    with self.lock:
+                        self.errors += len(session.requests) - i
+                    return
+                latency = time.perf_counter() - start
+
+                with self.lock:
+                    self.requests += 1
+                    self.bytes += nbytes
+                    self.latencies[command].append(latency)
+                    self.recorded[command].append(duration)
+                    if status != expected:
+                        self.divergences[
+                            f"{command} {expected}->{status}"] += 1
+                if fatal_status(status) or command == 'quit':
+                    return
+
+            if session.closed is not None:
+                self.wait_until(session.closed)
+        finally:
+            c.abort()
+
+    def report(self, elapsed: float) -> dict:
+        commands = {}
+        for command, samples in sorted(self.latencies.items()):
+            recorded = self.recorded[command]
+            commands[command] = {
+                'count': len(samples),
+                'p50_ms': percentile(samples, .5) * 1000,
+                'p95_ms': percentile(samples, .95) * 1000,
+                'p99_ms': percentile(samples, .99) * 1000,
+                # time the recorded server took to serve them, without
+                # the network: a floor for the latencies above
+                'recorded_p50_ms': percentile(recorded, .5) * 1000,
+                'recorded_p95_ms': percentile(recorded, .95) * 1000,
+            }
+        return {
+            'sessions': len(self.sessions),
+            'requests': self.requests,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'divergent': sum(self.divergences.values()),
+            'divergences': dict(self.divergences),
+            'elapsed': elapsed,
+            'requests_per_second': self.requests / elapsed if elapsed else 0,
+            'bytes_per_second': self.bytes / elapsed if elapsed else 0,
+            'max_lag': self.max_lag,
+            'commands': commands,
+        }
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="%prog [options] RECORDING [SERVER]")
+    parser.add_option(
+        "-p", "--port", type="int", default=DEFAULT_PORT,
+        help="Puerto del servidor, si SERVER no lo dice")
+    parser.add_option(
+        "-s", "--speed", type="float", default=1.0,
+        help="Velocidad de reproducción: 1 es tiempo real, 10 diez veces "
+             "más rápido, 0 tan rápido como se pueda")
+    parser.add_option(
+        "-j", "--jobs", type="int", default=DEFAULT_JOBS,
+        help="Máximo de conexiones simultáneas")
+    options, args = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.print_help()
+        sys.exit(2)
+
+    try:
+        server, port = client.parse_server(
+            args[1] if len(args) > 1 else DEFAULT_ADDR, options.port)
+        sessions = load_sessions(args[0])
+    except (OSError, ValueError) as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(2)
+
+    report = Replay(sessions, server, port, options.speed,
+                    options.jobs).run()
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    sys.exit(1 if report['divergent'] else 0)
+
+
+if __name__ == '__main__':
+    main()
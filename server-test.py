@@ -8,13 +8,37 @@
 import unittest
 import client
 import constants
+import accesslog
+import backpressure
+import readahead
+import recorder
+import replay
+import watcher
+import base64
+import collections
+import io
+import json
+import threading
 import select
+import signal
 import time
 import socket
+import struct
 import os
 import os.path
 import logging
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
+from connection import MAX_BATCH_BYTES, Connection
+from serverproc import rss, spawn_server
+
+try:
+    import resource
+except ImportError:  # No existe en Windows
+    resource = None
 
 DATADIR = 'testdata'
 TIMEOUT = 3  # Una cantidad razonable de segundos para esperar respuestas
@@ -252,6 +276,18 @@ class TestHFTPHard(TestBase):
         c.connected = False
         c.s.close()
 
+    def test_many_pipelined_commands(self):
+        # Más pedidos juntos de los que el server atiende por evento: los
+        # que quedan en su buffer se tienen que atender igual
+        open(os.path.join(DATADIR, 'bar'), 'w').close()
+        c = self.new_client()
+        c.s.sendall(b'get_metadata bar\r\n' * 300)
+        for _ in range(300):
+            self.assertEqual(c.read_response_line(TIMEOUT)[0],
+                             constants.CODE_OK)
+            self.assertEqual(c.read_line(TIMEOUT), '0')
+        c.close()
+
     def test_big_filename(self):
         c = self.new_client()
         c.send('get_metadata ' + 'x' * (5 * 2 ** 20), timeout=120)
@@ -293,11 +329,1274 @@ class TestHFTPHard(TestBase):
         c.close()
 
 
+class TestHFTPBatch(TestBase):
+
+    def test_get_metadata_batch(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x' * 10)
+        f.close()
+        open(os.path.join(DATADIR, 'foo'), 'w').close()
+        c = self.new_client()
+        sizes = c.get_metadata_batch(['bar', 'does_not_exist', 'foo'])
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(sizes, [10, None, 0])
+        c.close()
+
+    def test_get_slices(self):
+        test_data = 'a' * 100 + 'b' * 200 + 'c' * 300
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        fragments = c.get_slices('bar', [(0, 100), (550, 50), (100, 200)])
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(fragments, [b'a' * 100, b'c' * 50, b'b' * 200])
+        # Un rango vacío se confundiría con el fin de la lista
+        fragments = c.get_slices('bar', [(0, 100), (10, 0)])
+        self.assertEqual(c.status, constants.INVALID_ARGUMENTS)
+        self.assertIsNone(fragments)
+        # Un rango inválido invalida todo el pedido
+        fragments = c.get_slices('bar', [(0, 100), (550, 51)])
+        self.assertEqual(c.status, constants.BAD_OFFSET)
+        self.assertIsNone(fragments)
+        c.close()
+
+    def test_get_slices_without_ranges(self):
+        open(os.path.join(DATADIR, 'bar'), 'w').close()
+        c = self.new_client()
+        c.send('get_slices bar')
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.INVALID_ARGUMENTS)
+        c.send('get_slices bar 0')
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.INVALID_ARGUMENTS)
+        c.close()
+
+    def test_fetch(self):
+        test_data = 'x' * 100 + '\0' * 100 + 'y' * 100
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write(test_data)
+        f.close()
+        open(os.path.join(DATADIR, 'empty'), 'w').close()
+        c = self.new_client()
+        self.assertEqual(c.fetch('bar'), test_data.encode('ascii'))
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(c.fetch('empty'), b'')
+        self.assertEqual(c.fetch('does_not_exist'), None)
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        c.close()
+
+    def test_response_too_large(self):
+        # El servidor arma toda la respuesta en memoria: está acotada
+        size = MAX_BATCH_BYTES + 1
+        test_data = os.urandom(size)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        self.assertIsNone(c.fetch('bar'))
+        self.assertEqual(c.status, constants.RESPONSE_TOO_LARGE)
+        self.assertIsNone(c.get_slices('bar', [(0, size // 2),
+                                               (size // 2, size // 2 + 1)]))
+        self.assertEqual(c.status, constants.RESPONSE_TOO_LARGE)
+        self.assertEqual(c.get_slices('bar', [(0, 10)]), [test_data[:10]])
+
+        # retrieve lo baja de a pedazos
+        dest = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(dest)
+            self.assertTrue(c.retrieve('bar'))
+            f = open(os.path.join(dest, 'bar'), 'rb')
+            self.assertEqual(f.read(), test_data)
+            f.close()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(dest)
+        c.close()
+
+    def test_retrieve_without_extensions(self):
+        test_data = os.urandom(3 * client.MIRROR_CHUNK + 5)
+        server = BasicServer({'bar': test_data})
+        dest = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            c = client.Client(*server.address)
+            os.chdir(dest)
+            self.assertTrue(c.retrieve('bar'))
+            f = open(os.path.join(dest, 'bar'), 'rb')
+            self.assertEqual(f.read(), test_data)
+            f.close()
+            c.close()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(dest)
+            server.close()
+
+    def test_truncated_response(self):
+        mirror = DroppingMirror({'bar': 3000})
+        try:
+            for fetch in (lambda c: c.get_slices('bar', [(0, 3000)]),
+                          lambda c: c.get_slice_if('bar', '1-2-3', 0, 3000),
+                          lambda c: c.fetch('bar')):
+                c = client.Client(*mirror.address)
+                self.assertRaises(ConnectionError, fetch, c)
+                c.abort()
+        finally:
+            mirror.close()
+
+
+class TestConditionalFetch(TestBase):
+
+    def write(self, data):
+        # Como lo haría un proceso que publica archivos: uno nuevo que
+        # reemplaza al anterior
+        path = os.path.join(DATADIR, 'bar')
+        f = open(path + '.tmp', 'wb')
+        f.write(data)
+        f.close()
+        os.replace(path + '.tmp', path)
+
+    def test_get_metadata_ext(self):
+        self.write(b'x' * 10)
+        c = self.new_client()
+        size, mtime, version = c.get_metadata_ext('bar')
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(size, 10)
+        self.assertEqual(mtime, int(os.stat(os.path.join(DATADIR,
+                                                         'bar')).st_mtime))
+        self.assertEqual(c.get_metadata_ext('bar')[2], version)
+        self.write(b'y' * 10)
+        self.assertNotEqual(c.get_metadata_ext('bar')[2], version)
+        self.assertIsNone(c.get_metadata_ext('does_not_exist'))
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        c.close()
+
+    def test_get_slice_if(self):
+        self.write(b'a' * 100)
+        c = self.new_client()
+        _, _, version = c.get_metadata_ext('bar')
+        self.assertEqual(c.get_slice_if('bar', version, 10, 20), b'a' * 20)
+        self.write(b'b' * 100)
+        self.assertIsNone(c.get_slice_if('bar', version, 10, 20))
+        self.assertEqual(c.status, constants.VERSION_CHANGED)
+        c.send('get_slice_if bar not-a-version 0 1')
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.INVALID_ARGUMENTS)
+        c.close()
+
+    def test_cache(self):
+        self.write(b'a' * 100)
+        dest = tempfile.mkdtemp()
+        try:
+            c = self.new_client()
+            c.cache = client.DownloadCache(dest)
+            self.assertTrue(c.retrieve('bar'))
+            self.assertFalse(c.retrieve('bar'),
+                             "Volvió a bajar un archivo que no cambió")
+            # El índice persiste en disco
+            c.cache = client.DownloadCache(dest)
+            self.assertFalse(c.retrieve('bar'))
+            self.write(b'b' * 100)
+            self.assertTrue(c.retrieve('bar'))
+            f = open(os.path.join(dest, 'bar'), 'rb')
+            self.assertEqual(f.read(), b'b' * 100)
+            f.close()
+            c.close()
+        finally:
+            shutil.rmtree(dest)
+
+
+class TestSubscribe(TestBase):
+
+    def next_events(self, events, count):
+        """Los próximos `count' eventos, sin los avisos de timeout."""
+        result = []
+        while len(result) < count:
+            event = next(events)
+            if event is None:
+                self.fail("Faltan eventos, llegaron %s" % result)
+            result.append(event)
+        return result
+
+    def test_events(self):
+        path = os.path.join(DATADIR, 'bar')
+        c = self.new_client()
+        self.assertTrue(c.subscribe())
+        events = c.events(TIMEOUT)
+        f = open(path, 'w')
+        f.write('x')
+        f.close()
+        self.assertEqual(self.next_events(events, 1)[0], ('add', 'bar'))
+        # Reemplazarlo con un rename es modificarlo. Los nombres que no
+        # se pueden pedir no se informan
+        f = open(os.path.join(DATADIR, 'bar~'), 'w')
+        f.write('y')
+        f.close()
+        os.replace(os.path.join(DATADIR, 'bar~'), path)
+        self.assertEqual(self.next_events(events, 1)[0], ('modify', 'bar'))
+        os.remove(path)
+        self.assertEqual(self.next_events(events, 1)[0], ('remove', 'bar'))
+        events.close()
+        # Después de desuscribirse, la conexión sigue sirviendo
+        self.assertEqual(c.file_lookup(), [])
+        self.assertEqual(c.status, constants.CODE_OK)
+        c.close()
+
+    def test_commands_while_subscribed(self):
+        c = self.new_client()
+        self.assertTrue(c.subscribe())
+        c.send('get_file_listing')
+        self.assertEqual(c.read_response_line(TIMEOUT)[0],
+                         constants.INVALID_COMMAND)
+        c.send('quit')
+        # quit cierra la lista de eventos antes de su respuesta
+        self.assertEqual(c.read_line(TIMEOUT), '')
+        self.assertEqual(c.read_response_line(TIMEOUT)[0],
+                         constants.CODE_OK)
+        c.s.close()
+        c.connected = False
+
+    def test_errors_between_events(self):
+        c = self.new_client()
+        self.assertTrue(c.subscribe())
+        events = c.events(0.5)
+        c.send('get_file_listing')
+        # La respuesta de error no se confunde con un evento
+        self.assertIsNone(next(events))
+        self.assertEqual(c.status, constants.INVALID_COMMAND)
+        events.close()
+        self.assertEqual(c.file_lookup(), [])
+        c.close()
+
+    def test_scan_watcher(self):
+        pushed = []
+
+        class Subscriber(object):
+            def push_events(self, lines):
+                pushed.append(lines)
+
+        hub = watcher.Subscriptions(
+            DATADIR, lambda d: watcher.ScanWatcher(d, interval=0))
+        hub.subscribe(Subscriber())
+        self.assertIsNone(hub.fileno())
+        self.assertIsNotNone(hub.timeout())
+        open(os.path.join(DATADIR, 'bar'), 'w').close()
+        hub.dispatch()
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x')
+        f.close()
+        hub.dispatch()
+        self.assertEqual(pushed, [b'add bar\r\n', b'modify bar\r\n'])
+        hub.close()
+
+
+def cpu_time(pid):
+    """Segundos de CPU que usó un proceso (sólo Linux)."""
+    with open('/proc/%d/stat' % pid) as f:
+        # Después del nombre, que puede tener espacios
+        fields = f.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class TestIdleConnections(unittest.TestCase):
+
+    CONNECTIONS = 100000
+    # Presupuesto de memoria por conexión ociosa del lado del servidor:
+    # el Connection, su entrada en el dict y su registro en poll()
+    MAX_BYTES_PER_CONNECTION = 1024
+
+    def setUp(self):
+        if resource is None or not os.path.exists('/proc/self/statm'):
+            self.skipTest("Hace falta /proc y el módulo resource")
+        # Dos descriptores por conexión: el del server y el del cliente
+        self.limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (self.limits[1], self.limits[1]))
+        self.count = min(self.CONNECTIONS, (self.limits[1] - 256) // 2)
+        if self.count < 1000:
+            self.skipTest("Límite de descriptores muy bajo")
+        self.pairs = []
+
+    def tearDown(self):
+        for server_end, client_end in self.pairs:
+            server_end.close()
+            client_end.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.limits)
+
+    def test_memory_per_connection(self):
+        for _ in range(self.count):
+            server_end, client_end = socket.socketpair()
+            server_end.setblocking(False)
+            self.pairs.append((server_end, client_end))
+        before = rss()
+
+        connections = {}
+        poller = select.poll()
+        for server_end, _ in self.pairs:
+            connections[server_end.fileno()] = Connection(server_end,
+                                                          DATADIR)
+            poller.register(server_end, select.POLLIN)
+        per_connection = (rss() - before) / self.count
+
+        self.assertLess(per_connection, self.MAX_BYTES_PER_CONNECTION,
+                        "%d conexiones ociosas ocupan %d bytes cada una"
+                        % (self.count, per_connection))
+        for connection in connections.values():
+            self.assertTrue(connection.is_idle())
+            self.assertIsNone(connection.recv_buffer)
+
+
+class TestAccessTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.tracker = readahead.AccessTracker(
+            lambda fd, offset, length, advice: self.calls.append(
+                (offset, length, advice)))
+
+    def advised(self, advice):
+        return [(o, l) for o, l, a in self.calls if a == advice]
+
+    def test_sequential_scan(self):
+        for offset in range(0, 400, 100):
+            self.tracker.on_read('bar', 3, offset, 100, 1000)
+        # Recién a partir del tercer pedido consecutivo se da la pista
+        self.assertEqual(self.advised(os.POSIX_FADV_WILLNEED),
+                         [(300, 400), (700, 100)])
+        self.assertEqual(self.advised(os.POSIX_FADV_DONTNEED),
+                         [(0, 200), (200, 100)])
+
+    def test_random_access(self):
+        for offset in (500, 0, 900, 100, 300):
+            self.tracker.on_read('bar', 3, offset, 100, 1000)
+        self.assertEqual(self.calls, [])
+
+
+class TestConnectionPool(TestBase):
+
+    def setUp(self):
+        super().setUp()
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x' * 10)
+        f.close()
+        self.pool = client.ConnectionPool(max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        super().tearDown()
+
+    def test_reuse(self):
+        c = self.pool.acquire()
+        self.assertEqual(c.get_metadata('bar'), 10)
+        self.pool.release(c)
+        with self.pool.connection() as c2:
+            self.assertIs(c2, c, "El pool no reutilizó la conexión")
+            self.assertEqual(c2.get_metadata('bar'), 10)
+
+    def test_replaces_closed_connection(self):
+        c = self.pool.acquire()
+        # El server cierra la conexión, pero el cliente no se entera
+        c.send('quit')
+        self.assertEqual(c.read_response_line(TIMEOUT)[0],
+                         constants.CODE_OK)
+        self.pool.release(c)
+        time.sleep(0.1)
+        c2 = self.pool.acquire()
+        self.assertIsNot(c2, c, "El pool prestó una conexión cerrada")
+        self.assertEqual(c2.get_metadata('bar'), 10)
+        self.pool.release(c2)
+
+    def test_request_retries_closed_connection(self):
+        c = self.pool.acquire()
+        c.get_metadata('bar')
+        self.pool.release(c)
+        # Simula que se cortó justo después del chequeo de salud
+        c.is_alive = lambda: True
+        c.s.shutdown(socket.SHUT_RDWR)
+        size = self.pool.request(constants.DEFAULT_ADDR,
+                                 constants.DEFAULT_PORT,
+                                 lambda c: c.get_metadata('bar'))
+        self.assertEqual(size, 10)
+
+    def test_concurrent_use(self):
+        results = []
+        open_counts = []
+
+        def work():
+            for _ in range(20):
+                with self.pool.connection() as c:
+                    results.append(c.get_metadata('bar'))
+                    open_counts.append(self.pool.open[
+                        (constants.DEFAULT_ADDR, constants.DEFAULT_PORT)])
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [10] * 160)
+        self.assertLessEqual(max(open_counts), 2,
+                             "El pool abrió más conexiones que su límite")
+
+
+class TestMirror(TestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.contents = {}
+        for i, size in enumerate([0, 10, 3 * 2 ** 20 + 7]):
+            name = 'file%d.bin' % i
+            self.contents[name] = os.urandom(size)
+            f = open(os.path.join(DATADIR, name), 'wb')
+            f.write(self.contents[name])
+            f.close()
+        open(os.path.join(DATADIR, 'other.txt'), 'w').close()
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+        super().tearDown()
+
+    def mirror(self):
+        servers = [(constants.DEFAULT_ADDR, constants.DEFAULT_PORT)]
+        return client.Mirror(servers, self.dest, '*.bin', jobs=2).run()
+
+    def test_mirror(self):
+        summary = self.mirror()
+        self.assertEqual(summary['files_transferred'], 3)
+        self.assertEqual(summary['files_failed'], 0)
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         sorted(self.contents))
+        for name, data in self.contents.items():
+            f = open(os.path.join(self.dest, name), 'rb')
+            self.assertEqual(f.read(), data,
+                             "El contenido de %s no es el correcto" % name)
+            f.close()
+
+    def test_skip_existing(self):
+        self.mirror()
+        # Uno con otro tamaño se vuelve a bajar
+        f = open(os.path.join(self.dest, 'file1.bin'), 'wb')
+        f.write(b'xx')
+        f.close()
+        summary = self.mirror()
+        self.assertEqual(summary['files_transferred'], 1)
+        self.assertEqual(summary['files_skipped'], 2)
+
+    def test_dropped_connection(self):
+        mirror = DroppingMirror({'file2.bin': 3 * 2 ** 20})
+        try:
+            summary = client.Mirror([mirror.address], self.dest, '*.bin',
+                                    jobs=2).run()
+        finally:
+            mirror.close()
+        # Un trozo incompleto no cuenta como transferido
+        self.assertEqual(summary['files_transferred'], 0)
+        self.assertEqual(summary['files_failed'], 1)
+        self.assertEqual(summary['bytes'], 0)
+        self.assertEqual(os.listdir(self.dest), [])
+
+
+class FakeServer(object):
+    """
+    Servidor falso en un puerto libre de loopback, que atiende cada
+    conexión en un hilo con serve().
+    """
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.address = self.sock.getsockname()
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+        self.thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,),
+                             daemon=True).start()
+
+    def serve(self, conn):
+        raise NotImplementedError
+
+    def close(self):
+        self.sock.close()
+
+
+class BasicServer(FakeServer):
+    """
+    Servidor falso con sólo los comandos originales del protocolo, sin
+    get_file ni get_slices.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        super().__init__()
+
+    def serve(self, conn):
+        with conn:
+            for line in conn.makefile('rb'):
+                command, *args = line.decode('ascii').split()
+                if command == 'get_metadata':
+                    conn.sendall(('0 OK\r\n%d\r\n' % len(self.files[args[0]]))
+                                 .encode('ascii'))
+                elif command == 'get_slice':
+                    start, length = int(args[1]), int(args[2])
+                    data = self.files[args[0]][start:start + length]
+                    conn.sendall(b'0 OK\r\n' + base64.b64encode(data) +
+                                 b'\r\n')
+                elif command == 'quit':
+                    conn.sendall(b'0 OK\r\n')
+                    return
+                else:
+                    conn.sendall(('%d Command not found\r\n'
+                                  % constants.INVALID_COMMAND).encode('ascii'))
+
+
+class DroppingMirror(FakeServer):
+    """
+    Servidor falso que contesta el listado y la metadata de los archivos
+    dados, pero corta la conexión a mitad de cualquier otra respuesta,
+    como un mirror que se cae durante una transferencia.
+    """
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        super().__init__()
+
+    def metadata(self, name):
+        if name in self.sizes:
+            return '%d %d' % (constants.CODE_OK, self.sizes[name])
+        return str(constants.FILE_NOT_FOUND)
+
+    def serve(self, conn):
+        with conn:
+            for line in conn.makefile('rb'):
+                command, *args = line.decode('ascii').split()
+                if command == 'get_file_listing':
+                    conn.sendall(('0 OK\r\n%s\r\n' % ''.join(
+                        n + '\r\n' for n in self.sizes)).encode('ascii'))
+                elif command == 'get_metadata':
+                    conn.sendall(('0 OK\r\n%d\r\n' % self.sizes[args[0]])
+                                 .encode('ascii'))
+                elif command == 'get_metadata_batch':
+                    conn.sendall(('0 OK\r\n%s\r\n' % ''.join(
+                        self.metadata(n) + '\r\n' for n in args))
+                                 .encode('ascii'))
+                elif command == 'quit':
+                    conn.sendall(b'0 OK\r\n')
+                    return
+                else:
+                    # El comienzo de un trozo en base64, y nada más
+                    conn.sendall(b'0 OK\r\nQUJD')
+                    return
+
+
+class TestRateLimit(TestBase):
+
+    SIZE = 3 * 2 ** 20  # 4MB en base64
+
+    def setUp(self):
+        super().setUp()
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(os.urandom(self.SIZE))
+        f.close()
+
+    def throughput(self, server_args, clients):
+        """
+        Baja el archivo completo con `clients' conexiones a la vez y
+        devuelve el throughput agregado en bytes/s.
+        """
+        proc, port = spawn_server(DATADIR, server_args)
+        try:
+            socks = [socket.create_connection(('127.0.0.1', port))
+                     for _ in range(clients)]
+            expected = len('0 OK\r\n') + (self.SIZE + 2) // 3 * 4 + 2
+            start = time.monotonic()
+            for s in socks:
+                s.send(('get_slice bar 0 %d\r\n' % self.SIZE).encode())
+
+            def drain(s):
+                received = 0
+                while received < expected:
+                    received += len(s.recv(2 ** 16))
+
+            threads = [threading.Thread(target=drain, args=(s,))
+                       for s in socks]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.monotonic() - start
+            for s in socks:
+                s.close()
+            return expected * clients / elapsed
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def test_global_rate(self):
+        rate = 3 * 2 ** 20
+        measured = self.throughput(['-g', str(rate)], 3)
+        self.assertAlmostEqual(measured / rate, 1, delta=0.05,
+                               msg="Throughput %d, límite %d" % (measured,
+                                                                 rate))
+
+    def test_subnet_rate(self):
+        rate = 2 ** 21
+        measured = self.throughput(['-r', '127.0.0.0/8=%d' % rate,
+                                    '-r', '10.0.0.0/8=1K'], 2)
+        self.assertAlmostEqual(measured / rate, 1, delta=0.05,
+                               msg="Throughput %d, límite %d" % (measured,
+                                                                 rate))
+
+    def test_reset_while_throttled(self):
+        if not os.path.exists('/proc/self/stat'):
+            self.skipTest("Hace falta /proc")
+        proc, port = spawn_server(DATADIR, ['-r', '127.0.0.0/8=2K'])
+        try:
+            s = socket.create_connection(('127.0.0.1', port))
+            s.sendall(b'get_slice bar 0 1048576\r\nquit\r\n')
+            s.settimeout(TIMEOUT)
+            self.assertTrue(s.recv(1024))
+            # Que cierre con RST, mientras el servidor espera para mandarle
+            # más
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                         struct.pack('ii', 1, 0))
+            s.close()
+            time.sleep(0.1)
+            before = cpu_time(proc.pid)
+            time.sleep(1)
+            self.assertLess(cpu_time(proc.pid) - before, 0.2,
+                            "El servidor sigue atendiendo la conexión "
+                            "cerrada")
+        finally:
+            proc.kill()
+            proc.wait()
+
+
+class TestBackpressure(TestBase):
+
+    SIZE = 2 ** 20
+    CLIENTS = 32
+    # Pedidos que manda cada cliente sin leer las respuestas: sin
+    # backpressure el servidor acumularía ~1GB de respuestas
+    PIPELINED = 24
+    BUDGET = 8 * 2 ** 20
+    # Holgura sobre el presupuesto: cada conexión puede pasarse por una
+    # respuesta, más las copias transitorias al armarlas
+    MAX_GROWTH = 96 * 2 ** 20
+
+    def setUp(self):
+        super().setUp()
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(os.urandom(self.SIZE))
+        f.close()
+
+    def test_water_marks(self):
+        budget = backpressure.OutputBudget(high_water=100, low_water=10,
+                                           limit=250)
+        pairs = [socket.socketpair() for _ in range(2)]
+        try:
+            a, b = [Connection(server_end, DATADIR, budget=budget)
+                    for server_end, _ in pairs]
+            a.queue(b'x' * 150)
+            self.assertTrue(a.reading_paused())
+            a.sent(100)
+            # Por encima de la marca baja sigue pausada
+            self.assertTrue(a.reading_paused())
+            a.sent(45)
+            self.assertFalse(a.reading_paused())
+
+            # Entre las dos agotan el presupuesto: sólo se pausa la que
+            # tiene salida pendiente
+            b.queue(b'x' * 300)
+            self.assertTrue(budget.exhausted)
+            self.assertTrue(a.reading_paused())
+            b.sent(300)
+            self.assertFalse(b.reading_paused())
+            a.close()
+            self.assertEqual(budget.used, 0)
+            self.assertFalse(budget.exhausted)
+            self.assertTrue(budget.resumed)
+        finally:
+            for server_end, client_end in pairs:
+                server_end.close()
+                client_end.close()
+
+    def test_bounded_memory(self):
+        if not os.path.exists('/proc/self/statm'):
+            self.skipTest("Hace falta /proc")
+        proc, port = spawn_server(DATADIR, [
+            '--high-water', '1M', '--low-water', '256K',
+            '--memory-budget', str(self.BUDGET)])
+        socks = []
+        try:
+            c = client.Client('127.0.0.1', port)
+            self.assertEqual(len(c.get_slices('bar', [(0, self.SIZE)])[0]),
+                             self.SIZE)
+            before = rss(proc.pid)
+
+            request = ('get_slice bar 0 %d\r\n' % self.SIZE).encode()
+            for _ in range(self.CLIENTS):
+                s = socket.create_connection(('127.0.0.1', port))
+                s.sendall(request * self.PIPELINED)
+                socks.append(s)
+
+            peak = before
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline:
+                peak = max(peak, rss(proc.pid))
+                time.sleep(0.05)
+            self.assertLess(peak - before, self.MAX_GROWTH,
+                            "El servidor creció %d bytes" % (peak - before))
+
+            # Los clientes que leen sus respuestas siguen siendo atendidos
+            self.assertEqual(c.get_metadata('bar'), self.SIZE)
+            c.close()
+
+            # Y uno que se pone a leer recibe todas las suyas
+            expected = (len('0 OK\r\n') + (self.SIZE + 2) // 3 * 4 + 2) \
+                * self.PIPELINED
+            received = 0
+            socks[0].settimeout(TIMEOUT)
+            while received < expected:
+                data = socks[0].recv(2 ** 16)
+                self.assertTrue(data, "Se cerró la conexión")
+                received += len(data)
+            self.assertEqual(received, expected)
+        finally:
+            for s in socks:
+                s.close()
+            proc.kill()
+            proc.wait()
+
+    def test_huge_slices(self):
+        if not os.path.exists('/proc/self/statm'):
+            self.skipTest("Hace falta /proc")
+        size = 48 * 2 ** 20
+        data = os.urandom(size)
+        with open(os.path.join(DATADIR, 'huge'), 'wb') as f:
+            f.write(data)
+        proc, port = spawn_server(DATADIR, [
+            '--high-water', '1M', '--low-water', '256K',
+            '--memory-budget', str(self.BUDGET)])
+        socks = []
+        try:
+            c = client.Client('127.0.0.1', port)
+            version = c.get_metadata_ext('huge')[2]
+            self.assertEqual(c.get_slice_if('huge', version, 1, size - 1),
+                             data[1:])
+            before = rss(proc.pid)
+
+            # Un solo pedido por cliente, pero cada respuesta armada entera
+            # ocuparía 64MB
+            request = ('get_slice huge 0 %d\r\n' % size).encode()
+            for _ in range(8):
+                s = socket.create_connection(('127.0.0.1', port))
+                s.sendall(request)
+                socks.append(s)
+
+            peak = before
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline:
+                peak = max(peak, rss(proc.pid))
+                time.sleep(0.05)
+            self.assertLess(peak - before, self.MAX_GROWTH,
+                            "El servidor creció %d bytes" % (peak - before))
+            self.assertEqual(c.get_metadata('huge'), size)
+            c.close()
+        finally:
+            for s in socks:
+                s.close()
+            proc.kill()
+            proc.wait()
+
+
+def read_until(stream, pattern, timeout):
+    """
+    Lee la salida de un proceso hasta que aparezca la expresión regular
+    (de bytes) `pattern'. Devuelve el match, o None si no aparece en
+    `timeout' segundos.
+    """
+    # Directo del fd: select() no ve lo que ya esté en el buffer de stream
+    output = b''
+    deadline = time.monotonic() + timeout
+    while True:
+        match = re.search(pattern, output)
+        remaining = deadline - time.monotonic()
+        if match is not None or remaining <= 0:
+            return match
+        r, _, _ = select.select([stream], [], [], remaining)
+        data = os.read(stream.fileno(), 2 ** 16) if r else b''
+        if not data:
+            return None
+        output += data
+
+
+def free_ipv6_port():
+    """Un puerto libre en [::] para IPv6 y IPv4, o None si no hay IPv6."""
+    if not socket.has_ipv6:
+        return None
+    try:
+        with socket.socket(socket.AF_INET6) as s:
+            s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            s.bind(('::', 0))
+            return s.getsockname()[1]
+    except OSError:
+        return None
+
+
+class TestAccept(TestBase):
+
+    # Descriptores que puede abrir el servidor: menos que los clientes
+    MAX_FDS = 40
+    CLIENTS = 60
+
+    def test_out_of_descriptors(self):
+        if resource is None or not os.path.exists('/proc/self/stat'):
+            self.skipTest("Hace falta resource y /proc")
+        log = tempfile.TemporaryFile()
+        limit = self.MAX_FDS
+        proc, port = spawn_server(
+            DATADIR, [], stderr=log, preexec_fn=lambda: resource.setrlimit(
+                resource.RLIMIT_NOFILE, (limit, limit)))
+        socks = []
+        try:
+            for _ in range(self.CLIENTS):
+                socks.append(socket.create_connection(('127.0.0.1', port)))
+            time.sleep(0.2)
+            before = cpu_time(proc.pid)
+            time.sleep(1)
+            self.assertLess(cpu_time(proc.pid) - before, 0.2,
+                            "El servidor insiste con accept() sin "
+                            "descriptores libres")
+
+            # Al liberarse descriptores atiende a los que esperaban
+            for s in socks[:self.CLIENTS - self.MAX_FDS // 2]:
+                s.close()
+            s = socks[-1]
+            s.settimeout(TIMEOUT)
+            s.sendall(b'get_metadata missing\r\n')
+            self.assertEqual(s.recv(1024).split()[0],
+                             str(constants.FILE_NOT_FOUND).encode())
+        finally:
+            for s in socks:
+                s.close()
+            proc.kill()
+            proc.wait()
+        log.seek(0)
+        self.assertLess(log.read().count(b'accept() failed'), 5)
+        log.close()
+
+
+class TestListeners(TestBase):
+
+    def setUp(self):
+        super().setUp()
+        open(os.path.join(DATADIR, 'bar'), 'w').close()
+        self.unix_path = tempfile.mktemp()
+        self.port6 = free_ipv6_port()
+        if self.port6 is None:
+            self.skipTest("No hay IPv6")
+        self.unix = constants.UNIX_PREFIX + self.unix_path
+        self.dual = '[::]:%d' % self.port6
+        self.proc, self.port = spawn_server(
+            DATADIR, ['-L', self.unix, '-L', self.dual],
+            stderr=subprocess.PIPE)
+
+    def tearDown(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.proc.stderr.close()
+        if os.path.exists(self.unix_path):
+            os.remove(self.unix_path)
+        super().tearDown()
+
+    def listener_stats(self):
+        # kill -USR1 vuelca las estadísticas en una línea de stderr
+        self.proc.send_signal(signal.SIGUSR1)
+        match = read_until(self.proc.stderr, rb'(?m)^\{.*\}$', TIMEOUT)
+        self.assertIsNotNone(match, "El servidor no volcó sus estadísticas")
+        return json.loads(match.group(0))['listeners']
+
+    def test_listeners(self):
+        clients = [
+            client.Client(self.unix),
+            client.Client('::1', self.port6),
+            # El de IPv6 también atiende IPv4
+            client.Client('127.0.0.1', self.port6),
+        ]
+        for c in clients:
+            self.assertEqual(c.get_metadata('bar'), 0)
+            self.assertEqual(c.status, constants.CODE_OK)
+
+        stats = self.listener_stats()
+        tcp = '127.0.0.1:%d' % self.port
+        self.assertEqual(sorted(stats), sorted([tcp, self.unix, self.dual]))
+        self.assertEqual(stats[self.unix], {'accepted': 1, 'active': 1})
+        self.assertEqual(stats[self.dual], {'accepted': 2, 'active': 2})
+        # La conexión de prueba de spawn_server
+        self.assertEqual(stats[tcp]['accepted'], 1)
+
+        for c in clients:
+            c.close()
+        deadline = time.monotonic() + TIMEOUT
+        while time.monotonic() < deadline:
+            stats = self.listener_stats()
+            if all(s['active'] == 0 for s in stats.values()):
+                break
+            time.sleep(0.05)
+        self.assertEqual(stats[self.unix], {'accepted': 1, 'active': 0})
+        self.assertEqual(stats[self.dual], {'accepted': 2, 'active': 0})
+        self.assertEqual(stats[tcp]['active'], 0)
+
+
+class TestReload(TestBase):
+
+    # Su respuesta no entra en los buffers del kernel
+    SIZE = 32 * 2 ** 20
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(self.SIZE)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(self.data)
+        f.close()
+        # En un grupo propio, que comparte con su sucesor
+        self.proc, self.port = spawn_server(DATADIR, [],
+                                            stdout=subprocess.PIPE,
+                                            start_new_session=True)
+
+    def tearDown(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+        super().tearDown()
+
+    def test_reload_while_sending(self):
+        c = client.Client('127.0.0.1', self.port)
+        c.send('get_slice bar 0 %d' % self.SIZE)
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.CODE_OK)
+
+        self.proc.send_signal(signal.SIGHUP)
+        # El proceso viejo avisa cuando el nuevo tomó los sockets
+        match = read_until(self.proc.stdout, rb'Replaced by process (\d+)',
+                           10 * TIMEOUT)
+        self.assertIsNotNone(match, "El servidor no fue reemplazado")
+        self.assertNotEqual(int(match.group(1)), self.proc.pid)
+
+        # Las conexiones nuevas se atienden mientras el viejo sigue con la
+        # respuesta en curso
+        c2 = client.Client('127.0.0.1', self.port)
+        self.assertEqual(c2.get_metadata('bar'), self.SIZE)
+        self.assertIsNone(self.proc.poll(),
+                          "El proceso viejo terminó con una respuesta "
+                          "en curso")
+
+        data = base64.b64decode(c.read_line(10 * TIMEOUT))
+        self.assertTrue(data == self.data,
+                        "La respuesta en curso no llegó completa")
+        c.abort()
+        # Terminada su última conexión, el viejo termina...
+        self.proc.wait(10 * TIMEOUT)
+        # ...y las conexiones nuevas eran del sucesor
+        self.assertEqual(c2.get_metadata('bar'), self.SIZE)
+        c2.close()
+        c3 = client.Client('127.0.0.1', self.port)
+        self.assertEqual(c3.get_metadata('bar'), self.SIZE)
+        c3.close()
+
+
+class TestMirrorGroup(TestBase):
+
+    SIZE = 8 * 2 ** 20 + 5
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(self.SIZE)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(self.data)
+        f.close()
+        self.dest = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.dest):
+            os.remove(self.dest)
+        super().tearDown()
+
+    def retrieve(self, mirrors):
+        group = client.MirrorGroup(mirrors, pool_size=4)
+        try:
+            self.assertTrue(group.retrieve('bar', self.dest, jobs=4))
+            return {(m['server'], m['port']): m for m in group.stats()}
+        finally:
+            group.close()
+
+    def check_file(self):
+        f = open(self.dest, 'rb')
+        self.assertEqual(f.read(), self.data,
+                         "El contenido del archivo no es el correcto")
+        f.close()
+
+    def test_prefers_fast_mirror(self):
+        fast = (constants.DEFAULT_ADDR, constants.DEFAULT_PORT)
+        proc, port = spawn_server(DATADIR, ['-g', '256K'])
+        try:
+            stats = self.retrieve([('127.0.0.1', port), fast])
+        finally:
+            proc.kill()
+            proc.wait()
+        self.check_file()
+        slow = stats[('127.0.0.1', port)]
+        self.assertGreater(stats[fast]['requests'], slow['requests'],
+                           "El mirror limitado recibió más pedidos")
+
+    def test_hedge_delay(self):
+        stats = client.MirrorStats('127.0.0.1', 0)
+        for _ in range(client.HEDGE_MIN_SAMPLES):
+            stats.record(0.001, 0)
+            stats.record(0.5, 2 ** 20)
+        # Los trozos lentos no demoran la duplicación de los pedidos chicos
+        self.assertAlmostEqual(stats.hedge_delay(0), 0.001)
+        # Y las transferencias se estiman según su tamaño
+        self.assertAlmostEqual(stats.hedge_delay(2 ** 20), 0.5)
+        self.assertAlmostEqual(stats.hedge_delay(2 ** 19), 0.25)
+
+    def test_failover(self):
+        # Un puerto en el que nadie escucha
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            dead = ('127.0.0.1', s.getsockname()[1])
+        fast = (constants.DEFAULT_ADDR, constants.DEFAULT_PORT)
+        stats = self.retrieve([dead, fast])
+        self.check_file()
+        self.assertGreater(stats[dead]['failures'], 0)
+        self.assertEqual(stats[dead]['requests'], 0)
+
+    def test_failover_mid_response(self):
+        # Un mirror que se cae en medio de cada trozo
+        dropping = DroppingMirror({'bar': self.SIZE})
+        fast = (constants.DEFAULT_ADDR, constants.DEFAULT_PORT)
+        try:
+            stats = self.retrieve([dropping.address, fast])
+        finally:
+            dropping.close()
+        self.check_file()
+        self.assertGreater(stats[dropping.address]['failures'], 0)
+
+    def test_all_mirrors_drop(self):
+        dropping = DroppingMirror({'bar': self.SIZE})
+        group = client.MirrorGroup([dropping.address], pool_size=4)
+        try:
+            self.assertRaises(socket.error, group.retrieve, 'bar',
+                              self.dest, jobs=4)
+        finally:
+            group.close()
+            dropping.close()
+        self.assertFalse(os.path.exists(self.dest),
+                         "Quedó un archivo a medias")
+
+
+class BlockedStream(io.StringIO):
+    """Stream cuyo write se bloquea hasta que se libere `release'."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def write(self, s):
+        self.release.wait()
+        return super().write(s)
+
+
+class TestRecordReplay(TestBase):
+
+    def setUp(self):
+        super().setUp()
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(os.urandom(100000))
+        f.close()
+        self.recording = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.recording):
+            os.remove(self.recording)
+        super().tearDown()
+
+    def record(self):
+        proc, port = spawn_server(DATADIR, ['--record', self.recording])
+        try:
+            for _ in range(3):
+                c = client.Client('127.0.0.1', port)
+                c.file_lookup()
+                c.get_metadata('bar')
+                c.get_slices('bar', [(0, 1000), (5000, 50000)])
+                c.get_metadata('missing')
+                c.send('bogus')
+                c.read_response_line()
+                c.close()
+        finally:
+            # Con TERM el servidor termina limpio y vuelca la grabación
+            proc.terminate()
+            proc.wait()
+
+    def test_recording(self):
+        self.record()
+        events = list(recorder.read_recording(self.recording))
+        kinds = collections.Counter(e.kind for e in events)
+        # spawn_server también abre y cierra una conexión de prueba, que
+        # puede no llegar a atenderse
+        self.assertEqual(kinds[recorder.CONNECT], kinds[recorder.CLOSE])
+        self.assertEqual(kinds[recorder.COMMAND], 18)
+        used = {e.connection for e in events if e.kind == recorder.COMMAND}
+        self.assertEqual(len(used), 3)
+        commands = [e for e in events if e.kind == recorder.COMMAND]
+        self.assertEqual([(e.line, e.status) for e in commands[:6]], [
+            ('get_file_listing', constants.CODE_OK),
+            ('get_metadata bar', constants.CODE_OK),
+            ('get_slices bar 0 1000 5000 50000', constants.CODE_OK),
+            ('get_metadata missing', constants.FILE_NOT_FOUND),
+            ('bogus', constants.INVALID_COMMAND),
+            ('quit', constants.CODE_OK),
+        ])
+        # Sin el contenido de las respuestas
+        self.assertLess(os.path.getsize(self.recording), 2000)
+        times = [e.time for e in events]
+        self.assertEqual(times, sorted(times))
+
+    def test_replay(self):
+        self.record()
+        sessions = replay.load_sessions(self.recording)
+        proc, port = spawn_server(DATADIR, [])
+        try:
+            report = replay.Replay(sessions, '127.0.0.1', port,
+                                   speed=0).run()
+            self.assertEqual(report['requests'], 18)
+            self.assertEqual(report['divergent'], 0)
+            self.assertEqual(report['errors'], 0)
+            self.assertEqual(report['commands']['get_slices']['count'], 3)
+
+            # Sin el archivo, las respuestas difieren de las grabadas
+            os.remove(os.path.join(DATADIR, 'bar'))
+            report = replay.Replay(sessions, '127.0.0.1', port,
+                                   speed=0).run()
+            self.assertEqual(report['divergences'], {
+                'get_metadata %d->%d' % (constants.CODE_OK,
+                                         constants.FILE_NOT_FOUND): 3,
+                'get_slices %d->%d' % (constants.CODE_OK,
+                                       constants.FILE_NOT_FOUND): 3,
+            })
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def test_replay_batches(self):
+        proc, port = spawn_server(DATADIR, ['--record', self.recording])
+        try:
+            c = client.Client('127.0.0.1', port)
+            c.send('get_slices bar 0 0 0 5')
+            c.read_response_line()
+            c.get_metadata('bar')
+            c.get_slices('bar', [(0, 5), (10, 1), (20, 30000)])
+            c.get_metadata_batch(['bar', 'missing', 'bar'])
+            c.get_metadata('bar')
+            c.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+        sessions = replay.load_sessions(self.recording)
+        proc, port = spawn_server(DATADIR, [])
+        try:
+            report = replay.Replay(sessions, '127.0.0.1', port,
+                                   speed=0).run()
+        finally:
+            proc.kill()
+            proc.wait()
+        self.assertEqual(report['requests'], 6)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['divergent'], 0)
+
+    def test_read_response_empty_fragment(self):
+        # Un servidor que acepta rangos vacíos: el fragmento vacío no es el
+        # fin de la lista
+        path = tempfile.mktemp()
+        listener = socket.socket(socket.AF_UNIX)
+        listener.bind(path)
+        listener.listen(1)
+        try:
+            c = client.Client(client.UNIX_PREFIX + path)
+            conn, _ = listener.accept()
+            conn.sendall(b'0 OK\r\n\r\nYWJjZGU=\r\n\r\n0 OK\r\n5\r\n')
+            self.assertEqual(replay.read_response(c, 'get_slices bar 0 0 0 5'),
+                             (constants.CODE_OK, 20))
+            self.assertEqual(replay.read_response(c, 'get_metadata bar'),
+                             (constants.CODE_OK, 9))
+            c.abort()
+            conn.close()
+        finally:
+            listener.close()
+            os.remove(path)
+
+
+class TestAccessLog(unittest.TestCase):
+
+    def test_json_records(self):
+        out = io.StringIO()
+        log = accesslog.AccessLog(out, 'json', flush_interval=0.01)
+        log.record('127.0.0.1:1234', 'command', 'get_slice', 'bar 0 10',
+                   constants.CODE_OK, 22, 0.001)
+        log.close()
+        record = json.loads(out.getvalue())
+        self.assertEqual(record['command'], 'get_slice')
+        self.assertEqual(record['args'], 'bar 0 10')
+        self.assertEqual(record['bytes'], 22)
+
+    def test_overload_drops_instead_of_blocking(self):
+        out = BlockedStream()
+        log = accesslog.AccessLog(out, 'text', capacity=10,
+                                  flush_interval=0.01)
+        start = time.monotonic()
+        for i in range(1000):
+            log.record('127.0.0.1:1234', 'connect')
+        self.assertLess(time.monotonic() - start, 1,
+                        "El log de accesos bloqueó al productor")
+        self.assertGreaterEqual(log.dropped, 1000 - 2 * 10)
+        out.release.set()
+        log.close()
+        self.assertIn('dropped', out.getvalue())
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestHFTPServer))
     suite.addTest(unittest.makeSuite(TestHFTPErrors))
     suite.addTest(unittest.makeSuite(TestHFTPHard))
+    suite.addTest(unittest.makeSuite(TestHFTPBatch))
+    suite.addTest(unittest.makeSuite(TestConditionalFetch))
+    suite.addTest(unittest.makeSuite(TestSubscribe))
+    suite.addTest(unittest.makeSuite(TestIdleConnections))
+    suite.addTest(unittest.makeSuite(TestConnectionPool))
+    suite.addTest(unittest.makeSuite(TestMirror))
+    suite.addTest(unittest.makeSuite(TestMirrorGroup))
+    suite.addTest(unittest.makeSuite(TestRateLimit))
+    suite.addTest(unittest.makeSuite(TestBackpressure))
+    suite.addTest(unittest.makeSuite(TestAccept))
+    suite.addTest(unittest.makeSuite(TestListeners))
+    suite.addTest(unittest.makeSuite(TestReload))
+    suite.addTest(unittest.makeSuite(TestRecordReplay))
+    suite.addTest(unittest.makeSuite(TestAccessLog))
+    suite.addTest(unittest.makeSuite(TestAccessTracker))
     return suite
 
 
@@ -6,86 +6,511 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: server.py 656 2013-03-18 23:49:11Z bc $
 
+import errno
+import handoff
+import os
+import json
+import logging
+import math
 import optparse
+import signal
 import socket
 import sys
 import select
+import time
+from accesslog import AccessLog, FORMATS
+from backpressure import (OutputBudget, parse_size, DEFAULT_HIGH_WATER,
+                          DEFAULT_LOW_WATER, DEFAULT_MEMORY_BUDGET)
 from connection import Connection
-from constants import DEFAULT_ADDR, DEFAULT_DIR, DEFAULT_PORT
+from constants import DEFAULT_ADDR, DEFAULT_BACKLOG, DEFAULT_DIR, DEFAULT_PORT
+from listeners import Listener
+from ratelimit import RateLimiter, parse_rate
+from recorder import Recorder
+from tuning import SocketTuning
+from watcher import Subscriptions
+
+# Max connections accepted per POLLIN event on the listening socket, so a
+# reconnect storm can't starve the connections already being served
+ACCEPT_BATCH = 64
+
+# Seconds a server replaced on reload waits for its clients to finish
+DRAIN_TIMEOUT = 60
+
+# Out of file descriptors, seconds to stop accepting before trying again;
+# meanwhile new connections wait in the listen backlog
+ACCEPT_BACKOFF = 0.1
+# Seconds between warnings about failed accepts
+ACCEPT_WARNING_INTERVAL = 10
 
 
 class Server(object):
     """
-    El servidor, que crea y atiende el socket en la dirección y puerto
-    especificados donde se reciben nuevas conexiones de clientes.
+    El servidor, que crea y atiende los sockets de escucha donde se reciben
+    nuevas conexiones de clientes. Por defecto escucha en la dirección y
+    puerto especificados; `listeners' permite pasar en cambio una lista de
+    especificaciones (ver listeners.py) para escuchar en varios sockets
+    TCP, IPv6 o Unix a la vez.
     """
 
     def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT,
-                 directory=DEFAULT_DIR):
-        print("Serving %s on %s:%s." % (directory, addr, port))
+                 directory=DEFAULT_DIR, access_log=None,
+                 backlog=DEFAULT_BACKLOG, accept_batch=ACCEPT_BATCH,
+                 tuning=None, listeners=None, rate_limiter=None,
+                 drain_timeout=DRAIN_TIMEOUT, budget=None, recorder=None):
+        if listeners is None:
+            listeners = [f"{addr}:{port}"]
+        print("Serving %s on %s." % (directory, ", ".join(listeners)))
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listeners = [Listener(spec) for spec in listeners]
+        # listening socket fd -> Listener
+        self.listening = {}
         self.port = port
         self.addr = addr
         self.dir = directory
         self.connections = {}
         self.poller = None
+        self.access_log = access_log
+        self.backlog = backlog
+        self.accept_batch = accept_batch
+        self.tuning = tuning if tuning is not None else SocketTuning()
+        self.rate_limiter = rate_limiter
+        # fds of the connections waiting for their rate limits to refill
+        self.throttled = set()
+        # fds of the connections with whole requests already read, that
+        # poll() won't report again
+        self.ready = set()
+        # Backpressure on the output, see backpressure.py
+        self.budget = budget if budget is not None else OutputBudget()
+        # fds of the connections not read from until they drain their
+        # output, or until the memory budget frees up
+        self.paused = set()
+        # Traffic recording for replay.py, see recorder.py
+        self.recorder = recorder
+        # Change notifications; the watcher is created on first subscribe
+        self.subscriptions = Subscriptions(directory)
+        self.watcher_fd = None
+        # time.monotonic() until which the listeners aren't polled, after
+        # running out of file descriptors
+        self.accept_paused_until = None
+        # failed accepts not warned about yet, and when the last warning was
+        self.accept_errors = 0
+        self.accept_warned = None
+
+        # Graceful reload, see handoff.py
+        self.drain_timeout = drain_timeout
+        self.reload_requested = False
+        self.stop_requested = False
+        # read end of the socketpair signal.set_wakeup_fd() writes to
+        self.wakeup = None
+        # new server process and its readiness pipe, while it starts
+        self.successor = None
+        self.successor_fd = None
+        # once replaced, time.monotonic() at which we give up draining
+        self.drain_deadline = None
+
+    def listen(self):
+        """
+        Abre los sockets de escucha. Si se pidió el puerto 0, self.port
+        queda con el puerto que asignó el sistema al primer listener TCP.
+        """
+        self.poller = select.poll()
+        inherited = handoff.inherited_listeners()
+        try:
+            for listener in self.listeners:
+                if listener.name in inherited:
+                    sock = listener.adopt(socket.socket(
+                        fileno=inherited.pop(listener.name)))
+                else:
+                    sock = listener.open(self.backlog)
+                self.listening[sock.fileno()] = listener
+                self.poller.register(sock, select.POLLIN)
+        except OSError:
+            self.close_listeners()
+            raise
+
+        # Listeners the previous process had but we no longer want
+        for fd in inherited.values():
+            os.close(fd)
+
+        tcp_ports = [lst.port for lst in self.listeners
+                     if lst.port is not None]
+        if tcp_ports:
+            self.port = tcp_ports[0]
+
+    def close_listeners(self):
+        for listener in self.listeners:
+            if listener.socket is not None and self.poller is not None:
+                try:
+                    self.poller.unregister(listener.socket)
+                except KeyError:
+                    pass
+            listener.close()
+        self.listening = {}
+
+    def install_signal_handlers(self):
+        """
+        kill -HUP reemplaza al servidor por un proceso nuevo sin cortar
+        conexiones; kill (TERM) lo termina entre dos iteraciones del loop,
+        sin perder registros del log ni de la grabación. Debe llamarse
+        desde el hilo principal.
+        """
+        self.wakeup, wakeup_w = socket.socketpair()
+        self.wakeup.setblocking(False)
+        wakeup_w.setblocking(False)
+        # Kept alive through the wakeup fd registration
+        self.wakeup_w = wakeup_w
+        signal.set_wakeup_fd(wakeup_w.fileno())
+        signal.signal(signal.SIGHUP, self.on_sighup)
+        signal.signal(signal.SIGTERM, self.on_sigterm)
+
+    def on_sighup(self, signum, frame):
+        # The loop picks it up when the wakeup fd interrupts poll()
+        self.reload_requested = True
+
+    def on_sigterm(self, signum, frame):
+        self.stop_requested = True
 
     def serve(self):
         """
-        Loop principal del servidor. Se acepta una conexión a la vez
-        y se espera a que concluya antes de seguir.
+        Loop principal del servidor. Atiende todas las conexiones a la vez
+        multiplexando con poll(). Si el servidor fue reemplazado por uno
+        nuevo (ver reload()), vuelve una vez que terminaron sus conexiones.
         """
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((self.addr, self.port))
-        self.socket.listen()
+        if self.poller is None:
+            self.listen()
+        if self.wakeup is not None:
+            self.poller.register(self.wakeup, select.POLLIN)
+        handoff.notify_ready()
 
-        self.poller = select.poll()
-        self.poller.register(self.socket, select.POLLIN)
-
-        while True:
-            events = self.poller.poll()
-            for sock_fd, event in events:
-                if not (event & (select.POLLIN | select.POLLOUT)):
-                    continue
-
-                if (event & select.POLLOUT):
-                    self.handle_pollout(sock_fd)
-                elif (event & select.POLLIN):
-                    if sock_fd == self.socket.fileno():
-                        # Server socket event
-                        self.handle_new_connection()
-                    else:
-                        self.handle_pollin(sock_fd)
-
-    def handle_new_connection(self):
-        (new_sock, _) = self.socket.accept()
-        new_sock.setblocking(False)
-
-        self.poller.register(new_sock, select.POLLIN)
-        self.connections[new_sock.fileno()] = Connection(new_sock, self.dir)
+        try:
+            while not self.drained() and not self.stop_requested:
+                events = self.poller.poll(self.poll_timeout())
+                for sock_fd, event in events:
+                    if self.wakeup is not None and \
+                            sock_fd == self.wakeup.fileno():
+                        self.handle_wakeup()
+                        continue
+                    if sock_fd == self.successor_fd:
+                        self.handle_successor_ready()
+                        continue
+                    if sock_fd == self.watcher_fd:
+                        self.handle_changes()
+                        continue
+                    if sock_fd not in self.connections and \
+                            sock_fd not in self.listening:
+                        # Closed while handling an earlier event
+                        continue
+                    if not (event & (select.POLLIN | select.POLLOUT)):
+                        if sock_fd in self.connections and event & (
+                                select.POLLERR | select.POLLHUP |
+                                select.POLLNVAL):
+                            # Reset while not polled for anything (e.g.
+                            # throttled after quit): these can't be masked,
+                            # poll() would return at once until it's woken
+                            self.close_connection(sock_fd)
+                        continue
+
+                    if (event & select.POLLOUT):
+                        self.handle_pollout(sock_fd)
+                    elif (event & select.POLLIN):
+                        listener = self.listening.get(sock_fd)
+                        if listener is not None:
+                            # Server socket event
+                            self.handle_new_connection(listener)
+                        else:
+                            self.handle_pollin(sock_fd)
+                self.wake_throttled()
+                self.resume_accepting()
+                self.resume_paused()
+                self.serve_ready()
+                self.update_watcher()
+        finally:
+            self.close_listeners()
+            for sock_fd in list(self.connections):
+                self.close_connection(sock_fd)
+            self.subscriptions.close()
+
+    def poll_timeout(self):
+        """
+        Milliseconds until the next throttled connection may send again,
+        the next scan for changes or the drain deadline, or None to wait
+        indefinitely.
+        """
+        if self.ready:
+            return 0
+        wakes = [self.connections[fd].throttled_until
+                 for fd in self.throttled]
+        if self.drain_deadline is not None:
+            wakes.append(self.drain_deadline)
+        if self.accept_paused_until is not None:
+            wakes.append(self.accept_paused_until)
+        if self.subscriptions.timeout() is not None:
+            wakes.append(self.subscriptions.timeout())
+        if not wakes:
+            return None
+        return max(0, math.ceil((min(wakes) - time.monotonic()) * 1000))
+
+    def handle_wakeup(self):
+        try:
+            while self.wakeup.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reload()
+
+    def reload(self):
+        """
+        Lanza un proceso servidor nuevo que hereda los sockets de escucha.
+        Cuando está listo, este deja de aceptar conexiones y termina las
+        que tiene.
+        """
+        if self.successor is not None or self.drain_deadline is not None:
+            return
+        try:
+            self.successor, self.successor_fd = handoff.spawn_successor(
+                self.listeners)
+        except OSError as e:
+            logging.error(f"Could not start the new server: {e}")
+            return
+        self.poller.register(self.successor_fd, select.POLLIN)
+
+    def handle_successor_ready(self):
+        ready = os.read(self.successor_fd, 1)
+        self.poller.unregister(self.successor_fd)
+        os.close(self.successor_fd)
+        self.successor_fd = None
+
+        if not ready:
+            status = self.successor.wait()
+            logging.error(f"New server exited with status {status} before "
+                          "taking over, still serving")
+            self.successor = None
+            return
+
+        print("Replaced by process %d, draining %d connections."
+              % (self.successor.pid, len(self.connections)))
+        # The successor outlives us, init adopts it once we exit
+        self.successor = None
+
+        # Stop accepting; the successor serves the same sockets now
+        for listener in self.listeners:
+            if listener.socket is not None:
+                self.poller.unregister(listener.socket)
+                listener.detach()
+        self.listening = {}
+
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        for sock_fd, client in list(self.connections.items()):
+            if client.is_idle():
+                self.close_connection(sock_fd)
+
+    def drained(self):
+        if self.drain_deadline is None:
+            return False
+        return not self.connections or time.monotonic() >= self.drain_deadline
+
+    def serve_ready(self):
+        ready, self.ready = self.ready, set()
+        for sock_fd in ready:
+            if sock_fd in self.connections:
+                self.handle_pollin(sock_fd)
+
+    def wake_throttled(self):
+        now = time.monotonic()
+        for sock_fd in list(self.throttled):
+            client = self.connections[sock_fd]
+            if client.throttled_until > now:
+                continue
+            self.throttled.discard(sock_fd)
+            client.throttled_until = None
+            self.handle_pollout(sock_fd)
+
+    def resume_paused(self):
+        """
+        Once the memory budget stops being exhausted, reads again from the
+        connections it held back. The ones held back by their own water
+        marks resume by themselves as they drain.
+        """
+        if not self.budget.resumed:
+            return
+        self.budget.resumed = False
+        for sock_fd in list(self.paused):
+            self.update_interest(sock_fd, self.connections[sock_fd])
+
+    def update_watcher(self):
+        """
+        Polls the watcher once the first subscriber created it, and runs
+        the scans of the fallback watcher when they are due.
+        """
+        fd = self.subscriptions.fileno()
+        if fd is not None and self.watcher_fd is None:
+            # Kept open from then on, so it's never unregistered
+            self.poller.register(fd, select.POLLIN)
+            self.watcher_fd = fd
+
+        wake = self.subscriptions.timeout()
+        if wake is not None and wake <= time.monotonic():
+            self.handle_changes()
+
+    def handle_changes(self):
+        for client in self.subscriptions.dispatch():
+            sock_fd = client.socket.fileno()
+            if sock_fd in self.connections:
+                self.handle_pollout(sock_fd)
+
+    def stats(self):
+        """Estado del servidor, para monitoreo."""
+        stats = {
+            'connections': len(self.connections),
+            'throttled': len(self.throttled),
+            'subscribers': len(self.subscriptions.subscribers),
+            'paused': len(self.paused),
+            'output': self.budget.stats(),
+            'listeners': {
+                listener.name: {
+                    'accepted': listener.accepted,
+                    'active': listener.active,
+                } for listener in self.listeners
+            },
+        }
+        if self.rate_limiter is not None:
+            stats['rate_limits'] = self.rate_limiter.stats()
+        return stats
+
+    def handle_new_connection(self, listener):
+        # Drain the accept queue, up to accept_batch connections per event
+        for _ in range(self.accept_batch):
+            try:
+                (new_sock, address) = listener.socket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    # The listener stays readable: don't poll it for a while
+                    self.pause_accepting(e)
+                    return
+                # e.g. the client reset while still queued
+                if e.errno != errno.ECONNABORTED:
+                    self.warn_accept_failed(e)
+                    return
+                continue
+
+            new_sock.setblocking(False)
+            try:
+                self.tuning.apply(new_sock)
+                connection = Connection(new_sock, self.dir, self.access_log,
+                                        listener.name, self.subscriptions,
+                                        self.budget, self.recorder)
+            except OSError:
+                # Client is already gone (getpeername() fails)
+                new_sock.close()
+                continue
+
+            if self.rate_limiter is not None:
+                host = address[0] if isinstance(address, tuple) else ''
+                connection.buckets = self.rate_limiter.buckets_for(host)
+
+            listener.accepted += 1
+            listener.active += 1
+            self.poller.register(new_sock, select.POLLIN)
+            self.connections[new_sock.fileno()] = connection
+
+    def pause_accepting(self, error):
+        self.warn_accept_failed(error)
+        self.accept_paused_until = time.monotonic() + ACCEPT_BACKOFF
+        for sock_fd in self.listening:
+            self.poller.modify(sock_fd, 0)
+
+    def resume_accepting(self):
+        if self.accept_paused_until is None or \
+                time.monotonic() < self.accept_paused_until:
+            return
+        self.accept_paused_until = None
+        for sock_fd in self.listening:
+            self.poller.modify(sock_fd, select.POLLIN)
+
+    def warn_accept_failed(self, error):
+        """Logs failed accepts, at most once every ACCEPT_WARNING_INTERVAL."""
+        self.accept_errors += 1
+        now = time.monotonic()
+        if self.accept_warned is not None and \
+                now - self.accept_warned < ACCEPT_WARNING_INTERVAL:
+            return
+        logging.warning(f"accept() failed: {error} "
+                        f"({self.accept_errors} times)")
+        self.accept_errors = 0
+        self.accept_warned = now
+
+    def close_connection(self, sock_fd):
+        client = self.connections.pop(sock_fd)
+        self.poller.unregister(sock_fd)
+        self.throttled.discard(sock_fd)
+        self.ready.discard(sock_fd)
+        self.paused.discard(sock_fd)
+        for listener in self.listeners:
+            if listener.name == client.listener:
+                listener.active -= 1
+        try:
+            client.close()
+        except OSError:
+            print('Transport endpoint not connected, connection closed.')
 
     def handle_pollin(self, sock_fd):
         client = self.connections[sock_fd]
 
         should_close_client = client.on_read_available()
         if should_close_client:
-            self.poller.unregister(sock_fd)
-            self.connections.pop(sock_fd)
-            try:
-                client.close()
-            except OSError:
-                print('Transport endpoint not connected, connection closed.')
-        elif client.shoud_pollout():
-            self.poller.modify(sock_fd, select.POLLIN | select.POLLOUT)
-        else:
-            self.poller.modify(sock_fd, select.POLLIN)
+            # Stop reading, but let the pending output drain first
+            client.quit = True
+        self.update_interest(sock_fd, client)
 
     def handle_pollout(self, sock_fd):
         client = self.connections[sock_fd]
-        client.send()
-        if not client.shoud_pollout():
-            self.poller.modify(sock_fd, select.POLLIN)
+        try:
+            client.send()
+        except OSError:
+            # Client went away with output still pending
+            self.close_connection(sock_fd)
+            return
+        self.update_interest(sock_fd, client)
+
+    def update_interest(self, sock_fd, client):
+        """
+        Decides which events to poll for on a client after serving it, and
+        closes it once it quit and its output was flushed.
+        """
+        if client.quit and not client.shoud_pollout():
+            self.close_connection(sock_fd)
+            return
+        if self.drain_deadline is not None and client.is_idle():
+            # Being replaced: let clients reconnect to the new server
+            self.close_connection(sock_fd)
+            return
+
+        if client.quit:
+            mask = 0
+        elif client.reading_paused():
+            # Backpressure: requests wait in the kernel, or in recv_buffer,
+            # until the client reads its responses
+            mask = 0
+            self.paused.add(sock_fd)
+            self.ready.discard(sock_fd)
+        else:
+            mask = select.POLLIN
+            self.paused.discard(sock_fd)
+            if client.lines_ready:
+                # Stopped at PIPELINE_BATCH requests or paused, the rest
+                # are buffered
+                self.ready.add(sock_fd)
+        if client.shoud_pollout():
+            if client.throttled_until is not None:
+                # Woken up by wake_throttled() instead
+                self.throttled.add(sock_fd)
+            else:
+                mask |= select.POLLOUT
+        self.poller.modify(sock_fd, mask)
 
 
 def main():
@@ -101,6 +526,67 @@ def main():
     parser.add_option(
         "-d", "--datadir",
         help="Directorio compartido", default=DEFAULT_DIR)
+    parser.add_option(
+        "-L", "--listen", action="append", metavar="SPEC",
+        help="Escuchar en SPEC: HOST:PORT, [HOST6]:PORT o unix:PATH. Se "
+             "puede repetir; si se usa, se ignoran -a y -p", default=None)
+    parser.add_option(
+        "-l", "--access-log",
+        help="Archivo donde escribir el log de accesos (por defecto stdout)",
+        default=None)
+    parser.add_option(
+        "-f", "--log-format", type="choice", choices=list(FORMATS),
+        help="Formato del log de accesos: text o json", default="text")
+    parser.add_option(
+        "-b", "--backlog", type="int",
+        help="Tamaño de la cola de conexiones pendientes",
+        default=DEFAULT_BACKLOG)
+    parser.add_option(
+        "--accept-batch", type="int",
+        help="Máximo de conexiones aceptadas por iteración del loop",
+        default=ACCEPT_BATCH)
+    parser.add_option(
+        "--no-nodelay", dest="nodelay", action="store_false",
+        help="No desactivar el algoritmo de Nagle (TCP_NODELAY)",
+        default=True)
+    parser.add_option(
+        "-r", "--rate-limit", action="append", metavar="SUBNET=RATE",
+        help="Limitar a RATE bytes/s (ej. 512K, 10M) el tráfico hacia la "
+             "subred SUBNET, compartido entre sus clientes. Se puede repetir",
+        default=[])
+    parser.add_option(
+        "-g", "--global-rate", metavar="RATE",
+        help="Limitar a RATE bytes/s el tráfico total del servidor",
+        default=None)
+    parser.add_option(
+        "--drain-timeout", type="float",
+        help="Segundos que espera un servidor reemplazado (kill -HUP) a "
+             "que terminen sus conexiones", default=DRAIN_TIMEOUT)
+    parser.add_option(
+        "--sndbuf", type="int",
+        help="SO_SNDBUF de las conexiones aceptadas, en bytes", default=None)
+    parser.add_option(
+        "--rcvbuf", type="int",
+        help="SO_RCVBUF de las conexiones aceptadas, en bytes", default=None)
+    parser.add_option(
+        "--high-water", metavar="SIZE",
+        help="Dejar de leer pedidos de una conexión con más de SIZE bytes "
+             "(ej. 4M) de respuestas sin enviar",
+        default=str(DEFAULT_HIGH_WATER))
+    parser.add_option(
+        "--low-water", metavar="SIZE",
+        help="Volver a leer pedidos de la conexión cuando le quedan menos de "
+             "SIZE bytes sin enviar", default=str(DEFAULT_LOW_WATER))
+    parser.add_option(
+        "--memory-budget", metavar="SIZE",
+        help="Máximo de respuestas sin enviar entre todas las conexiones; "
+             "al llegar, se deja de leer pedidos de las que tienen salida "
+             "pendiente", default=str(DEFAULT_MEMORY_BUDGET))
+    parser.add_option(
+        "--record", metavar="FILE",
+        help="Grabar los pedidos atendidos (sin el contenido de las "
+             "respuestas) en FILE, para reproducirlos con replay.py",
+        default=None)
 
     options, args = parser.parse_args()
     if len(args) > 0:
@@ -114,8 +600,55 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    server = Server(options.address, port, options.datadir)
-    server.serve()
+    if options.access_log is not None:
+        log_stream = open(options.access_log, 'a')
+    else:
+        log_stream = sys.stdout
+    access_log = AccessLog(log_stream, options.log_format)
+
+    tuning = SocketTuning(options.nodelay, options.sndbuf, options.rcvbuf)
+
+    rate_limiter = None
+    if options.rate_limit or options.global_rate is not None:
+        try:
+            global_rate = None
+            if options.global_rate is not None:
+                global_rate = parse_rate(options.global_rate)
+            rate_limiter = RateLimiter(options.rate_limit, global_rate)
+        except ValueError as e:
+            sys.stderr.write("Límite de ancho de banda inválido: %s\n" % e)
+            parser.print_help()
+            sys.exit(1)
+
+    try:
+        budget = OutputBudget(parse_size(options.high_water),
+                              parse_size(options.low_water),
+                              parse_size(options.memory_budget))
+    except ValueError as e:
+        sys.stderr.write("Límite de memoria inválido: %s\n" % e)
+        parser.print_help()
+        sys.exit(1)
+
+    recorder = None
+    if options.record is not None:
+        recorder = Recorder(options.record)
+
+    server = Server(options.address, port, options.datadir, access_log,
+                    options.backlog, options.accept_batch, tuning,
+                    options.listen, rate_limiter, options.drain_timeout,
+                    budget, recorder)
+    server.install_signal_handlers()
+
+    # kill -USR1 vuelca las estadísticas del servidor a stderr
+    signal.signal(signal.SIGUSR1, lambda signum, frame: sys.stderr.write(
+        json.dumps(server.stats()) + '\n'))
+
+    try:
+        server.serve()
+    finally:
+        access_log.close()
+        if recorder is not None:
+            recorder.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+# encoding: utf-8
+"""
+Runs server.py in a subprocess and measures it through /proc, for the tests
+and the benchmarks.
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'server.py')
+START_TIMEOUT = 10  # seconds
+
+
+def free_port() -> int:
+    """A loopback port nobody is listening on right now."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(directory: str, args: List[str],
+                 **kwargs) -> Tuple[subprocess.Popen, int]:
+    """
+    Launches server.py serving `directory' on a free loopback port (plus
+    whatever -L listeners args adds) and waits until it accepts. Returns
+    the process and the port. kwargs go to Popen; stdout is discarded
+    unless given.
+    """
+    port = free_port()
+    kwargs.setdefault('stdout', subprocess.DEVNULL)
+    # Unbuffered, so its output can be read while it runs
+    proc = subprocess.Popen(
+        [sys.executable, '-u', SERVER_SCRIPT, '-L', f'127.0.0.1:{port}',
+         '-d', directory, '-l', os.devnull] + args, **kwargs)
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return proc, port
+        except OSError:
+            if time.monotonic() > deadline or proc.poll() is not None:
+                proc.kill()
+                proc.wait()
+                raise RuntimeError("server.py did not start")
+            time.sleep(0.05)
+
+
+def rss(pid='self') -> int:
+    """Resident memory of a process in bytes (Linux only)."""
+    with open(f'/proc/{pid}/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
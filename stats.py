@@ -0,0 +1,12 @@
+# encoding: utf-8
+"""
+Summary statistics shared by the benchmark and replay tools.
+"""
+
+from typing import List
+
+
+def percentile(samples: List[float], p: float) -> float:
+    """The sample below which a fraction p of them fall (nearest rank)."""
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Pruebas de carga prolongada (soak) del servidor.
+
+Lanza server.py en un subproceso y durante --duration segundos lo ataca
+con --clients clientes concurrentes, cada uno repitiendo al azar:
+
+- sesiones normales con una mezcla de comandos, válidos e inválidos,
+- ráfagas de pedidos en pipeline,
+- half-close: manda pedidos y cierra su lado antes de leer,
+- resets (RST) a mitad de una respuesta grande,
+- cortes sin quit, y lectores lentos que fuerzan envíos parciales.
+
+Verifica cada respuesta contra los archivos que generó. Mientras corre
+mide la memoria residente y los descriptores abiertos del servidor (por
+/proc), y al final controla que la memoria se haya estabilizado, que no
+queden conexiones ni descriptores abiertos de más, y que ningún cliente
+haya visto una respuesta incorrecta.
+
+No forma parte de server-test.py porque tarda: se corre aparte, p.ej.
+
+    python stress-test.py --duration 300 --clients 500
+"""
+
+import base64
+import json
+import logging
+import optparse
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import client
+import constants
+from serverproc import rss, spawn_server
+
+DURATION = 20  # segundos
+CLIENTS = 200
+SEED = None
+TIMEOUT = 10  # Para esperar cada respuesta, con el servidor cargado
+
+# Archivos servidos: nombre -> tamaño
+FILES = {
+    'empty': 0,
+    'one': 1,
+    'small': 1000,
+    'medium': 100000,
+    'large': 2 ** 20,
+}
+# Segundos entre muestras de memoria y descriptores del servidor
+SAMPLE_INTERVAL = 0.5
+# Crecimiento de la memoria tolerado entre la primera y la segunda mitad
+# de la corrida (sin contar el calentamiento)
+RSS_GROWTH_RATIO = 0.10
+RSS_GROWTH_SLACK = 8 * 2 ** 20
+
+
+def proc_fds(pid):
+    return len(os.listdir('/proc/%d/fd' % pid))
+
+
+class StressClient(object):
+    """
+    Un cliente de la prueba: repite escenarios al azar hasta el deadline
+    y anota cualquier respuesta incorrecta.
+    """
+
+    def __init__(self, port, data, deadline, rng):
+        self.port = port
+        self.data = data
+        self.deadline = deadline
+        self.rng = rng
+        self.failures = []
+        self.requests = 0
+        self.scenarios = {}
+
+    def run(self):
+        scenarios = [
+            (self.session, 5),
+            (self.pipeline, 2),
+            (self.half_close, 1),
+            (self.reset_mid_response, 1),
+            (self.abrupt_close, 1),
+            (self.slow_reader, 1),
+            (self.bad_request, 1),
+        ]
+        functions = [f for f, _ in scenarios]
+        weights = [w for _, w in scenarios]
+        while time.monotonic() < self.deadline:
+            scenario = self.rng.choices(functions, weights)[0]
+            name = scenario.__name__
+            self.scenarios[name] = self.scenarios.get(name, 0) + 1
+            try:
+                scenario()
+            except AssertionError as e:
+                self.failures.append("%s: %s" % (name, e))
+            except (socket.error, ConnectionError) as e:
+                self.failures.append("%s: %r" % (name, e))
+            if len(self.failures) > 10:
+                return
+
+    def connect(self):
+        return client.Client('127.0.0.1', self.port)
+
+    # Pedidos al azar y las respuestas que corresponden
+
+    def random_request(self):
+        """Devuelve (pedido, código esperado, cuerpo esperado)."""
+        rng = self.rng
+        name = rng.choice(list(self.data))
+        content = self.data[name]
+        size = len(content)
+        kind = rng.randrange(8)
+        if kind == 0:
+            return 'get_file_listing', constants.CODE_OK, sorted(self.data)
+        if kind == 1:
+            return ('get_metadata %s' % name, constants.CODE_OK,
+                    [str(size)])
+        if kind == 2:
+            offset = rng.randint(0, size)
+            length = rng.randint(0, min(size - offset, 65536))
+            return ('get_slice %s %d %d' % (name, offset, length),
+                    constants.CODE_OK,
+                    [base64.b64encode(content[offset:offset + length])
+                     .decode('ascii')])
+        if kind == 3:
+            offset = rng.randint(0, size + 10)
+            return ('get_slice %s %d %d' % (name, offset, size + 1),
+                    constants.BAD_OFFSET, None)
+        if kind == 4:
+            names = rng.sample(list(self.data) + ['missing'], 3)
+            return ('get_metadata_batch %s' % ' '.join(names),
+                    constants.CODE_OK,
+                    ['%d %d' % (constants.CODE_OK, len(self.data[n]))
+                     if n in self.data else str(constants.FILE_NOT_FOUND)
+                     for n in names])
+        if kind == 5 and size > 0:
+            ranges = []
+            for _ in range(rng.randint(1, 4)):
+                offset = rng.randrange(size)
+                length = rng.randint(1, min(size - offset, 16384))
+                ranges.append((offset, length))
+            line = 'get_slices %s %s' % (
+                name, ' '.join('%d %d' % r for r in ranges))
+            return (line, constants.CODE_OK,
+                    [base64.b64encode(content[o:o + n]).decode('ascii')
+                     for o, n in ranges])
+        if kind == 5:
+            # Los rangos vacíos no se aceptan
+            return ('get_slices %s 0 0' % name, constants.INVALID_ARGUMENTS,
+                    None)
+        if kind == 6:
+            return ('get_metadata no-such-file', constants.FILE_NOT_FOUND,
+                    None)
+        return 'frobnicate %s' % name, constants.INVALID_COMMAND, None
+
+    def check_response(self, c, request, code, body):
+        """Lee una respuesta completa y la compara con la esperada."""
+        status, message = c.read_response_line(TIMEOUT)
+        assert status == code, "%r: %s %s, se esperaba %s" % (
+            request[:60], status, message, code)
+        self.requests += 1
+        if body is None:
+            return
+        command = request.split(' ', 1)[0]
+        if command in ('get_file_listing', 'get_metadata_batch',
+                       'get_slices'):
+            lines = []
+            while True:
+                line = c.read_line(TIMEOUT)
+                assert c.connected, "%r: conexión cerrada" % request[:60]
+                if line == '':
+                    break
+                lines.append(line)
+            if command == 'get_file_listing':
+                lines.sort()
+        else:
+            lines = [c.read_line(TIMEOUT)]
+        assert lines == body, "%r: respuesta incorrecta" % request[:60]
+
+    # Escenarios
+
+    def session(self):
+        c = self.connect()
+        try:
+            for _ in range(self.rng.randint(1, 20)):
+                request, code, body = self.random_request()
+                c.send(request, TIMEOUT)
+                self.check_response(c, request, code, body)
+            c.send('quit', TIMEOUT)
+            self.check_response(c, 'quit', constants.CODE_OK, None)
+            assert c.read_line(TIMEOUT) == '' and not c.connected, \
+                "la conexión sigue abierta después de quit"
+        finally:
+            c.abort()
+
+    def pipeline(self):
+        c = self.connect()
+        try:
+            requests = [self.random_request()
+                        for _ in range(self.rng.randint(2, 50))]
+            c.s.sendall(''.join(r + constants.EOL
+                                for r, _, _ in requests).encode('ascii'))
+            for request, code, body in requests:
+                self.check_response(c, request, code, body)
+        finally:
+            c.abort()
+
+    def half_close(self):
+        c = self.connect()
+        try:
+            requests = [self.random_request()
+                        for _ in range(self.rng.randint(1, 5))]
+            c.s.sendall(''.join(r + constants.EOL
+                                for r, _, _ in requests).encode('ascii'))
+            c.s.shutdown(socket.SHUT_WR)
+            # Las respuestas llegan igual, y después el servidor cierra
+            for request, code, body in requests:
+                self.check_response(c, request, code, body)
+            assert c.read_line(TIMEOUT) == '' and not c.connected, \
+                "el servidor no cerró tras el half-close"
+        finally:
+            c.abort()
+
+    def reset_mid_response(self):
+        c = self.connect()
+        # Cerrar con SO_LINGER en 0 manda un RST en lugar de un FIN
+        c.s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                       struct.pack('ii', 1, 0))
+        try:
+            c.send('get_slice large 0 %d' % FILES['large'], TIMEOUT)
+            c.s.settimeout(TIMEOUT)
+            c.s.recv(self.rng.randint(1, 65536))
+        finally:
+            c.abort()
+
+    def abrupt_close(self):
+        c = self.connect()
+        request, code, body = self.random_request()
+        try:
+            c.send(request, TIMEOUT)
+            if self.rng.random() < 0.5:
+                self.check_response(c, request, code, body)
+        finally:
+            c.abort()
+
+    def slow_reader(self):
+        c = self.connect()
+        # Un buffer de recepción chico obliga al servidor a mandar la
+        # respuesta de a pedazos
+        c.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        try:
+            c.send('get_slice medium 0 %d' % FILES['medium'], TIMEOUT)
+            time.sleep(self.rng.random() * 0.2)
+            self.check_response(
+                c, 'get_slice medium', constants.CODE_OK,
+                [base64.b64encode(self.data['medium']).decode('ascii')])
+        finally:
+            c.abort()
+
+    def bad_request(self):
+        c = self.connect()
+        try:
+            # Un \n suelto es un error fatal: el servidor contesta y cierra
+            c.send('get_metadata small\nget_file_listing', TIMEOUT)
+            self.check_response(c, 'bad eol', constants.BAD_EOL, None)
+            assert c.read_line(TIMEOUT) == '' and not c.connected, \
+                "el servidor no cerró tras un error fatal"
+        finally:
+            c.abort()
+
+
+class TestSoak(unittest.TestCase):
+
+    def setUp(self):
+        if not os.path.exists('/proc/self/statm'):
+            self.skipTest("Hace falta /proc")
+        self.datadir = tempfile.mkdtemp(prefix='hftp-stress-')
+        self.data = {}
+        for name, size in FILES.items():
+            self.data[name] = os.urandom(size)
+            with open(os.path.join(self.datadir, name), 'wb') as f:
+                f.write(self.data[name])
+        self.stderr = tempfile.TemporaryFile(mode='w+')
+        # Tantos clientes y sus conexiones necesitan descriptores, acá y en
+        # el servidor, que hereda el límite
+        try:
+            import resource
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ImportError, ValueError):
+            pass
+        self.proc, self.port = spawn_server(self.datadir, [],
+                                            stderr=self.stderr)
+
+    def tearDown(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.stderr.close()
+        shutil.rmtree(self.datadir)
+
+    def server_stats(self):
+        """Las estadísticas que vuelca el servidor con kill -USR1."""
+        self.stderr.seek(0, os.SEEK_END)
+        position = self.stderr.tell()
+        self.proc.send_signal(signal.SIGUSR1)
+        deadline = time.monotonic() + TIMEOUT
+        while time.monotonic() < deadline:
+            self.stderr.seek(position)
+            for line in self.stderr:
+                if line.startswith('{'):
+                    return json.loads(line)
+            time.sleep(0.05)
+        self.fail("El servidor no volcó sus estadísticas")
+
+    def wait_for_idle(self):
+        """
+        Espera a que el servidor cierre todas las conexiones. Devuelve sus
+        estadísticas y cuántos descriptores tiene abiertos.
+        """
+        deadline = time.monotonic() + TIMEOUT
+        while True:
+            stats = self.server_stats()
+            if stats['connections'] == 0 or time.monotonic() > deadline:
+                return stats, proc_fds(self.proc.pid)
+            time.sleep(0.1)
+
+    def test_soak(self):
+        pid = self.proc.pid
+        _, idle_fds = self.wait_for_idle()
+        rng = random.Random(SEED)
+        start = time.monotonic()
+        deadline = start + DURATION
+
+        samples = []  # (segundos desde el comienzo, rss, fds)
+        done = threading.Event()
+
+        def monitor():
+            while not done.wait(SAMPLE_INTERVAL):
+                samples.append((time.monotonic() - start, rss(pid),
+                                proc_fds(pid)))
+
+        clients = [StressClient(self.port, self.data, deadline,
+                                random.Random(rng.random()))
+                   for _ in range(CLIENTS)]
+        threads = [threading.Thread(target=c.run) for c in clients]
+        sampler = threading.Thread(target=monitor)
+        sampler.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        done.set()
+        sampler.join()
+
+        failures = [f for c in clients for f in c.failures]
+        requests = sum(c.requests for c in clients)
+        scenarios = {}
+        for c in clients:
+            for name, count in c.scenarios.items():
+                scenarios[name] = scenarios.get(name, 0) + count
+        print("\n%d pedidos verificados en %.1f s; escenarios: %s"
+              % (requests, time.monotonic() - start, scenarios))
+
+        self.assertIsNone(self.proc.poll(), "El servidor terminó")
+        self.assertEqual(failures, [], "%d fallas" % len(failures))
+        self.assertGreater(requests, CLIENTS)
+
+        # La memoria no debe seguir creciendo una vez caliente: la segunda
+        # mitad de la corrida no puede superar a la primera
+        steady = [rss for t, rss, _ in samples if t > DURATION * 0.2]
+        if len(steady) >= 4:
+            half = len(steady) // 2
+            first, second = max(steady[:half]), max(steady[half:])
+            print("RSS máximo: %.1f MB, luego %.1f MB"
+                  % (first / 2 ** 20, second / 2 ** 20))
+            self.assertLess(second, first * (1 + RSS_GROWTH_RATIO) +
+                            RSS_GROWTH_SLACK, "La memoria sigue creciendo")
+
+        # Ni conexiones ni descriptores perdidos
+        stats, fds = self.wait_for_idle()
+        self.assertEqual(stats['connections'], 0)
+        self.assertEqual(stats['output']['used'], 0)
+        self.assertEqual(fds, idle_fds,
+                         "El servidor perdió descriptores")
+
+        # Y sigue atendiendo
+        c = client.Client('127.0.0.1', self.port)
+        self.assertEqual(c.get_metadata('small'), FILES['small'])
+        c.close()
+
+
+def main():
+    global DURATION, CLIENTS, SEED
+    parser = optparse.OptionParser()
+    parser.set_usage("%prog [opciones] [clases de tests]")
+    parser.add_option('-t', '--duration', type='float', default=DURATION,
+                      help="Segundos de carga")
+    parser.add_option('-c', '--clients', type='int', default=CLIENTS,
+                      help="Clientes concurrentes")
+    parser.add_option('-s', '--seed', type='int', default=SEED,
+                      help="Semilla, para repetir una corrida")
+    options, args = parser.parse_args()
+    DURATION = options.duration
+    CLIENTS = options.clients
+    SEED = options.seed
+    # Los cortes abruptos son parte de la prueba, no hace falta avisarlos
+    logging.getLogger().setLevel(logging.ERROR)
+    unittest.main(argv=sys.argv[0:1] + args)
+
+
+if __name__ == '__main__':
+    main()
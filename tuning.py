@@ -0,0 +1,40 @@
+# encoding: utf-8
+"""
+Socket options applied to every accepted connection.
+"""
+
+import socket
+from typing import Union
+
+
+class SocketTuning(object):
+    """
+    Perfil de opciones de socket para las conexiones aceptadas.
+
+    - nodelay: desactiva Nagle, así las respuestas cortas (metadata,
+      códigos de error) salen sin esperar el ACK del segmento anterior.
+    - sndbuf/rcvbuf: tamaño de los buffers del kernel, en bytes. None deja
+      el valor por defecto (y el autotuning de Linux).
+    """
+
+    nodelay: bool
+    sndbuf: Union[int, None]
+    rcvbuf: Union[int, None]
+
+    def __init__(self, nodelay: bool = True, sndbuf: int = None,
+                 rcvbuf: int = None):
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+
+    def apply(self, sock: socket.socket):
+        if self.nodelay and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def __repr__(self):
+        return (f"SocketTuning(nodelay={self.nodelay}, "
+                f"sndbuf={self.sndbuf}, rcvbuf={self.rcvbuf})")
@@ -0,0 +1,313 @@
+# encoding: utf-8
+"""
+Change notifications for the served directory.
+
+Clients that send "subscribe" get a line pushed for every file that is
+added, removed or modified, instead of polling get_file_listing. The
+server has a single watcher for all of them:
+
+- On Linux, inotify through ctypes. Its descriptor is polled by the
+  server loop like any socket. Files are reported once the process
+  writing them closes them (or renames them into place), so subscribers
+  don't go fetch half written files.
+- Elsewhere, or if inotify can't be used, a periodic scan comparing the
+  inode, mtime and size of every file.
+
+Both report raw events that Subscriptions coalesces before pushing: a
+temporary file created and renamed within the same batch is never seen,
+and a file replaced by a rename is reported as modified.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import time
+from constants import VALID_CHARS
+from typing import Dict, List, Set, Tuple, Union
+
+# Seconds between scans of the fallback watcher
+SCAN_INTERVAL = 1.0
+# A subscriber with this many bytes of output pending stops getting events
+# until it catches up, and is then told it missed some
+EVENT_BUFFER_LIMIT = 65536
+
+ADD = 'add'
+REMOVE = 'remove'
+MODIFY = 'modify'
+# Events were lost, e.g. the kernel queue filled up: re-list the directory
+OVERFLOW = 'overflow'
+
+Event = Tuple[str, Union[str, None]]
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |
+              IN_ONLYDIR)
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+INOTIFY_READ_SIZE = 65536
+
+
+def valid_name(name: str) -> bool:
+    """Only files a client could ask for are reported."""
+    return bool(name) and all(c in VALID_CHARS for c in name)
+
+
+class InotifyWatcher(object):
+    """Vigila un directorio con inotify(7)."""
+
+    directory: str
+    fd: int
+    # watch descriptor while started
+    wd: Union[int, None]
+
+    def __init__(self, directory: str):
+        """Raises OSError if inotify is not available."""
+        name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.directory = directory
+        self.wd = None
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def timeout(self) -> Union[float, None]:
+        return None
+
+    def start(self):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(self.directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        self.wd = wd
+
+    def stop(self):
+        # The descriptor stays open (and registered in the server's poll
+        # object), it just stops getting events
+        if self.wd is not None:
+            self.libc.inotify_rm_watch(self.fd, self.wd)
+            self.wd = None
+
+    def read(self) -> List[Event]:
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    events.append((OVERFLOW, None))
+                elif wd != self.wd or mask & IN_ISDIR:
+                    # Leftovers of a previous watch, or subdirectories
+                    continue
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    events.append((REMOVE, os.fsdecode(name)))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    # Subscriptions tells new files from modified ones
+                    events.append((MODIFY, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ScanWatcher(object):
+    """
+    Vigila un directorio revisándolo cada `interval' segundos, donde no
+    hay inotify.
+    """
+
+    directory: str
+    interval: float
+    # name -> (inode, mtime, size) as of the last scan, while started
+    files: Union[Dict[str, Tuple[int, int, int]], None]
+    next_scan: float
+
+    def __init__(self, directory: str, interval: float = SCAN_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.files = None
+        self.next_scan = 0.0
+
+    def fileno(self) -> None:
+        return None
+
+    def timeout(self) -> Union[float, None]:
+        """time.monotonic() of the next scan, while started."""
+        return None if self.files is None else self.next_scan
+
+    def start(self):
+        self.files = self.scan()
+        self.next_scan = time.monotonic() + self.interval
+
+    def stop(self):
+        self.files = None
+
+    def scan(self) -> Dict[str, Tuple[int, int, int]]:
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_ino, stat.st_mtime_ns,
+                                             stat.st_size)
+                except OSError:
+                    # Removed while scanning
+                    pass
+        return files
+
+    def read(self) -> List[Event]:
+        now = time.monotonic()
+        if self.files is None or now < self.next_scan:
+            return []
+        self.next_scan = now + self.interval
+
+        files = self.scan()
+        events = []
+        for name, state in files.items():
+            if name not in self.files:
+                events.append((ADD, name))
+            elif self.files[name] != state:
+                events.append((MODIFY, name))
+        for name in self.files:
+            if name not in files:
+                events.append((REMOVE, name))
+        self.files = files
+        return events
+
+    def close(self):
+        self.stop()
+
+
+def open_watcher(directory: str):
+    try:
+        return InotifyWatcher(directory)
+    except OSError:
+        return ScanWatcher(directory)
+
+
+class Subscriptions(object):
+    """
+    Conexiones suscriptas a los cambios del directorio, y el único
+    watcher que comparten.
+    """
+
+    directory: str
+    subscribers: Set
+    watcher: Union[InotifyWatcher, ScanWatcher, None]
+    # files that exist as far as the subscribers know
+    known: Set[str]
+
+    def __init__(self, directory: str, watcher_factory=open_watcher):
+        self.directory = directory
+        self.watcher_factory = watcher_factory
+        self.subscribers = set()
+        self.watcher = None
+        self.known = set()
+
+    def subscribe(self, connection):
+        """Raises OSError if the directory can't be watched."""
+        if not self.subscribers:
+            if self.watcher is None:
+                self.watcher = self.watcher_factory(self.directory)
+            # Started before listing, so no change falls in between
+            self.watcher.start()
+            self.known = self.list_files()
+        self.subscribers.add(connection)
+
+    def unsubscribe(self, connection):
+        self.subscribers.discard(connection)
+        if not self.subscribers and self.watcher is not None:
+            self.watcher.stop()
+
+    def fileno(self) -> Union[int, None]:
+        """Descriptor to poll for events, if the watcher has one."""
+        return None if self.watcher is None else self.watcher.fileno()
+
+    def timeout(self) -> Union[float, None]:
+        """time.monotonic() at which dispatch() should be called next."""
+        if self.watcher is None or not self.subscribers:
+            return None
+        return self.watcher.timeout()
+
+    def list_files(self) -> Set[str]:
+        with os.scandir(self.directory) as entries:
+            return {e.name for e in entries
+                    if valid_name(e.name) and e.is_file()}
+
+    def dispatch(self) -> List:
+        """
+        Reads the pending changes and queues them to every subscriber.
+        Returns the connections that got output to send.
+        """
+        if self.watcher is None:
+            return []
+        raw = self.watcher.read()
+        if not raw or not self.subscribers:
+            return []
+
+        events = self.coalesce(raw)
+        if not events:
+            return []
+        lines = b''.join(f"{event} {name}".encode('ascii') + b'\r\n'
+                         if name is not None else
+                         event.encode('ascii') + b'\r\n'
+                         for event, name in events)
+        for connection in self.subscribers:
+            connection.push_events(lines)
+        return list(self.subscribers)
+
+    def coalesce(self, raw: List[Event]) -> List[Event]:
+        """
+        Turns a batch of raw events into at most one event per file, by
+        comparing whether it existed before and after the batch.
+        """
+        if any(event == OVERFLOW for event, _ in raw):
+            self.known = self.list_files()
+            return [(OVERFLOW, None)]
+
+        # name -> exists after the batch, in order of first appearance
+        after = collections.OrderedDict()
+        for event, name in raw:
+            if valid_name(name):
+                after[name] = event != REMOVE
+
+        events = []
+        for name, exists in after.items():
+            existed = name in self.known
+            if exists and not existed:
+                events.append((ADD, name))
+                self.known.add(name)
+            elif existed and not exists:
+                events.append((REMOVE, name))
+                self.known.discard(name)
+            elif exists:
+                events.append((MODIFY, name))
+        return events
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()